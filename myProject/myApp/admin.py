@@ -1,3 +1,192 @@
-from django.contrib import admin
+from datetime import timedelta
 
-# Register your models here.
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin.helpers import ActionForm
+from django.db import transaction
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .billing import PLAN_WEEKS
+from .catalog import bump_catalog_version
+from .entitlements import invalidate_entitlements
+from .models import AIUserAccess, BotBotTransaction, BotService, BotSubscription, BotUserPaymentInfo
+from .pagination import EstimatedCountPaginator
+
+PLAN_CHOICES = [(plan, plan) for plan in [*PLAN_WEEKS, 'lifetime']]
+
+
+class SubscriptionActionFields(forms.Form):
+    weeks = forms.IntegerField(required=False, min_value=1, max_value=520, label="Weeks")
+    plan = forms.ChoiceField(required=False, choices=[('', "Plan")] + PLAN_CHOICES, label="Plan")
+
+
+class SubscriptionActionForm(ActionForm, SubscriptionActionFields):
+    # The action dropdown plus the inputs the subscription actions read
+    pass
+
+
+def action_value(modeladmin, request, field):
+    """
+    The cleaned value of one of the SubscriptionActionFields, or None (after telling the user) when it is missing.
+    """
+    form = SubscriptionActionFields(request.POST)
+    value = form.cleaned_data.get(field) if form.is_valid() else None
+    if not value:
+        modeladmin.message_user(request, f"Enter a valid {field} next to the action first.", messages.ERROR)
+    return value
+
+
+def invalidate_users_of(queryset):
+    user_ids = list(queryset.values_list('user_id', flat=True).distinct())
+    transaction.on_commit(lambda: invalidate_entitlements(*user_ids))
+    return len(user_ids)
+
+
+def legacy_access_of(queryset):
+    # The selected subscriptions' users' AIUserAccess rows, as a subquery rather than a list of ids
+    return AIUserAccess.objects.filter(user_id__in=queryset.values('user_id'))
+
+
+@admin.register(BotSubscription)
+class BotSubscriptionAdmin(admin.ModelAdmin):
+    list_display = ('user', 'selected_plan', 'is_active', 'expiration_date', 'next_billing_date', 'declined_renewals')
+    list_select_related = ('user',)
+    list_filter = ('is_active', 'selected_plan')
+    search_fields = ('=user__email',)
+    raw_id_fields = ('user',)
+    readonly_fields = ('renewal_lease_until',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    action_form = SubscriptionActionForm
+    actions = ['extend_expiration', 'change_plan']
+
+    @admin.action(description="Extend expiration by N weeks")
+    def extend_expiration(self, request, queryset):
+        """
+        Pushes the selected subscriptions' expiry and next billing date back by N weeks in one UPDATE,
+        reactivating any the sweeper already switched off. Lifetime subscriptions are left as they are.
+        The legacy expiration_date on the users' AIUserAccess rows moves with it.
+        """
+        weeks = action_value(self, request, 'weeks')
+        if not weeks:
+            return
+        extension = timedelta(weeks=weeks)
+        with transaction.atomic():
+            subscriptions = queryset.filter(expiration_date__isnull=False).update(
+                expiration_date=F('expiration_date') + extension,
+                next_billing_date=F('next_billing_date') + extension,
+                is_active=True,
+                expiry_reminder_sent_at=None,
+                updated_at=timezone.now(),
+            )
+            legacy_access_of(queryset).filter(expiration_date__isnull=False).update(
+                expiration_date=F('expiration_date') + extension
+            )
+            invalidate_users_of(queryset)
+        self.message_user(request, f"Extended {subscriptions} subscriptions by {weeks} weeks.")
+
+    @admin.action(description="Change plan")
+    def change_plan(self, request, queryset):
+        """
+        Moves the selected subscriptions to another plan in one UPDATE. Switching to lifetime ends billing;
+        switching a lifetime subscription to a recurring plan gives it one period before the first charge.
+        """
+        plan = action_value(self, request, 'plan')
+        if not plan:
+            return
+        now = timezone.now()
+        if plan == 'lifetime':
+            dates = {'expiration_date': None, 'next_billing_date': None}
+        else:
+            first_period_end = Value(now + timedelta(weeks=PLAN_WEEKS[plan]))
+            dates = {
+                'expiration_date': Coalesce(F('expiration_date'), first_period_end),
+                'next_billing_date': Coalesce(F('next_billing_date'), F('expiration_date'), first_period_end),
+            }
+        with transaction.atomic():
+            subscriptions = queryset.update(
+                selected_plan=plan, is_active=True, expiry_reminder_sent_at=None, updated_at=now, **dates
+            )
+            legacy_access_of(queryset).update(selected_plan=plan)
+            invalidate_users_of(queryset)
+        self.message_user(request, f"Moved {subscriptions} subscriptions to the {plan} plan.")
+
+
+@admin.register(AIUserAccess)
+class AIUserAccessAdmin(admin.ModelAdmin):
+    list_display = ('user', 'bot_service', 'progress', 'selected_plan', 'expiration_date', 'is_saved', 'is_favorite')
+    list_select_related = ('user', 'bot_service')
+    # Each filter is served by an index: the partial saved/favorite indexes and the bot_service foreign key
+    list_filter = ('is_saved', 'is_favorite', 'bot_service')
+    search_fields = ('=user__email',)
+    raw_id_fields = ('user', 'bot_service')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    actions = ['mark_favorite', 'unmark_favorite']
+
+    @admin.action(description="Mark as favorite")
+    def mark_favorite(self, request, queryset):
+        updated = queryset.filter(is_favorite=False).update(is_favorite=True)
+        self.message_user(request, f"Marked {updated} rows as favorite.")
+
+    @admin.action(description="Unmark favorite")
+    def unmark_favorite(self, request, queryset):
+        updated = queryset.filter(is_favorite=True).update(is_favorite=False)
+        self.message_user(request, f"Unmarked {updated} favorites.")
+
+
+@admin.register(BotBotTransaction)
+class BotBotTransactionAdmin(admin.ModelAdmin):
+    list_display = ('user', 'subscription_type', 'status', 'amount', 'BotTransaction_date', 'recurring')
+    list_select_related = ('user',)
+    # status and date ranges go through txn_status_date_idx and the BotTransaction_date index
+    list_filter = ('status', ('BotTransaction_date', admin.DateFieldListFilter))
+    search_fields = ('=user__email', '=square_payment_id')
+    raw_id_fields = ('user',)
+    ordering = ('-BotTransaction_date',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+    def get_readonly_fields(self, request, obj=None):
+        # DailyRevenue counts a transaction when it is saved new or deleted, never on a later save, so the fields
+        # it is bucketed and summed by stay fixed once recorded. Status changes come from the Square webhooks, which
+        # move the rollups along with record_status_changes
+        if obj is None:
+            return self.readonly_fields
+        return (*self.readonly_fields, 'status', 'amount', 'BotTransaction_date', 'subscription_type')
+
+
+@admin.register(BotUserPaymentInfo)
+class BotUserPaymentInfoAdmin(admin.ModelAdmin):
+    list_display = ('user', 'customer_id', 'card_id')
+    list_select_related = ('user',)
+    search_fields = ('=user__email', '=customer_id')
+    raw_id_fields = ('user',)
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(BotService)
+class BotServiceAdmin(admin.ModelAdmin):
+    list_display = ('title', 'category', 'order', 'is_active')
+    list_filter = ('is_active', 'category')
+    list_editable = ('order', 'is_active')
+    search_fields = ('title',)
+    ordering = ('order', 'id')
+    actions = ['activate', 'deactivate']
+
+    def set_active(self, request, queryset, is_active):
+        updated = queryset.exclude(is_active=is_active).update(is_active=is_active)
+        # update() sends no post_save, so move the catalog version here, once the change has committed
+        transaction.on_commit(bump_catalog_version)
+        self.message_user(request, f"{'Activated' if is_active else 'Deactivated'} {updated} services.")
+
+    @admin.action(description="Activate")
+    def activate(self, request, queryset):
+        self.set_active(request, queryset, True)
+
+    @admin.action(description="Deactivate")
+    def deactivate(self, request, queryset):
+        self.set_active(request, queryset, False)
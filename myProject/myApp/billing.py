@@ -0,0 +1,172 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import square_gateway
+from .entitlements import invalidate_entitlements
+from .models import BotBotTransaction, BotSubscription
+from .revenue import record_transactions
+from .views import determine_amount_based_on_plan
+
+logger = logging.getLogger(__name__)
+
+PLAN_WEEKS = {'1-week': 1, '4-week': 4, '12-week': 12}
+# A declined renewal is retried this much later (with a new idempotency key)
+DECLINE_RETRY_DELAY = timedelta(days=1)
+# Declines in a row after which billing stops and the subscription is ended
+MAX_DECLINED_RENEWALS = 4
+# How long a claimed subscription is reserved; a renewal that ended in an unknown outcome is retried after this
+RENEWAL_LEASE = timedelta(minutes=10)
+
+
+def renewal_idempotency_key(subscription):
+    """
+    One key per user and billing cycle: re-running a cycle after a crash or timeout replays
+    Square's original result instead of charging the card twice.
+    """
+    return f"renewal-{subscription.user_id}-{int(subscription.next_billing_date.timestamp())}"
+
+
+def claim_due_subscriptions(now, batch_size):
+    """
+    Reserves the next batch of active subscriptions due for renewal at `now` for this worker and returns them,
+    read through the next_billing_date index in (next_billing_date, id) order. Rows another worker has claimed
+    are skipped, so two runners never charge the same subscription.
+    """
+    with transaction.atomic():
+        ids = list(
+            BotSubscription.objects.select_for_update(skip_locked=True)
+            .filter(next_billing_date__lte=now, is_active=True)
+            .filter(Q(renewal_lease_until__isnull=True) | Q(renewal_lease_until__lte=now))
+            .order_by('next_billing_date', 'id')
+            .values_list('id', flat=True)[:batch_size]
+        )
+        BotSubscription.objects.filter(id__in=ids).update(renewal_lease_until=now + RENEWAL_LEASE)
+    return list(
+        BotSubscription.objects.filter(id__in=ids)
+        .select_related('user__botuserpaymentinfo')
+        .order_by('next_billing_date', 'id')
+    )
+
+
+def charge_renewal(subscription):
+    """
+    Charges the stored card for one renewal. Returns (status, detail) where status is
+    'success', 'declined' (Square refused the charge) or 'error' (we don't know; retry the same cycle),
+    and detail is the Square payment id on success and the error otherwise.
+    """
+    payment_info = getattr(subscription.user, 'botuserpaymentinfo', None)
+    if payment_info is None:
+        return 'declined', "No card on file."
+    amount = determine_amount_based_on_plan(subscription.selected_plan)
+    try:
+        result = square_gateway.call('payments.create_payment', {
+            "source_id": payment_info.card_id,
+            "customer_id": payment_info.customer_id,
+            "idempotency_key": renewal_idempotency_key(subscription),
+            "amount_money": {"amount": amount, "currency": "USD"},
+            "autocomplete": True,
+        })
+    except Exception as e:
+        return 'error', str(e)
+    if result.is_error():
+        return 'declined', str(result.errors)
+    return 'success', result.body['payment']['id']
+
+
+def apply_renewals(now, outcomes):
+    """
+    Writes one batch of renewal outcomes: all transactions in one bulk INSERT and all subscription
+    changes in one bulk UPDATE, inside a single transaction.
+    """
+    transactions = []
+    changed = []
+    for subscription, (status, detail) in outcomes:
+        amount = determine_amount_based_on_plan(subscription.selected_plan)
+        if status == 'success':
+            weeks = timedelta(weeks=PLAN_WEEKS[subscription.selected_plan])
+            # Stay on the original billing cycle unless we are more than a cycle behind
+            next_billing_date = subscription.next_billing_date + weeks
+            if next_billing_date <= now:
+                next_billing_date = now + weeks
+            subscription.next_billing_date = next_billing_date
+            subscription.expiration_date = next_billing_date
+            subscription.is_active = True
+            subscription.expiry_reminder_sent_at = None
+            subscription.declined_renewals = 0
+            subscription.renewal_lease_until = None
+            changed.append(subscription)
+            transactions.append(BotBotTransaction(
+                user_id=subscription.user_id,
+                amount=amount,
+                subscription_type=subscription.selected_plan,
+                status='success',
+                recurring=True,
+                is_renewal=True,
+                next_billing_date=next_billing_date,
+                square_payment_id=detail,
+            ))
+        elif status == 'declined':
+            subscription.declined_renewals += 1
+            if subscription.declined_renewals >= MAX_DECLINED_RENEWALS:
+                # Out of retries: stop billing and end the subscription
+                subscription.next_billing_date = None
+                subscription.is_active = False
+            else:
+                subscription.next_billing_date = now + DECLINE_RETRY_DELAY
+            subscription.renewal_lease_until = None
+            changed.append(subscription)
+            transactions.append(BotBotTransaction(
+                user_id=subscription.user_id,
+                amount=amount,
+                subscription_type=subscription.selected_plan,
+                status='error',
+                error_logs=detail,
+                recurring=True,
+                is_renewal=True,
+            ))
+        else:
+            # Unknown outcome: leave next_billing_date alone and keep the lease, so a run after RENEWAL_LEASE
+            # retries with the same key
+            logger.warning("Renewal for user %s did not complete: %s", subscription.user_id, detail)
+
+    for subscription in changed:
+        subscription.updated_at = now  # bulk_update skips auto_now
+
+    with transaction.atomic():
+        BotBotTransaction.objects.bulk_create(transactions)
+        record_transactions(transactions)  # bulk_create skips post_save
+        BotSubscription.objects.bulk_update(changed, [
+            'next_billing_date', 'expiration_date', 'is_active', 'expiry_reminder_sent_at', 'declined_renewals',
+            'renewal_lease_until', 'updated_at',
+        ])
+    invalidate_entitlements(*[subscription.user_id for subscription in changed])
+
+
+def run_renewals(batch_size=500, concurrency=16, now=None):
+    """
+    Renews every active subscription due at `now`, charging up to `concurrency` cards at a time.
+    Returns a dict of counts per outcome.
+    """
+    now = now or timezone.now()
+    counts = {'success': 0, 'declined': 0, 'error': 0}
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        while True:
+            batch = claim_due_subscriptions(now, batch_size)
+            if not batch:
+                return counts
+
+            recurring = [subscription for subscription in batch if subscription.selected_plan in PLAN_WEEKS]
+            # Anything else (lifetime, unknown plans) has no billing cycle; stop selecting it
+            BotSubscription.objects.filter(
+                id__in=[subscription.id for subscription in batch if subscription.selected_plan not in PLAN_WEEKS]
+            ).update(next_billing_date=None, renewal_lease_until=None, updated_at=now)
+
+            outcomes = list(zip(recurring, pool.map(charge_renewal, recurring)))
+            for _, (status, _) in outcomes:
+                counts[status] += 1
+            apply_renewals(now, outcomes)
@@ -0,0 +1,72 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.locmem import LocMemCache
+
+from .models import BotService
+
+CATALOG_VERSION_KEY = 'catalog:version'
+CATALOG_CACHE_TTL = 24 * 60 * 60
+
+# (version, services) for this process; replaced wholesale so readers never see a half-updated pair
+_local_catalog = (None, None)
+
+
+def cache_is_shared():
+    # A locmem cache lives in this process only, so bumps and evictions made by other processes never reach it
+    return not isinstance(caches['default'], LocMemCache)
+
+
+def cache_timeout(timeout):
+    """
+    `timeout` for an entry in a shared cache; in a process-local one, at most LOCAL_CACHE_TTL, since nothing
+    another process changes would ever evict it.
+    """
+    if cache_is_shared():
+        return timeout
+    return settings.LOCAL_CACHE_TTL if timeout is None else min(timeout, settings.LOCAL_CACHE_TTL)
+
+
+def catalog_version():
+    """
+    Current catalog version from the shared cache. It is seeded from the clock rather than 1, so a
+    flushed cache can never hand out a version some process still has a stale local copy for. In a
+    process-local cache the version expires after LOCAL_CACHE_TTL, so this process's copy is reloaded then.
+    """
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOG_VERSION_KEY, int(time.time() * 1000), timeout=cache_timeout(None))
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def bump_catalog_version():
+    try:
+        cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        catalog_version()
+
+
+def active_services():
+    """
+    The active BotService catalog ordered by `order`, served from process memory while the shared
+    version is unchanged, then from the shared cache, and only then from the database.
+    """
+    global _local_catalog
+    version = catalog_version()
+    local_version, services = _local_catalog
+    if version is not None and local_version == version:
+        return services
+
+    key = f"catalog:{version}:services"
+    services = cache.get(key)
+    if services is None:
+        services = list(BotService.objects.filter(is_active=True).order_by('order', 'id'))
+        cache.set(key, services, timeout=cache_timeout(CATALOG_CACHE_TTL))
+    _local_catalog = (version, services)
+    return services
+
+
+def active_service_ids():
+    return frozenset(service.pk for service in active_services())
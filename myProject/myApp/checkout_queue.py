@@ -0,0 +1,84 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .models import CheckoutJob
+from .views import run_checkout
+
+logger = logging.getLogger(__name__)
+
+# Attempts for a checkout that keeps ending in a server error (Square unavailable, crash)
+MAX_ATTEMPTS = 5
+# How long a claimed job is reserved; a worker that dies mid-checkout releases it when this runs out
+PROCESS_LEASE = timedelta(minutes=5)
+
+
+def retry_delay(attempts):
+    # 5, 10, 20, 40 ... seconds
+    return timedelta(seconds=5 * 2 ** (attempts - 1))
+
+
+def claim_jobs(batch_size):
+    """
+    Reserves up to batch_size due checkouts for this worker and returns them.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            CheckoutJob.objects.select_for_update(skip_locked=True)
+            .filter(status__in=['queued', 'processing'], next_attempt_at__lte=now)
+            .order_by('next_attempt_at')
+            .values_list('id', flat=True)[:batch_size]
+        )
+        CheckoutJob.objects.filter(id__in=ids).update(
+            status='processing', next_attempt_at=now + PROCESS_LEASE, updated_at=now
+        )
+    return list(CheckoutJob.objects.filter(id__in=ids).order_by('created_at'))
+
+
+def process_job(job):
+    """
+    Runs one queued checkout and records its outcome. Every attempt uses the job's id as the checkout key,
+    so a retried job replays the Square calls an earlier attempt already made. Returns the final status.
+    """
+    def on_step(step):
+        CheckoutJob.objects.filter(pk=job.pk).update(step=step, updated_at=timezone.now())
+
+    try:
+        response = run_checkout(job.payload, checkout_key=f"job:{job.pk}", on_step=on_step)
+        job.attempts += 1
+        job.response_status = response.status_code
+        job.response_body = json.loads(response.content)
+        if response.status_code >= 500 and job.attempts < MAX_ATTEMPTS:
+            job.status = 'queued'
+            job.next_attempt_at = timezone.now() + retry_delay(job.attempts)
+        else:
+            job.status = 'succeeded' if response.status_code == 200 else 'failed'
+            # The card token is single-use and of no further value; don't keep it around
+            job.payload = {}
+        job.step = ''
+        job.save(update_fields=[
+            'status', 'step', 'attempts', 'next_attempt_at', 'response_status', 'response_body', 'payload', 'updated_at',
+        ])
+        return job.status
+    finally:
+        close_old_connections()
+
+
+def process_checkout_batch(batch_size=20, concurrency=8):
+    """
+    Claims a batch of due checkouts and runs them concurrently; they spend most of their time waiting
+    on Square. Returns a dict of counts per resulting status.
+    """
+    jobs = claim_jobs(batch_size)
+    counts = {'succeeded': 0, 'failed': 0, 'queued': 0}
+    if not jobs:
+        return counts
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(jobs))) as pool:
+        for status in pool.map(process_job, jobs):
+            counts[status] += 1
+    return counts
@@ -0,0 +1,170 @@
+import asyncio
+import hashlib
+import json
+import time
+import uuid
+from datetime import timedelta
+from functools import wraps
+
+from django.core.cache import cache
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+
+from .models import BotBotTransaction
+
+# How long a checkout may stay in flight before a duplicate stops waiting for it
+IN_FLIGHT_TIMEOUT = 60
+# How long a finished checkout's response is replayed to duplicates
+REPLAY_TIMEOUT = 10 * 60
+POLL_INTERVAL = 0.05
+
+PENDING = 'pending'
+SQUARE_KEY_NAMESPACE = uuid.UUID('5b0f1f62-8a55-4c7e-9a43-3c4a1b1e2d70')
+
+
+def checkout_request_key(request, data):
+    """
+    The client's idempotency_key scoped to the buyer, or one derived from what makes a checkout unique: the buyer,
+    the plan and the single-use card token. Client keys are hashed with the email, so two buyers sending the
+    same key never get each other's response replayed.
+    """
+    if data.get('idempotency_key'):
+        parts = [data.get('email') or '', str(data['idempotency_key'])]
+        return 'client:' + hashlib.sha256('|'.join(parts).encode()).hexdigest()
+    parts = [data.get('email'), data.get('plan'), data.get('source_id')]
+    if not all(parts):
+        return None
+    return 'derived:' + hashlib.sha256('|'.join(parts).encode()).hexdigest()
+
+
+def repurchase_request_key(request, data):
+    """
+    The client's idempotency_key, or the buyer, the plan and their latest transaction from before the replay
+    window. Repeats inside the window share a key and get the first response; once the window has passed,
+    that purchase (or failure) becomes the anchor and the next deliberate purchase gets a new key.
+    """
+    if not request.user.is_authenticated:
+        return None
+    if data.get('idempotency_key'):
+        return f"client:{request.user.pk}:{data['idempotency_key']}"
+    anchor = (
+        BotBotTransaction.objects.filter(
+            user=request.user, BotTransaction_date__lt=timezone.now() - timedelta(seconds=REPLAY_TIMEOUT)
+        )
+        .order_by('-BotTransaction_date', '-id')
+        .values_list('id', flat=True)
+        .first()
+    )
+    return f"repurchase:{request.user.pk}:{data.get('plan') or ''}:{anchor}"
+
+
+def square_idempotency_key(checkout_key, step):
+    """
+    The Square idempotency key for one step of a checkout, derived from its checkout key, so that running
+    the same checkout again (a duplicate that missed the replay store, a retried job) is deduplicated by Square.
+    None without a checkout key.
+    """
+    return str(uuid.uuid5(SQUARE_KEY_NAMESPACE, f"{checkout_key}:{step}")) if checkout_key else None
+
+
+def square_key(request, step):
+    # The step's key for a request inside coalesce()
+    return square_idempotency_key(getattr(request, 'checkout_key', None), step)
+
+
+def _cache_key(key):
+    return f"checkout:{key}"
+
+
+def _request_key(request, key_func):
+    try:
+        data = json.loads(request.body or b'{}')
+    except ValueError:
+        return None
+    return key_func(request, data) if isinstance(data, dict) else None
+
+
+def _stored(response):
+    return {'status': response.status_code, 'content': response.content, 'content_type': response['Content-Type']}
+
+
+def _remember(cache_key, response):
+    # Server errors are not remembered, so retrying after one runs the checkout again
+    if response.status_code >= 500:
+        cache.delete(cache_key)
+    else:
+        cache.set(cache_key, _stored(response), REPLAY_TIMEOUT)
+
+
+async def _aremember(cache_key, response):
+    if response.status_code >= 500:
+        await cache.adelete(cache_key)
+    else:
+        await cache.aset(cache_key, _stored(response), REPLAY_TIMEOUT)
+
+
+def _replay(entry):
+    if entry == PENDING:
+        return JsonResponse({"error": "This checkout is still being processed. Please wait."}, status=409)
+    response = HttpResponse(entry['content'], status=entry['status'], content_type=entry['content_type'])
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def coalesce(key_func):
+    """
+    Deduplicates POSTs that share a key from key_func(request, data). The first request runs the view; duplicates
+    arriving meanwhile wait for its response, and later ones get it replayed for REPLAY_TIMEOUT, so a double
+    submit makes no extra Square calls or writes. Works across workers when the cache is shared.
+    """
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+            @wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                key = _request_key(request, key_func) if request.method == 'POST' else None
+                if key is None:
+                    return await view(request, *args, **kwargs)
+                request.checkout_key = key
+                cache_key = _cache_key(key)
+                deadline = time.monotonic() + IN_FLIGHT_TIMEOUT
+                while not await cache.aadd(cache_key, PENDING, IN_FLIGHT_TIMEOUT):
+                    entry = await cache.aget(cache_key)
+                    if entry is not None and (entry != PENDING or time.monotonic() >= deadline):
+                        return _replay(entry)
+                    await asyncio.sleep(POLL_INTERVAL)
+
+                try:
+                    response = await view(request, *args, **kwargs)
+                except BaseException:
+                    await cache.adelete(cache_key)
+                    raise
+                await _aremember(cache_key, response)
+                return response
+
+            return async_wrapper
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            key = _request_key(request, key_func) if request.method == 'POST' else None
+            if key is None:
+                return view(request, *args, **kwargs)
+            request.checkout_key = key
+            cache_key = _cache_key(key)
+            deadline = time.monotonic() + IN_FLIGHT_TIMEOUT
+            while not cache.add(cache_key, PENDING, IN_FLIGHT_TIMEOUT):
+                entry = cache.get(cache_key)
+                if entry is not None and (entry != PENDING or time.monotonic() >= deadline):
+                    return _replay(entry)
+                time.sleep(POLL_INTERVAL)
+
+            try:
+                response = view(request, *args, **kwargs)
+            except BaseException:
+                cache.delete(cache_key)
+                raise
+            _remember(cache_key, response)
+            return response
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,100 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count
+
+from .entitlements import invalidate_entitlements
+from .models import AIUserAccess
+
+# Extra rows removed per DELETE statement
+DELETE_BATCH_SIZE = 500
+
+MERGED_FIELDS = ['progress', 'expiration_date', 'renewal_date', 'renewal_task_id', 'selected_plan', 'is_saved', 'is_favorite']
+
+
+def newest_set(rows, field):
+    return next((getattr(row, field) for row in reversed(rows) if getattr(row, field)), None)
+
+
+def merge_rows(rows):
+    """
+    Folds a (user, bot_service) group, oldest row first, into its newest row the way migration 0002 did: the
+    highest progress, any saved/favorite flag and the latest expiration (none if any row never expires), plus
+    the latest renewal date and the newest plan and renewal task that were set. Returns (kept row, extra ids).
+    """
+    keep = rows[-1]
+    expirations = [row.expiration_date for row in rows]
+    renewals = [row.renewal_date for row in rows if row.renewal_date]
+    keep.progress = max(row.progress for row in rows)
+    keep.is_saved = any(row.is_saved for row in rows)
+    keep.is_favorite = any(row.is_favorite for row in rows)
+    keep.expiration_date = None if None in expirations else max(expirations)
+    keep.renewal_date = max(renewals) if renewals else None
+    keep.selected_plan = newest_set(rows, 'selected_plan')
+    keep.renewal_task_id = newest_set(rows, 'renewal_task_id')
+    return keep, [row.id for row in rows[:-1]]
+
+
+def duplicate_user_ids(first_user_id, last_user_id):
+    # Counted on the (user, bot_service) unique index, in its order; rows without a bot_service group together
+    return (
+        AIUserAccess.objects.filter(user_id__gte=first_user_id, user_id__lte=last_user_id)
+        .values('user_id', 'bot_service_id')
+        .annotate(rows=Count('id'))
+        .filter(rows__gt=1)
+        .values_list('user_id', flat=True)
+        .order_by()
+    )
+
+
+def stateless_orphans(first_user_id, last_user_id):
+    # Rows no service reads, holding nothing BotSubscription doesn't (the rule migration 0004 deleted by)
+    return (
+        AIUserAccess.objects.filter(
+            user_id__gte=first_user_id, user_id__lte=last_user_id, bot_service__isnull=True, progress=0.0
+        )
+        .exclude(is_saved=True)
+        .exclude(is_favorite=True)
+    )
+
+
+def dedupe_chunk(first_user_id, last_user_id, drop_orphans=False, dry_run=False, batch_size=DELETE_BATCH_SIZE):
+    """
+    Merges the duplicate (user, bot_service) groups of users first_user_id..last_user_id into one row each and
+    deletes the extras batch_size at a time, all in one short transaction. With drop_orphans, rows with no
+    bot_service and no state of their own go too. A dry run does the same and rolls back.
+    Returns (groups merged, rows deleted).
+    """
+    with transaction.atomic():
+        user_ids = set(duplicate_user_ids(first_user_id, last_user_id))
+        groups = defaultdict(list)
+        for row in AIUserAccess.objects.select_for_update().filter(user_id__in=user_ids).order_by('id'):
+            groups[row.user_id, row.bot_service_id].append(row)
+
+        kept, extra_ids = [], []
+        for rows in groups.values():
+            if len(rows) > 1:
+                keep, extras = merge_rows(rows)
+                kept.append(keep)
+                extra_ids.extend(extras)
+        # Written back as INSERT ... ON CONFLICT (id) DO UPDATE: plain VALUES rows, where bulk_update would build
+        # a CASE per field and row
+        AIUserAccess.objects.bulk_create(
+            kept, update_conflicts=True, unique_fields=['id'], update_fields=MERGED_FIELDS, batch_size=batch_size
+        )
+
+        deleted = 0
+        for start in range(0, len(extra_ids), batch_size):
+            deleted += AIUserAccess.objects.filter(id__in=extra_ids[start:start + batch_size]).delete()[0]
+        if drop_orphans:
+            orphan_ids = list(stateless_orphans(first_user_id, last_user_id).values_list('id', flat=True))
+            for start in range(0, len(orphan_ids), batch_size):
+                deleted += AIUserAccess.objects.filter(id__in=orphan_ids[start:start + batch_size]).delete()[0]
+
+        if dry_run:
+            transaction.set_rollback(True)
+        else:
+            # bulk_create sends no post_save; the deletes evicted their own users through post_delete
+            merged_user_ids = [row.user_id for row in kept]
+            transaction.on_commit(lambda: invalidate_entitlements(*merged_user_ids))
+    return len(kept), deleted
@@ -0,0 +1,121 @@
+import threading
+from itertools import islice
+
+from django.conf import settings
+from django.contrib.auth.forms import PasswordResetForm
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.template.loader import get_template
+from django.urls import reverse
+from django.utils.html import escape
+
+# Per-recipient values are rendered as these markers, so one template render yields the static output
+# with holes in it; sending then only fills the holes.
+FIELD_MARK = '\x1f'
+
+
+class CompiledEmail:
+    """
+    An email template rendered once with markers in place of the per-recipient fields and split into static
+    chunks. The static parts (layout, inline <style> CSS, copy) are never rendered again; render() only joins
+    them with the recipient's values, HTML-escaped for the HTML alternative.
+    """
+
+    def __init__(self, name, field_names, shared_context):
+        context = dict(shared_context)
+        context.update({field: f"{FIELD_MARK}{field}{FIELD_MARK}" for field in field_names})
+        self.subject = self.split(get_template(f"myApp/{name}_subject.txt").render(context).strip())
+        self.text = self.split(get_template(f"myApp/{name}.txt").render(context))
+        self.html = self.split(get_template(f"myApp/{name}.html").render(context))
+
+    @staticmethod
+    def split(rendered):
+        # Even positions are static text, odd positions are field names
+        return rendered.split(FIELD_MARK)
+
+    @staticmethod
+    def join(parts, fields, escape_value):
+        return ''.join(
+            part if index % 2 == 0 else escape_value(fields[part])
+            for index, part in enumerate(parts)
+        )
+
+    def render(self, fields):
+        """
+        Returns (subject, text, html) for one recipient.
+        """
+        return (
+            self.join(self.subject, fields, str),
+            self.join(self.text, fields, str),
+            self.join(self.html, fields, escape),
+        )
+
+
+_compiled = {}
+_compiled_lock = threading.Lock()
+
+
+def compiled_email(name, field_names, shared_context=None):
+    """
+    Loads and compiles the `name` email (myApp/<name>_subject.txt, <name>.txt, <name>.html) once per
+    process for a given set of per-recipient fields and shared context.
+    """
+    shared_context = shared_context or {}
+    key = (name, frozenset(field_names), tuple(sorted(shared_context.items())))
+    compiled = _compiled.get(key)
+    if compiled is None:
+        with _compiled_lock:
+            compiled = _compiled.get(key)
+            if compiled is None:
+                compiled = _compiled[key] = CompiledEmail(name, field_names, shared_context)
+    return compiled
+
+
+def build_email(name, to_email, fields, from_email=None, shared_context=None, compiled=None):
+    """
+    Builds the text + HTML EmailMultiAlternatives for one recipient of the `name` email.
+    """
+    compiled = compiled or compiled_email(name, fields.keys(), shared_context)
+    subject, text, html = compiled.render(fields)
+    email = EmailMultiAlternatives(subject, text, from_email or settings.DEFAULT_FROM_EMAIL, [to_email])
+    email.attach_alternative(html, "text/html")
+    return email
+
+
+def build_bulk_emails(name, recipients, field_names, from_email=None, shared_context=None):
+    """
+    Yields one message per (to_email, fields) pair in `recipients`, compiling the templates only once.
+    """
+    compiled = compiled_email(name, field_names, shared_context)
+    for to_email, fields in recipients:
+        yield build_email(name, to_email, fields, from_email=from_email, compiled=compiled)
+
+
+def send_bulk_emails(name, recipients, field_names, from_email=None, shared_context=None, batch_size=500):
+    """
+    Renders and hands messages to EMAIL_BACKEND in batches (with the outbox backend, one INSERT per batch).
+    Returns the number of messages sent.
+    """
+    messages = build_bulk_emails(name, recipients, field_names, from_email, shared_context)
+    connection = get_connection()
+    sent = 0
+    while True:
+        batch = list(islice(messages, batch_size))
+        if not batch:
+            return sent
+        sent += connection.send_messages(batch) or 0
+
+
+class CachedPasswordResetForm(PasswordResetForm):
+    """
+    Password reset form that renders its email through the compiled `password_reset_email` templates
+    instead of running the template engine for every request.
+    """
+
+    def send_mail(self, subject_template_name, email_template_name, context, from_email, to_email,
+                  html_email_template_name=None):
+        reset_path = reverse('password_reset_confirm', kwargs={'uidb64': context['uid'], 'token': context['token']})
+        fields = {
+            'username': context['user'].get_username(),
+            'reset_url': f"{context['protocol']}://{context['domain']}{reset_path}",
+        }
+        build_email('password_reset_email', to_email, fields, from_email=from_email).send()
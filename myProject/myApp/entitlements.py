@@ -0,0 +1,86 @@
+from django.core.cache import cache
+from django.utils import timezone
+
+from .catalog import active_service_ids, cache_timeout, catalog_version
+from .models import BotSubscription
+
+# Upper bound on how long an entry lives; entries for expiring plans are dropped at expiration_date
+ENTITLEMENT_CACHE_TTL = 15 * 60
+
+
+def entitlement_cache_key(user_id):
+    return f"entitlements:{user_id}"
+
+
+def load_entitlements(user_id):
+    """
+    Builds the cached entitlement entry for a user from their BotSubscription row.
+    """
+    subscription = BotSubscription.objects.filter(user_id=user_id).first()
+    if subscription is None or subscription.has_expired():
+        return {
+            'plan': subscription.selected_plan if subscription else None,
+            'expiration_date': subscription.expiration_date if subscription else None,
+            'active': False,
+            'service_ids': frozenset(),
+            'catalog_version': None,
+        }
+    return {
+        'plan': subscription.selected_plan,
+        'expiration_date': subscription.expiration_date,
+        'active': True,
+        'service_ids': active_service_ids(),
+        'catalog_version': catalog_version(),
+    }
+
+
+def entitlement_timeout(entitlements):
+    """
+    Seconds to keep an entry: never past the plan's expiration_date, so lapsed access drops out on its own,
+    and no longer than LOCAL_CACHE_TTL in a process-local cache, which other processes' evictions never reach.
+    """
+    ttl = cache_timeout(ENTITLEMENT_CACHE_TTL)
+    expiration_date = entitlements['expiration_date']
+    if not entitlements['active'] or expiration_date is None:
+        return ttl
+    remaining = (expiration_date - timezone.now()).total_seconds()
+    return max(1, min(ttl, int(remaining)))
+
+
+def get_entitlements(user):
+    """
+    Returns {'plan', 'expiration_date', 'active', 'service_ids'} for the user, filling the cache on first use.
+    Anonymous users get None.
+    """
+    if not user.is_authenticated:
+        return None
+    key = entitlement_cache_key(user.pk)
+    entitlements = cache.get(key)
+    if entitlements is None:
+        entitlements = load_entitlements(user.pk)
+        cache.set(key, entitlements, timeout=entitlement_timeout(entitlements))
+    elif entitlements['active'] and entitlements['catalog_version'] != catalog_version():
+        # The catalog changed since this entry was built; refresh the service ids from the catalog cache
+        entitlements = dict(entitlements, service_ids=active_service_ids(), catalog_version=catalog_version())
+        cache.set(key, entitlements, timeout=entitlement_timeout(entitlements))
+    return entitlements
+
+
+def invalidate_entitlements(*user_ids):
+    cache.delete_many([entitlement_cache_key(user_id) for user_id in user_ids])
+
+
+def has_access(user, bot_service=None):
+    """
+    Answers "can this user use this bot service?" (or any service, when bot_service is None)
+    from the cached entitlement entry; only a cache miss touches the database.
+    """
+    entitlements = get_entitlements(user)
+    if not entitlements or not entitlements['active']:
+        return False
+    expiration_date = entitlements['expiration_date']
+    if expiration_date is not None and timezone.now() > expiration_date:
+        return False
+    if bot_service is None:
+        return True
+    return getattr(bot_service, 'pk', bot_service) in entitlements['service_ids']
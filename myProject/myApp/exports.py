@@ -0,0 +1,189 @@
+import csv
+import json
+import zlib
+from datetime import datetime, time, timedelta
+
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import AIUserAccess, BotBotTransaction
+
+# Rows fetched per round trip; on PostgreSQL through a server-side cursor, so memory stays flat
+EXPORT_CHUNK_SIZE = 2000
+# Output is handed on in blocks of about this many bytes (before compression)
+BUFFER_SIZE = 64 * 1024
+
+FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+
+def day_range(start, end):
+    """
+    Aware datetimes bounding the local days start..end (inclusive), so the filter is a plain range on the
+    indexed column rather than a __date lookup the index can't serve.
+    """
+    tz = timezone.get_current_timezone()
+    return (
+        timezone.make_aware(datetime.combine(start, time.min), tz) if start else None,
+        timezone.make_aware(datetime.combine(end + timedelta(days=1), time.min), tz) if end else None,
+    )
+
+
+def date_filter(field, start, end):
+    lower, upper = day_range(start, end)
+    q = Q()
+    if lower:
+        q &= Q(**{f'{field}__gte': lower})
+    if upper:
+        q &= Q(**{f'{field}__lt': upper})
+    return q
+
+
+def transactions_queryset(start=None, end=None, status=None):
+    # Filtered and ordered on BotTransaction_date, so a date range (with or without a status) is read in order
+    # through the date or (status, date) index
+    queryset = BotBotTransaction.objects.filter(date_filter('BotTransaction_date', start, end))
+    if status:
+        queryset = queryset.filter(status=status)
+    return queryset.order_by('BotTransaction_date')
+
+
+# Access rows have no status of their own; these slices come from the user's BotSubscription
+ACCESS_STATUSES = {
+    'active': lambda now: Q(user__bot_subscription__is_active=True) & (
+        Q(user__bot_subscription__expiration_date__isnull=True) | Q(user__bot_subscription__expiration_date__gt=now)
+    ),
+    'expired': lambda now: Q(user__bot_subscription__is_active=False) | Q(user__bot_subscription__expiration_date__lte=now),
+    'saved': lambda now: Q(is_saved=True),
+    'favorite': lambda now: Q(is_favorite=True),
+}
+
+
+def access_queryset(start=None, end=None, status=None):
+    # Dates filter on the subscription's expiration_date (AIUserAccess.expiration_date is legacy and no longer
+    # written); together with status=active the range is read through sub_active_expiry_idx
+    queryset = AIUserAccess.objects.filter(date_filter('user__bot_subscription__expiration_date', start, end))
+    if status:
+        queryset = queryset.filter(ACCESS_STATUSES[status](timezone.now()))
+    # In whatever order the index or table yields them; sorting would mean reading everything first
+    return queryset.order_by()
+
+
+# kind -> (queryset builder, statuses accepted, [(column, field)])
+EXPORTS = {
+    'transactions': (
+        transactions_queryset,
+        [choice for choice, _ in BotBotTransaction.STATUS_CHOICES],
+        [
+            ('id', 'id'),
+            ('date', 'BotTransaction_date'),
+            ('user_email', 'user__email'),
+            ('plan', 'subscription_type'),
+            ('status', 'status'),
+            ('amount', 'amount'),
+            ('recurring', 'recurring'),
+            ('next_billing_date', 'next_billing_date'),
+            ('square_payment_id', 'square_payment_id'),
+        ],
+    ),
+    'access': (
+        access_queryset,
+        list(ACCESS_STATUSES),
+        [
+            ('id', 'id'),
+            ('user_email', 'user__email'),
+            ('bot_service', 'bot_service__title'),
+            ('progress', 'progress'),
+            ('is_saved', 'is_saved'),
+            ('is_favorite', 'is_favorite'),
+            ('plan', 'user__bot_subscription__selected_plan'),
+            ('subscription_active', 'user__bot_subscription__is_active'),
+            ('expiration_date', 'user__bot_subscription__expiration_date'),
+            ('next_billing_date', 'user__bot_subscription__next_billing_date'),
+        ],
+    ),
+}
+
+
+def export_rows(kind, start=None, end=None, status=None):
+    """
+    (columns, rows) for an export. Rows are tuples streamed from the database EXPORT_CHUNK_SIZE at a time.
+    """
+    build_queryset, statuses, columns = EXPORTS[kind]
+    if status and status not in statuses:
+        raise ValueError(f"status must be one of {', '.join(statuses)}")
+    queryset = build_queryset(start=start, end=end, status=status)
+    rows = queryset.values_list(*[field for _, field in columns]).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    return [column for column, _ in columns], rows
+
+
+class LineBuffer:
+    # Where csv.writer writes: just hands the line back
+    def write(self, line):
+        return line
+
+
+def csv_lines(columns, rows):
+    writer = csv.writer(LineBuffer())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def ndjson_lines(columns, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), cls=DjangoJSONEncoder) + '\n'
+
+
+def buffered(lines):
+    """
+    Joins lines into blocks of about BUFFER_SIZE bytes, so the response isn't written a row at a time.
+    """
+    block, size = [], 0
+    for line in lines:
+        block.append(line)
+        size += len(line)
+        if size >= BUFFER_SIZE:
+            yield ''.join(block).encode()
+            block, size = [], 0
+    if block:
+        yield ''.join(block).encode()
+
+
+def gzipped(blocks):
+    # A single gzip member, compressed as the blocks arrive
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for block in blocks:
+        compressed = compressor.compress(block)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def stream_export(kind, fmt='csv', compress=True, start=None, end=None, status=None):
+    """
+    The bytes of an export as an iterator of blocks. Nothing is held beyond the current block, so memory is
+    the same for ten thousand rows or ten million. Raises ValueError for an unknown status.
+    """
+    columns, rows = export_rows(kind, start=start, end=end, status=status)
+    blocks = buffered(csv_lines(columns, rows) if fmt == 'csv' else ndjson_lines(columns, rows))
+    return gzipped(blocks) if compress else blocks
+
+
+async def async_blocks(blocks):
+    """
+    The blocks of an export as an async iterator, for ASGI. Django would read a plain iterator into a list
+    before sending the first byte there; this pulls one block at a time on the thread that serves the request's
+    ORM calls, so the cursor never moves between threads.
+    """
+    while True:
+        block = await sync_to_async(next, thread_sensitive=True)(blocks, None)
+        if block is None:
+            return
+        yield block
+
+
+def export_filename(kind, fmt, compress, start=None, end=None):
+    span = '_'.join(day.isoformat() for day in (start, end) if day)
+    return f"{kind}{'_' + span if span else ''}.{fmt}{'.gz' if compress else ''}"
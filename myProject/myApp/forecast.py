@@ -0,0 +1,165 @@
+from datetime import datetime, time, timedelta
+
+import numpy as np
+from django.core.cache import cache
+from django.db.models import Case, IntegerField, Value, When
+from django.utils import timezone
+
+from .billing import PLAN_WEEKS
+from .models import BotBotTransaction, BotSubscription
+from .views import determine_amount_based_on_plan
+
+RECURRING_PLANS = list(PLAN_WEEKS)
+DEFAULT_HORIZON_DAYS = 90
+# Recurring charges this far back decide each plan's renewal rate
+DEFAULT_LOOKBACK_DAYS = 180
+FORECAST_CACHE_TTL = 60 * 60
+# Rows per fetch while loading transaction columns
+LOAD_CHUNK_SIZE = 20000
+
+
+def start_of_day(day):
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def plan_index(field='subscription_type'):
+    # The plan column as 0, 1, 2 ... in RECURRING_PLANS order, so it loads straight into an integer array
+    return Case(
+        *[When(**{field: plan}, then=Value(i)) for i, plan in enumerate(RECURRING_PLANS)],
+        output_field=IntegerField(),
+    )
+
+
+def renewal_rates(today, lookback_days=DEFAULT_LOOKBACK_DAYS):
+    """
+    Per recurring plan, the share of subscribers with a renewal charge within the lookback window whose latest
+    one succeeded (a decline or refund counts as churn). Used as the chance that any one renewal goes through.
+    Signup charges are left out, since they say nothing about renewing. Plans with no history take the overall
+    rate; with no history at all nothing is assumed to churn.
+    """
+    rows = (
+        BotBotTransaction.objects.filter(
+            is_renewal=True,
+            subscription_type__in=RECURRING_PLANS,
+            status__in=['success', 'error', 'refunded'],
+            BotTransaction_date__gte=start_of_day(today - timedelta(days=lookback_days)),
+        )
+        .annotate(plan=plan_index(), renewed=Case(When(status='success', then=Value(1)), default=Value(0)))
+        .values_list('id', 'user_id', 'plan', 'renewed')
+        .order_by()
+        .iterator(chunk_size=LOAD_CHUNK_SIZE)
+    )
+    charges = np.fromiter(rows, dtype=[('id', 'i8'), ('user', 'i8'), ('plan', 'i8'), ('renewed', 'i8')])
+
+    # Each user's latest charge: sort by (user, id) and keep the last row of every user's run
+    charges = charges[np.lexsort((charges['id'], charges['user']))]
+    latest = charges[np.append(charges['user'][1:] != charges['user'][:-1], True)] if len(charges) else charges
+
+    subscribers = np.bincount(latest['plan'], minlength=len(RECURRING_PLANS))
+    renewed = np.bincount(latest['plan'], weights=latest['renewed'], minlength=len(RECURRING_PLANS))
+    overall = renewed.sum() / subscribers.sum() if subscribers.sum() else 1.0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(subscribers > 0, renewed / subscribers, overall)
+
+
+def scheduled_renewals(today, horizon_days=DEFAULT_HORIZON_DAYS):
+    """
+    Active subscriptions billing before the horizon as arrays (day offset from today, plan index, count); anything
+    overdue is due today. One range read on the next_billing_date index loads the billing times and plans, which
+    are bucketed into local days against the day boundaries in NumPy.
+    """
+    rows = (
+        BotSubscription.objects.filter(
+            next_billing_date__lt=start_of_day(today + timedelta(days=horizon_days)),
+            selected_plan__in=RECURRING_PLANS,
+            is_active=True,
+        )
+        .annotate(plan=plan_index('selected_plan'))
+        .values_list('next_billing_date', 'plan')
+        .order_by()
+        .iterator(chunk_size=LOAD_CHUNK_SIZE)
+    )
+    due = np.fromiter(
+        ((next_billing_date.timestamp(), plan) for next_billing_date, plan in rows),
+        dtype=[('at', 'f8'), ('plan', 'i8')],
+    )
+
+    # The start of tomorrow, the day after and so on: a subscription's day is the number of them it has passed
+    day_ends = np.array([start_of_day(today + timedelta(days=offset)).timestamp() for offset in range(1, horizon_days)])
+    offsets = np.searchsorted(day_ends, due['at'], side='right')
+
+    buckets, counts = np.unique(offsets * len(RECURRING_PLANS) + due['plan'], return_counts=True)
+    return (
+        (buckets // len(RECURRING_PLANS)).astype(np.int64),
+        (buckets % len(RECURRING_PLANS)).astype(np.int64),
+        counts.astype(np.float64),
+    )
+
+
+def forecast_renewals(today=None, horizon_days=DEFAULT_HORIZON_DAYS, lookback_days=DEFAULT_LOOKBACK_DAYS):
+    """
+    Renewals and revenue expected on each of the next horizon_days days. A subscription renews every cycle until
+    the horizon; the k-th renewal from now counts in full in the scheduled figures and weighted by the plan's
+    renewal rate to the power k in the expected (churn-adjusted) ones.
+    """
+    today = today or timezone.localdate()
+    rates = renewal_rates(today, lookback_days)
+    offsets, plans, counts = scheduled_renewals(today, horizon_days)
+
+    period_days = np.array([PLAN_WEEKS[plan] * 7 for plan in RECURRING_PLANS])[plans]
+    prices = np.array([determine_amount_based_on_plan(plan) / 100 for plan in RECURRING_PLANS])[plans]
+
+    # One column per billing cycle: the day of each future renewal and the chance the subscription gets there
+    cycles = np.arange(horizon_days // min(PLAN_WEEKS.values()) // 7 + 1)
+    days = offsets[:, None] + cycles[None, :] * period_days[:, None]
+    survival = rates[plans][:, None] ** (cycles[None, :] + 1)
+    inside = days < horizon_days
+
+    def per_day(weights):
+        return np.bincount(days[inside], weights=np.broadcast_to(weights, days.shape)[inside], minlength=horizon_days)
+
+    scheduled = per_day(counts[:, None])
+    expected = per_day(counts[:, None] * survival)
+    scheduled_revenue = per_day((counts * prices)[:, None])
+    expected_revenue = per_day((counts * prices)[:, None] * survival)
+
+    return {
+        'start': today.isoformat(),
+        'horizon_days': horizon_days,
+        'lookback_days': lookback_days,
+        'generated_at': timezone.now().isoformat(),
+        'renewal_rates': {plan: round(float(rate), 4) for plan, rate in zip(RECURRING_PLANS, rates)},
+        'totals': {
+            'scheduled_renewals': int(scheduled.sum()),
+            'expected_renewals': round(float(expected.sum()), 2),
+            'scheduled_revenue': round(float(scheduled_revenue.sum()), 2),
+            'expected_revenue': round(float(expected_revenue.sum()), 2),
+        },
+        'days': [
+            {
+                'date': (today + timedelta(days=offset)).isoformat(),
+                'scheduled_renewals': int(scheduled[offset]),
+                'expected_renewals': round(float(expected[offset]), 2),
+                'scheduled_revenue': round(float(scheduled_revenue[offset]), 2),
+                'expected_revenue': round(float(expected_revenue[offset]), 2),
+            }
+            for offset in range(horizon_days)
+        ],
+    }
+
+
+def forecast_cache_key(today, horizon_days, lookback_days):
+    return f"renewal_forecast:{today.isoformat()}:{horizon_days}:{lookback_days}"
+
+
+def cached_forecast(horizon_days=DEFAULT_HORIZON_DAYS, lookback_days=DEFAULT_LOOKBACK_DAYS, refresh=False):
+    """
+    Today's forecast from the cache, computed on first use and kept for FORECAST_CACHE_TTL.
+    """
+    today = timezone.localdate()
+    key = forecast_cache_key(today, horizon_days, lookback_days)
+    forecast = None if refresh else cache.get(key)
+    if forecast is None:
+        forecast = forecast_renewals(today, horizon_days, lookback_days)
+        cache.set(key, forecast, FORECAST_CACHE_TTL)
+    return forecast
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max
+
+from myApp.models import BotBotTransaction, DailyRevenue
+from myApp.revenue import backfill_chunk
+
+
+class Command(BaseCommand):
+    help = ("Rebuilds the DailyRevenue rollups from BotBotTransaction in id-range chunks, each its own short "
+            "transaction. Transactions written meanwhile are counted as usual; pause `reconcile_webhooks` while "
+            "it runs, since a status change to a row not yet backfilled would be counted twice.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=5000)
+        parser.add_argument('--pause', type=float, default=0.05, help="Seconds to sleep between chunks")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        with transaction.atomic():
+            # Everything up to last_id is rebuilt here; later rows were counted when they were written
+            last_id = BotBotTransaction.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+            DailyRevenue.objects.all().delete()
+
+        counted = 0
+        first_id = 1
+        while first_id <= last_id:
+            chunk_last_id = min(first_id + options['chunk_size'] - 1, last_id)
+            with transaction.atomic():
+                counted += backfill_chunk(first_id, chunk_last_id)
+            self.stdout.write(f"counted {counted} transactions (up to id {chunk_last_id})")
+            first_id = chunk_last_id + 1
+            time.sleep(options['pause'])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f"done: counted {counted} transactions in {elapsed:.2f}s")
@@ -0,0 +1,52 @@
+import json
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = ("Fires concurrent checkouts at a running server (ideally backed by `fake_square`) "
+            "and reports throughput and latency.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000/process-payment-async/')
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--concurrency', type=int, default=50)
+        parser.add_argument('--plan', default='4-week')
+
+    def checkout(self, url, plan):
+        body = json.dumps({
+            "source_id": "cnon:card-nonce-ok",
+            "plan": plan,
+            "email": f"bench-{uuid.uuid4().hex[:12]}@example.com",
+            "givenName": "Bench",
+            "familyName": "User",
+        }).encode()
+        request = Request(url, data=body, headers={'Content-Type': 'application/json'})
+        started = time.perf_counter()
+        try:
+            with urlopen(request, timeout=60) as response:
+                status = response.status
+        except HTTPError as e:
+            status = e.code
+        return status, time.perf_counter() - started
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+            results = list(pool.map(
+                lambda _: self.checkout(options['url'], options['plan']),
+                range(options['requests']),
+            ))
+        elapsed = time.perf_counter() - started
+
+        latencies = sorted(latency for _, latency in results)
+        ok = sum(1 for status, _ in results if status == 200)
+        self.stdout.write(f"{len(results)} checkouts in {elapsed:.2f}s -> {len(results) / elapsed:.1f} req/s")
+        self.stdout.write(f"ok={ok} failed={len(results) - ok}")
+        self.stdout.write(f"p50={latencies[len(latencies) // 2] * 1000:.0f} ms "
+                          f"p95={latencies[int(len(latencies) * 0.95) - 1] * 1000:.0f} ms")
@@ -0,0 +1,97 @@
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils.crypto import get_random_string
+
+from myApp.models import BotBotTransaction, BotSubscription, BotUserPaymentInfo
+from myApp.views import (
+    complete_checkout, compute_plan_dates, determine_amount_based_on_plan, send_welcomepassword_email,
+)
+
+WRITES = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+
+def legacy_checkout(user_email, selected_plan, amount, customer_id, card_id):
+    # The old write path: every step autocommits on its own and update_or_create selects before it writes
+    user, created = User.objects.get_or_create(username=user_email, defaults={'email': user_email})
+    if created:
+        random_password = get_random_string(8)
+        user.set_password(random_password)
+        user.save()
+        send_welcomepassword_email(user_email, random_password)
+    BotUserPaymentInfo.objects.update_or_create(user=user, defaults={'customer_id': customer_id, 'card_id': card_id})
+    expiration_date, next_billing_date = compute_plan_dates(selected_plan)
+    BotSubscription.objects.update_or_create(
+        user=user,
+        defaults={'expiration_date': expiration_date, 'next_billing_date': next_billing_date,
+                  'selected_plan': selected_plan},
+    )
+    BotBotTransaction.objects.create(
+        user=user, amount=amount, subscription_type=selected_plan, status='success',
+        recurring=True, next_billing_date=next_billing_date,
+    )
+    return user
+
+
+@contextmanager
+def count_commits(counts):
+    """
+    Counts commits on the default connection: explicit COMMITs at the end of atomic blocks, plus every
+    write statement run in autocommit mode (each of which is its own implicit commit). Also counts statements.
+    """
+    def execute(execute, sql, params, many, context):
+        counts['statements'] += 1
+        if connection.get_autocommit() and sql.lstrip().upper().startswith(WRITES):
+            counts['commits'] += 1
+        return execute(sql, params, many, context)
+
+    original_commit = connection.commit
+
+    def commit():
+        counts['commits'] += 1
+        return original_commit()
+
+    connection.commit = commit
+    try:
+        with connection.execute_wrapper(execute):
+            yield counts
+    finally:
+        del connection.commit
+
+
+class Command(BaseCommand):
+    help = ("Counts database commits and statements per checkout for the old autocommitted write path and "
+            "the current single-transaction complete_checkout, on a throwaway test database.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checkouts', type=int, default=200)
+        parser.add_argument('--plan', default='4-week')
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=False)
+        try:
+            with override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher']):
+                for label, checkout in (('before', legacy_checkout), ('after', complete_checkout)):
+                    self.run(label, checkout, options['checkouts'], options['plan'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def run(self, label, checkout, checkouts, plan):
+        amount = determine_amount_based_on_plan(plan)
+        counts = {'commits': 0, 'statements': 0}
+        started = time.perf_counter()
+        with count_commits(counts):
+            for _ in range(checkouts):
+                token = uuid.uuid4().hex
+                checkout(f"bench-{token[:12]}@example.com", plan, amount, f"CUST_{token}", f"CARD_{token}")
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"{label}: {counts['commits'] / checkouts:.1f} commits/checkout, "
+            f"{counts['statements'] / checkouts:.1f} statements/checkout, "
+            f"{elapsed / checkouts * 1000:.2f} ms/checkout"
+        )
@@ -0,0 +1,85 @@
+import os
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, close_old_connections, connection
+from django.test.utils import override_settings
+
+from myApp.views import complete_checkout, determine_amount_based_on_plan
+
+
+class Command(BaseCommand):
+    help = ("Hammers process_payment's write path (complete_checkout) from concurrent threads on a throwaway "
+            "test database and reports throughput, latency and lock errors. Run it once per DATABASE_PROFILE "
+            "to compare them.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checkouts', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=16)
+        parser.add_argument('--plan', default='4-week')
+        parser.add_argument('--real-hasher', action='store_true',
+                            help="Hash the new account's password with the production hasher instead of MD5, "
+                                 "which makes the benchmark CPU-bound")
+
+    def handle(self, *args, **options):
+        test_settings = connection.settings_dict.setdefault('TEST', {})
+        scratch_dir = None
+        if connection.vendor == 'sqlite' and not test_settings.get('NAME'):
+            # The default in-memory test database never contends for the file lock
+            scratch_dir = tempfile.mkdtemp()
+            test_settings['NAME'] = os.path.join(scratch_dir, 'bench.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=False)
+        try:
+            hashers = settings.PASSWORD_HASHERS
+            if not options['real_hasher']:
+                hashers = ['django.contrib.auth.hashers.MD5PasswordHasher']
+            with override_settings(PASSWORD_HASHERS=hashers):
+                self.run(options['checkouts'], options['concurrency'], options['plan'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            if scratch_dir:
+                os.rmdir(scratch_dir)
+
+    def checkout(self, plan, amount):
+        token = uuid.uuid4().hex
+        started = time.perf_counter()
+        try:
+            complete_checkout(f"bench-{token[:12]}@example.com", plan, amount, f"CUST_{token}", f"CARD_{token}")
+            error = None
+        except OperationalError as e:
+            error = str(e)
+        finally:
+            # What request_finished does: keep the connection unless CONN_MAX_AGE says otherwise
+            close_old_connections()
+        return error, time.perf_counter() - started
+
+    def worker(self, count, plan, amount):
+        try:
+            return [self.checkout(plan, amount) for _ in range(count)]
+        finally:
+            connection.close()
+
+    def run(self, checkouts, concurrency, plan):
+        amount = determine_amount_based_on_plan(plan)
+        shares = [checkouts // concurrency + (i < checkouts % concurrency) for i in range(concurrency)]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = [
+                result
+                for share in pool.map(lambda count: self.worker(count, plan, amount), shares)
+                for result in share
+            ]
+        elapsed = time.perf_counter() - started
+
+        latencies = sorted(latency for _, latency in results)
+        errors = [error for error, _ in results if error]
+        self.stdout.write(f"profile={settings.DATABASE_PROFILE} vendor={connection.vendor} concurrency={concurrency}")
+        self.stdout.write(f"{checkouts} checkouts in {elapsed:.2f}s -> {(checkouts - len(errors)) / elapsed:.1f} committed/s")
+        self.stdout.write(f"ok={checkouts - len(errors)} failed={len(errors)}"
+                          + (f" (first error: {errors[0]})" if errors else ""))
+        self.stdout.write(f"p50={latencies[len(latencies) // 2] * 1000:.1f} ms "
+                          f"p95={latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f} ms")
@@ -0,0 +1,109 @@
+import importlib
+import time
+
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+from datetime import timedelta
+
+from myApp.entitlements import has_access
+from myApp.models import AIUserAccess, BotService, BotSubscription
+
+backfill = importlib.import_module('myApp.migrations.0004_backfill_botsubscription')
+
+
+def table_size(model):
+    """
+    Row count and on-disk bytes (SQLite dbstat, when available) of a model's table.
+    """
+    table = model._meta.db_table
+    size = None
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            try:
+                cursor.execute("SELECT SUM(pgsize) FROM dbstat WHERE name = %s", [table])
+                size = cursor.fetchone()[0]
+            except Exception:
+                size = None
+    return model.objects.count(), size
+
+
+def coursemenu_lookups(user, check_access):
+    """
+    The per-request entitlement work coursemenu does for a user: the access check plus the saved/favorite tabs.
+    """
+    allowed = check_access(user)
+    list(AIUserAccess.objects.filter(user=user, is_saved=True))
+    list(AIUserAccess.objects.filter(user=user, is_favorite=True))
+    return allowed
+
+
+def fan_out_access(user):
+    # The old check: load every per-service row and evaluate has_expired() in Python
+    return any(not access.has_expired() for access in AIUserAccess.objects.filter(user=user))
+
+
+class Command(BaseCommand):
+    help = ("Compares the per-service AIUserAccess fan-out with BotSubscription on a throwaway test database: "
+            "table size and coursemenu entitlement latency before and after the backfill.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--services', type=int, default=40)
+        parser.add_argument('--samples', type=int, default=500)
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=False)
+        try:
+            self.run(options['users'], options['services'], options['samples'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def run(self, user_count, service_count, samples):
+        BotService.objects.bulk_create(BotService(title=f"Bot {i}", order=i) for i in range(service_count))
+        User.objects.bulk_create(User(username=f"bench-{i}@example.com") for i in range(user_count))
+        service_ids = list(BotService.objects.values_list('id', flat=True))
+        user_ids = list(User.objects.values_list('id', flat=True))
+        expiration_date = timezone.now() + timedelta(weeks=4)
+
+        AIUserAccess.objects.bulk_create(
+            (
+                AIUserAccess(user_id=user_id, bot_service_id=service_id, selected_plan='4-week',
+                             expiration_date=expiration_date, is_saved=(service_id == service_ids[0]))
+                for user_id in user_ids
+                for service_id in service_ids
+            ),
+            batch_size=5000,
+        )
+        sample_users = list(User.objects.order_by('?')[:samples])
+
+        before_rows = table_size(AIUserAccess)
+        before_latency = self.time_lookups(sample_users, fan_out_access)
+
+        started = time.perf_counter()
+        backfill.backfill_subscriptions(apps, None)
+        migration_time = time.perf_counter() - started
+
+        after_access_rows = table_size(AIUserAccess)
+        after_subscription_rows = table_size(BotSubscription)
+        after_latency = self.time_lookups(sample_users, has_access)
+
+        self.stdout.write(f"{user_count} users x {service_count} services, {len(sample_users)} sampled requests")
+        self.stdout.write(f"before: AIUserAccess {self.describe(before_rows)}")
+        self.stdout.write(f"after:  AIUserAccess {self.describe(after_access_rows)}, "
+                          f"BotSubscription {self.describe(after_subscription_rows)}")
+        self.stdout.write(f"backfill: {migration_time:.2f}s")
+        self.stdout.write(f"coursemenu entitlement lookups: before {before_latency * 1000:.2f} ms/request, "
+                          f"after {after_latency * 1000:.2f} ms/request")
+
+    def time_lookups(self, users, check_access):
+        started = time.perf_counter()
+        for user in users:
+            coursemenu_lookups(user, check_access)
+        return (time.perf_counter() - started) / max(len(users), 1)
+
+    def describe(self, size):
+        rows, size_bytes = size
+        return f"{rows} rows" + (f" / {size_bytes / 1024:.0f} KiB" if size_bytes else "")
@@ -0,0 +1,50 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+
+from myApp.dedupe import DELETE_BATCH_SIZE, dedupe_chunk
+from myApp.models import AIUserAccess
+
+
+class Command(BaseCommand):
+    help = ("Merges duplicate AIUserAccess rows per (user, bot_service) into one, walking users in user_id "
+            "ranges along the (user, bot_service) index, each range its own short transaction. Rows without a "
+            "bot_service are not covered by the unique constraint, so that is where duplicates pile up.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Users per transaction")
+        parser.add_argument('--batch-size', type=int, default=DELETE_BATCH_SIZE, help="Rows per DELETE")
+        parser.add_argument('--pause', type=float, default=0.05, help="Seconds to sleep between chunks")
+        parser.add_argument('--from-user', type=int, default=1, help="Resume from this user id")
+        parser.add_argument('--drop-orphans', action='store_true',
+                            help="Also delete rows with no bot_service and no progress, saved or favorite state")
+        parser.add_argument('--dry-run', action='store_true', help="Count what would change and roll it back")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        last_user_id = AIUserAccess.objects.aggregate(last_user_id=Max('user_id'))['last_user_id'] or 0
+
+        merged = deleted = 0
+        first_user_id = options['from_user']
+        while first_user_id <= last_user_id:
+            chunk_last_user_id = min(first_user_id + options['chunk_size'] - 1, last_user_id)
+            groups, rows = dedupe_chunk(
+                first_user_id,
+                chunk_last_user_id,
+                drop_orphans=options['drop_orphans'],
+                dry_run=options['dry_run'],
+                batch_size=options['batch_size'],
+            )
+            merged += groups
+            deleted += rows
+            elapsed = time.perf_counter() - started
+            self.stdout.write(
+                f"users up to {chunk_last_user_id}/{last_user_id}: merged {merged} groups, "
+                f"deleted {deleted} rows ({deleted / elapsed:.0f} rows/s)"
+            )
+            first_user_id = chunk_last_user_id + 1
+            time.sleep(options['pause'])
+        elapsed = time.perf_counter() - started
+        dry_run = " (dry run, rolled back)" if options['dry_run'] else ""
+        self.stdout.write(f"done: merged {merged} groups, deleted {deleted} rows in {elapsed:.2f}s{dry_run}")
@@ -0,0 +1,53 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from myApp.exports import EXPORTS, FORMATS, export_filename, stream_export
+
+
+class Command(BaseCommand):
+    help = "Streams BotBotTransaction or AIUserAccess rows to a CSV or NDJSON file, gzipped by default."
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=list(EXPORTS))
+        parser.add_argument('--format', choices=list(FORMATS), default='csv')
+        parser.add_argument('--no-gzip', action='store_true')
+        parser.add_argument('--start', help="First day (YYYY-MM-DD)")
+        parser.add_argument('--end', help="Last day (YYYY-MM-DD), inclusive")
+        parser.add_argument('--status')
+        parser.add_argument('--output', help="File to write, '-' for stdout; default named after the export")
+
+    def parse_day(self, value):
+        try:
+            day = parse_date(value) if value else None
+        except ValueError:
+            day = None
+        if value and day is None:
+            raise CommandError(f"Not a date: {value}")
+        return day
+
+    def handle(self, *args, **options):
+        start, end = self.parse_day(options['start']), self.parse_day(options['end'])
+        compress = not options['no_gzip']
+        try:
+            blocks = stream_export(
+                options['kind'], options['format'], compress, start=start, end=end, status=options['status']
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        output = options['output'] or export_filename(options['kind'], options['format'], compress, start, end)
+        started = time.perf_counter()
+        written = 0
+        out = sys.stdout.buffer if output == '-' else open(output, 'wb')
+        try:
+            for block in blocks:
+                out.write(block)
+                written += len(block)
+        finally:
+            if out is not sys.stdout.buffer:
+                out.close()
+        if output != '-':
+            self.stdout.write(f"wrote {written} bytes to {output} in {time.perf_counter() - started:.2f}s")
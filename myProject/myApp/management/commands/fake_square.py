@@ -0,0 +1,97 @@
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand
+
+
+class FakeSquareHandler(BaseHTTPRequestHandler):
+    """
+    Answers the handful of Square endpoints the checkout uses with canned, successful responses
+    after an artificial delay, so checkout throughput can be measured without the real API.
+    With an error rate, some calls are processed but answered 503, as if the response were lost.
+    """
+    protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+    disable_nagle_algorithm = True
+    latency = 0.0
+    error_rate = 0.0
+    idempotent_responses = {}
+    lock = threading.Lock()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        time.sleep(self.latency)
+
+        if self.path.startswith('/v2/customers'):
+            payload = self.replay(body.get('idempotency_key'), lambda: {"customer": {
+                "id": f"CUST_{uuid.uuid4().hex[:16]}",
+                "email_address": body.get('email_address'),
+            }})
+        elif self.path.startswith('/v2/payments'):
+            payload = self.replay(body.get('idempotency_key'), lambda: {"payment": {
+                "id": f"PAY_{uuid.uuid4().hex[:16]}",
+                "status": "COMPLETED",
+                "amount_money": body.get('amount_money'),
+                "customer_id": body.get('customer_id'),
+            }})
+        elif self.path.startswith('/v2/cards'):
+            payload = self.replay(body.get('idempotency_key'), lambda: {"card": {
+                "id": f"ccof:{uuid.uuid4().hex[:16]}",
+                "customer_id": (body.get('card') or {}).get('customer_id'),
+            }})
+        else:
+            return self.respond(404, {"errors": [{"category": "INVALID_REQUEST_ERROR", "code": "NOT_FOUND", "detail": self.path}]})
+
+        if random.random() < self.error_rate:
+            return self.respond(503, {"errors": [{"category": "API_ERROR", "code": "SERVICE_UNAVAILABLE"}]})
+        self.respond(200, payload)
+
+    def replay(self, idempotency_key, build):
+        # Square returns the original result when an idempotency key is reused
+        with self.lock:
+            if idempotency_key and idempotency_key in self.idempotent_responses:
+                return self.idempotent_responses[idempotency_key]
+            payload = build()
+            if idempotency_key:
+                self.idempotent_responses[idempotency_key] = payload
+            return payload
+
+    def respond(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Command(BaseCommand):
+    help = "Runs a local fake Square API. Point the app at it with SQUARE_ENVIRONMENT=custom SQUARE_CUSTOM_URL=http://host:port"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--latency', type=float, default=0.2, help="Seconds to wait before answering each call")
+        parser.add_argument('--error-rate', type=float, default=0.0,
+                            help="Fraction of calls answered 503 after being processed")
+
+    def handle(self, *args, **options):
+        FakeSquareHandler.latency = options['latency']
+        FakeSquareHandler.error_rate = options['error_rate']
+        server = ThreadingHTTPServer((options['host'], options['port']), FakeSquareHandler)
+        server.daemon_threads = True
+        self.stdout.write(f"Fake Square listening on http://{options['host']}:{options['port']} "
+                          f"({options['latency'] * 1000:.0f} ms per call, {options['error_rate']:.0%} errors)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
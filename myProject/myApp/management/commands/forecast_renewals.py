@@ -0,0 +1,40 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from myApp.forecast import DEFAULT_HORIZON_DAYS, DEFAULT_LOOKBACK_DAYS, cached_forecast
+
+
+class Command(BaseCommand):
+    help = ("Forecasts renewals and renewal revenue per day, scheduled and churn-adjusted, and stores the result "
+            "where the renewal-forecast page reads it (useful with a shared CACHE_URL).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=DEFAULT_HORIZON_DAYS)
+        parser.add_argument('--lookback-days', type=int, default=DEFAULT_LOOKBACK_DAYS,
+                            help="Recurring charges this far back set each plan's renewal rate")
+        parser.add_argument('--json', action='store_true', help="Print the whole forecast as JSON")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        forecast = cached_forecast(options['days'], options['lookback_days'], refresh=True)
+        elapsed = time.perf_counter() - started
+        if options['json']:
+            self.stdout.write(json.dumps(forecast, indent=2))
+            return
+
+        rates = ', '.join(f"{plan} {rate:.1%}" for plan, rate in forecast['renewal_rates'].items())
+        self.stdout.write(f"renewal rates: {rates}")
+        self.stdout.write(f"{'date':<12}{'scheduled':>12}{'expected':>12}{'scheduled $':>16}{'expected $':>16}")
+        for day in forecast['days']:
+            self.stdout.write(
+                f"{day['date']:<12}{day['scheduled_renewals']:>12}{day['expected_renewals']:>12.2f}"
+                f"{day['scheduled_revenue']:>16,.2f}{day['expected_revenue']:>16,.2f}"
+            )
+        totals = forecast['totals']
+        self.stdout.write(
+            f"{'total':<12}{totals['scheduled_renewals']:>12}{totals['expected_renewals']:>12.2f}"
+            f"{totals['scheduled_revenue']:>16,.2f}{totals['expected_revenue']:>16,.2f}"
+        )
+        self.stdout.write(f"computed in {elapsed:.2f}s")
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from myApp.checkout_queue import process_checkout_batch
+
+
+class Command(BaseCommand):
+    help = "Runs checkouts queued by process_payment with CHECKOUT_MODE=queued."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=20)
+        parser.add_argument('--concurrency', type=int, default=8, help="Checkouts run at once")
+        parser.add_argument('--loop', action='store_true', help="Keep polling instead of exiting when the queue is empty")
+        parser.add_argument('--interval', type=float, default=0.5, help="Seconds to sleep between polls with --loop")
+
+    def handle(self, *args, **options):
+        totals = {'succeeded': 0, 'failed': 0, 'queued': 0}
+        while True:
+            counts = process_checkout_batch(options['batch_size'], options['concurrency'])
+            for status, count in counts.items():
+                totals[status] += count
+            if any(counts.values()):
+                self.stdout.write(
+                    f"batch: succeeded={counts['succeeded']} failed={counts['failed']} retrying={counts['queued']}"
+                )
+            elif not options['loop']:
+                break
+            else:
+                time.sleep(options['interval'])
+        self.stdout.write(
+            f"done: succeeded={totals['succeeded']} failed={totals['failed']} retrying={totals['queued']}"
+        )
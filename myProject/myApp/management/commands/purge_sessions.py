@@ -0,0 +1,31 @@
+import time
+
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    help = ("Deletes expired rows from django_session in small chunks, each its own short transaction, "
+            "so the table is never locked for long. Unlike `clearsessions`, which removes them in one DELETE.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--pause', type=float, default=0.05, help="Seconds to sleep between chunks")
+        parser.add_argument('--all', action='store_true',
+                            help="Delete every session, e.g. after switching SESSION_STRATEGY to signed_cookies")
+
+    def handle(self, *args, **options):
+        sessions = Session.objects.all() if options['all'] else Session.objects.filter(expire_date__lt=timezone.now())
+        started = time.perf_counter()
+        deleted = 0
+        while True:
+            # Read the chunk through the expire_date index, then delete it by primary key
+            keys = list(sessions.order_by('expire_date').values_list('session_key', flat=True)[:options['chunk_size']])
+            if not keys:
+                break
+            deleted += Session.objects.filter(session_key__in=keys).delete()[0]
+            self.stdout.write(f"deleted {deleted} sessions")
+            time.sleep(options['pause'])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f"done: deleted {deleted} sessions in {elapsed:.2f}s")
@@ -0,0 +1,30 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from myApp.webhooks import reconcile_batch
+
+
+class Command(BaseCommand):
+    help = "Applies received Square webhook events to transactions and access, a batch per transaction."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--loop', action='store_true', help="Keep polling instead of exiting when caught up")
+        parser.add_argument('--interval', type=float, default=1.0, help="Seconds to sleep between polls with --loop")
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        processed = changed = 0
+        while True:
+            events, transactions = reconcile_batch(options['batch_size'])
+            processed += events
+            changed += transactions
+            if events:
+                self.stdout.write(f"batch: events={events} transactions_changed={transactions}")
+            elif not options['loop']:
+                break
+            else:
+                time.sleep(options['interval'])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(f"done: events={processed} transactions_changed={changed} in {elapsed:.2f}s")
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from myApp.billing import run_renewals
+
+
+class Command(BaseCommand):
+    help = "Charges the card on file for every subscription whose next_billing_date has passed."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=16, help="Square charges in flight at once")
+        parser.add_argument('--loop', action='store_true', help="Keep running, sweeping every --interval seconds")
+        parser.add_argument('--interval', type=float, default=60.0)
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.perf_counter()
+            counts = run_renewals(batch_size=options['batch_size'], concurrency=options['concurrency'])
+            elapsed = time.perf_counter() - started
+            processed = sum(counts.values())
+            if processed or not options['loop']:
+                rate = processed / elapsed * 3600 if elapsed else 0
+                self.stdout.write(
+                    f"renewed={counts['success']} declined={counts['declined']} retry={counts['error']} "
+                    f"in {elapsed:.1f}s ({rate:.0f}/hour)"
+                )
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
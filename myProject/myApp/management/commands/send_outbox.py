@@ -0,0 +1,35 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from myApp.outbox import deliver_outbox_batch, purge_outbox
+
+
+class Command(BaseCommand):
+    help = ("Delivers queued EmailOutbox messages in batches, one SMTP connection per batch, and deletes sent and "
+            "failed messages older than the retention period whenever it runs out of work.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--loop', action='store_true', help="Keep polling instead of exiting when the outbox is empty")
+        parser.add_argument('--interval', type=float, default=5.0, help="Seconds to sleep between polls with --loop")
+        parser.add_argument('--retention-days', type=int, default=settings.EMAIL_OUTBOX_RETENTION_DAYS,
+                            help="Keep sent and failed messages this many days after their last attempt")
+
+    def handle(self, *args, **options):
+        retention = timedelta(days=options['retention_days'])
+        total_sent = total_failed = total_purged = 0
+        while True:
+            sent, failed = deliver_outbox_batch(options['batch_size'])
+            total_sent += sent
+            total_failed += failed
+            if sent or failed:
+                self.stdout.write(f"batch: sent={sent} failed={failed}")
+                continue
+            total_purged += purge_outbox(retention)
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+        self.stdout.write(f"done: sent={total_sent} failed={total_failed} purged={total_purged}")
@@ -0,0 +1,80 @@
+import socketserver
+from email import message_from_bytes
+from email.header import decode_header, make_header
+
+from django.core.management.base import BaseCommand
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough SMTP to accept and discard mail from Django's SMTP backend: EHLO, AUTH, MAIL, RCPT, DATA.
+    Every message is acknowledged and its recipients and subject are printed.
+    """
+    stdout = None
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        self.reply("220 smtp-sink ready")
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode(errors='replace').strip()
+            verb = command.split(' ', 1)[0].upper()
+
+            if verb == 'EHLO':
+                self.reply("250-smtp-sink")
+                self.reply("250 AUTH PLAIN LOGIN")
+            elif verb == 'HELO':
+                self.reply("250 smtp-sink")
+            elif verb == 'AUTH':
+                self.reply("235 Authentication successful")
+            elif verb == 'MAIL':
+                recipients = []
+                self.reply("250 OK")
+            elif verb == 'RCPT':
+                recipients.append(command.split(':', 1)[-1].strip(' <>'))
+                self.reply("250 OK")
+            elif verb == 'DATA':
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                while True:
+                    chunk = self.rfile.readline()
+                    if not chunk or chunk in (b".\r\n", b".\n"):
+                        break
+                    data.append(chunk[1:] if chunk.startswith(b"..") else chunk)
+                message = message_from_bytes(b"".join(data))
+                subject = str(make_header(decode_header(message['Subject'] or '')))
+                self.stdout.write(f"{', '.join(recipients)}: {subject}")
+                self.reply("250 OK: queued")
+            elif verb == 'QUIT':
+                self.reply("221 Bye")
+                return
+            else:
+                # RSET, NOOP and anything else
+                self.reply("250 OK")
+
+
+class Command(BaseCommand):
+    help = ("Runs a local SMTP server that accepts and discards mail. Point the outbox worker at it with "
+            "EMAIL_HOST=127.0.0.1 EMAIL_PORT=1025 EMAIL_USE_TLS=False")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=1025)
+
+    def handle(self, *args, **options):
+        SMTPSinkHandler.stdout = self.stdout
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        server = socketserver.ThreadingTCPServer((options['host'], options['port']), SMTPSinkHandler)
+        server.daemon_threads = True
+        self.stdout.write(f"SMTP sink listening on {options['host']}:{options['port']}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
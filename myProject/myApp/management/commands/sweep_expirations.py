@@ -0,0 +1,29 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from myApp.sweeper import sweep_expired, sweep_expiring
+
+
+class Command(BaseCommand):
+    help = ("Deactivates expired subscriptions and queues reminders for those about to expire, in chunks. "
+            "Auto-renewing subscriptions are left to `manage.py run_renewals`.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--reminder-days', type=int, default=3, help="Remind subscribers this many days before expiry")
+        parser.add_argument('--loop', action='store_true', help="Keep sweeping instead of exiting after one pass")
+        parser.add_argument('--interval', type=float, default=60.0, help="Seconds to sleep between sweeps with --loop")
+
+    def handle(self, *args, **options):
+        within = timedelta(days=options['reminder_days'])
+        while True:
+            started = time.perf_counter()
+            expired = sweep_expired(chunk_size=options['chunk_size'])
+            reminded = sweep_expiring(within=within, chunk_size=options['chunk_size'])
+            elapsed = time.perf_counter() - started
+            self.stdout.write(f"sweep: expired={expired} reminded={reminded} in {elapsed:.2f}s")
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
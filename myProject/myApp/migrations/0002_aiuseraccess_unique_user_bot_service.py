@@ -0,0 +1,47 @@
+# Generated by Django 5.1.2 on 2026-10-18 09:08
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def merge_duplicate_access(apps, schema_editor):
+    """
+    Folds repeated (user, bot_service) grants into one row before the unique constraint is added,
+    keeping the highest progress, any saved/favorite flag and the latest expiration.
+    """
+    AIUserAccess = apps.get_model('myApp', 'AIUserAccess')
+    duplicates = (
+        AIUserAccess.objects.filter(bot_service__isnull=False)
+        .values('user_id', 'bot_service_id')
+        .annotate(rows=Count('id'))
+        .filter(rows__gt=1)
+    )
+    for group in duplicates:
+        rows = list(
+            AIUserAccess.objects.filter(user_id=group['user_id'], bot_service_id=group['bot_service_id']).order_by('-id')
+        )
+        keep = rows[0]
+        expirations = [row.expiration_date for row in rows]
+        keep.progress = max(row.progress for row in rows)
+        keep.is_saved = any(row.is_saved for row in rows)
+        keep.is_favorite = any(row.is_favorite for row in rows)
+        keep.expiration_date = None if None in expirations else max(expirations)
+        keep.save()
+        AIUserAccess.objects.filter(id__in=[row.id for row in rows[1:]]).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myApp', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_access, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='aiuseraccess',
+            constraint=models.UniqueConstraint(fields=('user', 'bot_service'), name='unique_user_bot_service'),
+        ),
+    ]
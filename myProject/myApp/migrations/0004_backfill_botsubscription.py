@@ -0,0 +1,71 @@
+from django.db import migrations
+
+CHUNK_SIZE = 1000
+
+
+def backfill_subscriptions(apps, schema_editor):
+    """
+    Collapses the per-service AIUserAccess fan-out into one BotSubscription per user, a chunk of users at a time.
+
+    A user keeps unlimited access if any of their rows never expired (the old has_expired() semantics),
+    otherwise the latest expiration wins. Rows left with no progress/saved/favorite state are deleted,
+    so AIUserAccess only holds sparse per-service state afterwards.
+    """
+    AIUserAccess = apps.get_model('myApp', 'AIUserAccess')
+    BotSubscription = apps.get_model('myApp', 'BotSubscription')
+
+    last_user_id = 0
+    while True:
+        user_ids = list(
+            AIUserAccess.objects.filter(user_id__gt=last_user_id)
+            .order_by('user_id')
+            .values_list('user_id', flat=True)
+            .distinct()[:CHUNK_SIZE]
+        )
+        if not user_ids:
+            break
+        last_user_id = user_ids[-1]
+
+        plans = {}
+        rows = (
+            AIUserAccess.objects.filter(user_id__in=user_ids)
+            .order_by('user_id', 'id')
+            .values_list('user_id', 'selected_plan', 'expiration_date')
+        )
+        for user_id, selected_plan, expiration_date in rows:
+            plan, expiry, lifetime = plans.get(user_id, (None, None, False))
+            plan = selected_plan or plan
+            lifetime = lifetime or expiration_date is None
+            expiry = expiration_date if expiry is None or (expiration_date and expiration_date > expiry) else expiry
+            plans[user_id] = (plan, expiry, lifetime)
+
+        BotSubscription.objects.bulk_create(
+            [
+                BotSubscription(user_id=user_id, selected_plan=plan, expiration_date=None if lifetime else expiry)
+                for user_id, (plan, expiry, lifetime) in plans.items()
+            ],
+            update_conflicts=True,
+            unique_fields=['user'],
+            update_fields=['selected_plan', 'expiration_date'],
+        )
+
+        stateless_ids = list(
+            AIUserAccess.objects.filter(user_id__in=user_ids, progress=0.0)
+            .exclude(is_saved=True)
+            .exclude(is_favorite=True)
+            .values_list('id', flat=True)
+        )
+        AIUserAccess.objects.filter(id__in=stateless_ids).delete()
+
+
+class Migration(migrations.Migration):
+    # Each chunk commits on its own so the backfill never holds one long write lock
+    atomic = False
+
+    dependencies = [
+        ('myApp', '0003_botsubscription'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_subscriptions, migrations.RunPython.noop),
+    ]
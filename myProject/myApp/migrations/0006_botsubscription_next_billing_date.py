@@ -0,0 +1,35 @@
+# Generated by Django 5.1.2 on 2026-10-18 09:16
+
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_next_billing_date(apps, schema_editor):
+    """
+    Copies each subscriber's next billing date from their latest successful recurring transaction,
+    in one set-based UPDATE.
+    """
+    BotSubscription = apps.get_model('myApp', 'BotSubscription')
+    BotBotTransaction = apps.get_model('myApp', 'BotBotTransaction')
+    latest = (
+        BotBotTransaction.objects.filter(user_id=OuterRef('user_id'), status='success', recurring=True)
+        .order_by('-BotTransaction_date', '-id')
+        .values('next_billing_date')[:1]
+    )
+    BotSubscription.objects.update(next_billing_date=Subquery(latest))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myApp', '0005_emailoutbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='botsubscription',
+            name='next_billing_date',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.RunPython(backfill_next_billing_date, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.2 on 2026-10-18 09:17
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myApp', '0006_botsubscription_next_billing_date'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='botsubscription',
+            name='expiry_reminder_sent_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='botsubscription',
+            name='is_active',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddIndex(
+            model_name='botsubscription',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['expiration_date'], name='sub_active_expiry_idx'),
+        ),
+    ]
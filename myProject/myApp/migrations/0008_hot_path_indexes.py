@@ -0,0 +1,47 @@
+# Generated by Django 5.1.2 on 2026-10-18 09:19
+
+from django.conf import settings
+from django.db import migrations, models
+
+# auth.User is not ours to add Meta.indexes to, so its email index is created through the schema editor
+USER_EMAIL_INDEX = models.Index(fields=['email'], name='auth_user_email_idx')
+
+
+def add_user_email_index(apps, schema_editor):
+    schema_editor.add_index(apps.get_model(settings.AUTH_USER_MODEL), USER_EMAIL_INDEX)
+
+
+def remove_user_email_index(apps, schema_editor):
+    schema_editor.remove_index(apps.get_model(settings.AUTH_USER_MODEL), USER_EMAIL_INDEX)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myApp', '0007_botsubscription_sweeper_state'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='aiuseraccess',
+            index=models.Index(condition=models.Q(('is_saved', True)), fields=['user'], name='access_user_saved_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='aiuseraccess',
+            index=models.Index(condition=models.Q(('is_favorite', True)), fields=['user'], name='access_user_favorite_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='aiuseraccess',
+            index=models.Index(condition=models.Q(('expiration_date__isnull', False)), fields=['expiration_date'], name='access_expiry_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='botbottransaction',
+            index=models.Index(fields=['user', 'status', 'BotTransaction_date'], name='txn_user_status_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='botservice',
+            index=models.Index(condition=models.Q(('is_active', True)), fields=['order', 'id'], name='service_active_order_idx'),
+        ),
+        migrations.RunPython(add_user_email_index, remove_user_email_index),
+    ]
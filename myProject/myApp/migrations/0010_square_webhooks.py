@@ -0,0 +1,41 @@
+# Generated by Django 5.1.2 on 2026-10-18 09:33
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myApp', '0009_checkoutjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='botbottransaction',
+            name='square_payment_id',
+            field=models.CharField(blank=True, max_length=255, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='botbottransaction',
+            name='status',
+            field=models.CharField(choices=[('success', 'Success'), ('pending', 'Pending'), ('error', 'Error'), ('refunded', 'Refunded'), ('disputed', 'Disputed')], db_index=True, default='pending', max_length=10),
+        ),
+        migrations.CreateModel(
+            name='SquareWebhookEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=255, unique=True)),
+                ('event_type', models.CharField(max_length=100)),
+                ('payment_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('transaction_status', models.CharField(blank=True, max_length=10, null=True)),
+                ('occurred_at', models.DateTimeField()),
+                ('payload', models.JSONField()),
+                ('received_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('processed_at__isnull', True)), fields=['id'], name='webhook_unprocessed_idx'), models.Index(condition=models.Q(('transaction_status__isnull', False)), fields=['payment_id', '-occurred_at'], name='webhook_payment_latest_idx')],
+            },
+        ),
+    ]
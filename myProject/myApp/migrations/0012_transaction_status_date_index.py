@@ -0,0 +1,24 @@
+# Generated by Django 5.1.2 on 2026-10-18 09:43
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myApp', '0011_daily_revenue'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='botbottransaction',
+            name='status',
+            field=models.CharField(choices=[('success', 'Success'), ('pending', 'Pending'), ('error', 'Error'), ('refunded', 'Refunded'), ('disputed', 'Disputed')], default='pending', max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='botbottransaction',
+            index=models.Index(fields=['status', 'BotTransaction_date'], name='txn_status_date_idx'),
+        ),
+    ]
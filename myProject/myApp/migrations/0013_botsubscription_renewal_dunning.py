@@ -0,0 +1,23 @@
+# Generated by Django 5.1.2 on 2026-10-18 10:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myApp', '0012_transaction_status_date_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='botsubscription',
+            name='declined_renewals',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='botsubscription',
+            name='renewal_lease_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.2 on 2026-10-18 10:10
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myApp', '0013_botsubscription_renewal_dunning'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='botsubscription',
+            name='next_billing_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='botsubscription',
+            index=models.Index(condition=models.Q(('next_billing_date__isnull', False)), fields=['next_billing_date'], name='sub_next_billing_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='botsubscription',
+            index=models.Index(condition=models.Q(('is_active', True), ('next_billing_date__isnull', True)), fields=['expiration_date'], name='sub_reminder_expiry_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.1.2 on 2026-10-18 10:23
+
+from django.db import migrations, models
+from django.db.models import Exists, OuterRef, Q
+
+
+def mark_renewals(apps, schema_editor):
+    """
+    Flags the recurring charges already on record that `run_renewals` made. Only renewals record a declined
+    recurring charge, and a charged one is a renewal if the user had an earlier recurring charge go through.
+    A second checkout on a recurring plan is indistinguishable here and counts as a renewal too.
+    """
+    BotBotTransaction = apps.get_model('myApp', 'BotBotTransaction')
+    earlier_charge = BotBotTransaction.objects.filter(
+        user_id=OuterRef('user_id'), recurring=True, id__lt=OuterRef('id')
+    ).exclude(status='error')
+    (
+        BotBotTransaction.objects.filter(recurring=True)
+        .filter(Q(status='error') | Q(Exists(earlier_charge)))
+        .update(is_renewal=True)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myApp', '0014_botsubscription_partial_billing_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='botbottransaction',
+            name='is_renewal',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mark_renewals, migrations.RunPython.noop),
+    ]
@@ -1,3 +1,5 @@
+import uuid
+
 from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
@@ -16,22 +18,43 @@ class BotService(models.Model):
 
     class Meta:
         ordering = ['order']
+        indexes = [
+            # The catalog and its keyset pagination walk active services in (order, id) order
+            models.Index(fields=['order', 'id'], condition=models.Q(is_active=True), name='service_active_order_idx'),
+        ]
 
-# Renamed AIUserAccess to AIUserAccess for AI bot access tracking
+# Renamed AIUserAccess to AIUserAccess for AI bot access tracking.
+# Access itself now lives on BotSubscription; rows here only carry per-service progress/saved/favorite state.
 class AIUserAccess(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     bot_service = models.ForeignKey(BotService, on_delete=models.CASCADE, null=True, blank=True)
     progress = models.FloatField(default=0.0)
-    expiration_date = models.DateTimeField(null=True, blank=True)
+    expiration_date = models.DateTimeField(null=True, blank=True)  # Legacy, superseded by BotSubscription
     renewal_date = models.DateTimeField(null=True, blank=True)
     renewal_task_id = models.CharField(max_length=255, null=True, blank=True)
-    selected_plan = models.CharField(max_length=20, null=True, blank=True)
+    selected_plan = models.CharField(max_length=20, null=True, blank=True)  # Legacy, superseded by BotSubscription
     is_saved = models.BooleanField(default=False, null=True, blank=True)
     is_favorite = models.BooleanField(default=False, null=True, blank=True)
 
     def __str__(self):
         return f"{self.user.username} - {self.bot_service.title if self.bot_service else 'No Service'}"
 
+    class Meta:
+        constraints = [
+            # One access row per user and service, so grants can be upserted
+            models.UniqueConstraint(fields=['user', 'bot_service'], name='unique_user_bot_service'),
+        ]
+        indexes = [
+            # Saved and favorite rows are a small slice of each user's rows; index only that slice
+            models.Index(fields=['user'], condition=models.Q(is_saved=True), name='access_user_saved_idx'),
+            models.Index(fields=['user'], condition=models.Q(is_favorite=True), name='access_user_favorite_idx'),
+            models.Index(
+                fields=['expiration_date'],
+                condition=models.Q(expiration_date__isnull=False),
+                name='access_expiry_idx',
+            ),
+        ]
+
     def has_expired(self):
         return self.expiration_date is not None and timezone.now() > self.expiration_date
 
@@ -40,26 +63,74 @@ class AIUserAccess(models.Model):
             self.renewal_date = timezone.now() + timedelta(weeks=plan_duration)
             self.save()
 
+# One row per user holding the plan and expiry; access to every active BotService is answered from it
+class BotSubscription(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='bot_subscription')
+    selected_plan = models.CharField(max_length=20, null=True, blank=True)
+    expiration_date = models.DateTimeField(null=True, blank=True)  # None means lifetime access
+    next_billing_date = models.DateTimeField(null=True, blank=True)  # None means not recurring
+    is_active = models.BooleanField(default=True)  # Flipped off by `manage.py sweep_expirations`
+    expiry_reminder_sent_at = models.DateTimeField(null=True, blank=True)
+    declined_renewals = models.PositiveIntegerField(default=0)  # In a row; billing stops after MAX_DECLINED_RENEWALS
+    renewal_lease_until = models.DateTimeField(null=True, blank=True)  # Set while a `run_renewals` worker holds it
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.user.username} - {self.selected_plan or 'No Plan'}"
+
+    class Meta:
+        indexes = [
+            # Only live subscriptions are indexed, so sweeps stay cheap however many lapsed rows pile up
+            models.Index(fields=['expiration_date'], condition=models.Q(is_active=True), name='sub_active_expiry_idx'),
+            # Renewals and the forecast only look at subscriptions that bill again
+            models.Index(
+                fields=['next_billing_date'],
+                condition=models.Q(next_billing_date__isnull=False),
+                name='sub_next_billing_idx',
+            ),
+            # The expiry sweep and reminders only look at live subscriptions that won't renew on their own
+            models.Index(
+                fields=['expiration_date'],
+                condition=models.Q(is_active=True, next_billing_date__isnull=True),
+                name='sub_reminder_expiry_idx',
+            ),
+        ]
+
+    def has_expired(self):
+        return self.expiration_date is not None and timezone.now() > self.expiration_date
+
 # Renamed BotTransaction to BotBotTransaction to specify bot-related BotTransactions
 class BotBotTransaction(models.Model):
     STATUS_CHOICES = [
         ('success', 'Success'),
         ('pending', 'Pending'),
         ('error', 'Error'),
+        ('refunded', 'Refunded'),  # Set from Square webhooks, see myApp.webhooks
+        ('disputed', 'Disputed'),
     ]
 
     user = models.ForeignKey(User, on_delete=models.CASCADE, db_index=True)
-    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending', db_index=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
     BotTransaction_date = models.DateTimeField(default=timezone.now, db_index=True)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     subscription_type = models.CharField(max_length=100)
     error_logs = models.TextField(blank=True, null=True)
     recurring = models.BooleanField(default=False)
+    is_renewal = models.BooleanField(default=False)  # Charged by `manage.py run_renewals` rather than at checkout
     next_billing_date = models.DateTimeField(blank=True, null=True)
+    square_payment_id = models.CharField(max_length=255, unique=True, null=True, blank=True)
 
     def __str__(self):
         return f"{self.user.username} - {self.subscription_type} - {self.status}"
 
+    class Meta:
+        indexes = [
+            # A user's transactions by outcome, newest first (latest successful charge, failed attempts)
+            models.Index(fields=['user', 'status', 'BotTransaction_date'], name='txn_user_status_date_idx'),
+            # Exports and reports by outcome over a date range (also serves status on its own)
+            models.Index(fields=['status', 'BotTransaction_date'], name='txn_status_date_idx'),
+        ]
+
 # Example for payment storage, renamed to BotUserPaymentInfo
 class BotUserPaymentInfo(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
@@ -68,3 +139,109 @@ class BotUserPaymentInfo(models.Model):
 
     def __str__(self):
         return f"{self.user.username} - {self.customer_id}"
+
+
+# Outgoing email, written in the same transaction as the change that caused it and delivered by `manage.py send_outbox`
+class EmailOutbox(models.Model):
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('sending', 'Sending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    ]
+
+    to_email = models.TextField()  # Comma-separated recipients
+    from_email = models.CharField(max_length=255)
+    subject = models.CharField(max_length=255)
+    text_body = models.TextField()
+    html_body = models.TextField(blank=True, null=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    sent_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"{self.to_email} - {self.subject} - {self.status}"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='outbox_due_idx'),
+        ]
+
+
+# A checkout accepted with CHECKOUT_MODE=queued, run by `manage.py process_checkouts` and polled through checkout_status
+class CheckoutJob(models.Model):
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('processing', 'Processing'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    email = models.EmailField()
+    plan = models.CharField(max_length=20)
+    payload = models.JSONField(default=dict)  # The process_payment request body; cleared once the job finishes
+    status = models.CharField(max_length=12, choices=STATUS_CHOICES, default='queued')
+    step = models.CharField(max_length=20, blank=True)  # customer, payment, card or saving while processing
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    response_status = models.PositiveIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True)  # What the inline checkout would have answered
+    created_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.email} - {self.plan} - {self.status}"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='checkout_due_idx'),
+        ]
+
+
+# A Square webhook notification as received; `manage.py reconcile_webhooks` applies them to BotBotTransaction
+class SquareWebhookEvent(models.Model):
+    event_id = models.CharField(max_length=255, unique=True)  # Square redelivers with the same id
+    event_type = models.CharField(max_length=100)
+    payment_id = models.CharField(max_length=255, null=True, blank=True)
+    # The BotBotTransaction status this event implies, or None when it doesn't change one
+    transaction_status = models.CharField(max_length=10, null=True, blank=True)
+    occurred_at = models.DateTimeField()
+    payload = models.JSONField()
+    received_at = models.DateTimeField(default=timezone.now)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.event_type} - {self.event_id}"
+
+    class Meta:
+        indexes = [
+            # The reconciliation queue
+            models.Index(fields=['id'], condition=models.Q(processed_at__isnull=True), name='webhook_unprocessed_idx'),
+            # A payment's latest status-changing event
+            models.Index(
+                fields=['payment_id', '-occurred_at'],
+                condition=models.Q(transaction_status__isnull=False),
+                name='webhook_payment_latest_idx',
+            ),
+        ]
+
+
+# Transaction count and amount per day, plan and status, kept up to date as transactions are written (myApp.revenue)
+class DailyRevenue(models.Model):
+    day = models.DateField()
+    subscription_type = models.CharField(max_length=100)
+    status = models.CharField(max_length=10)
+    transaction_count = models.IntegerField(default=0)
+    amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    def __str__(self):
+        return f"{self.day} - {self.subscription_type} - {self.status}: {self.amount}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'subscription_type', 'status'], name='daily_revenue_key'),
+        ]
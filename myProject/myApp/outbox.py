@@ -0,0 +1,130 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import transaction
+from django.utils import timezone
+
+from .models import EmailOutbox
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 8
+# How long a claimed batch is reserved before another worker may pick it up again
+SEND_LEASE = timedelta(minutes=10)
+
+
+class OutboxEmailBackend(BaseEmailBackend):
+    """
+    Email backend that writes messages to the EmailOutbox table instead of talking to SMTP.
+
+    Rows are inserted on the current database connection, so inside transaction.atomic() the email only
+    exists if the surrounding change commits. Only the to/subject/text/HTML parts are kept; the app sends
+    no attachments, cc or bcc.
+    """
+
+    def send_messages(self, email_messages):
+        rows = []
+        for message in email_messages:
+            html_body = next(
+                (content for content, mimetype in getattr(message, 'alternatives', []) if mimetype == 'text/html'),
+                None,
+            )
+            rows.append(EmailOutbox(
+                to_email=','.join(message.recipients()),
+                from_email=message.from_email or settings.DEFAULT_FROM_EMAIL,
+                subject=message.subject,
+                text_body=message.body,
+                html_body=html_body,
+            ))
+        EmailOutbox.objects.bulk_create(rows)
+        return len(rows)
+
+
+def retry_delay(attempts):
+    # 1, 2, 4, 8 ... minutes, capped at an hour
+    return timedelta(minutes=min(2 ** (attempts - 1), 60))
+
+
+def claim_batch(batch_size):
+    """
+    Reserves up to batch_size due messages for this worker and returns them.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(
+            EmailOutbox.objects.select_for_update(skip_locked=True)
+            .filter(status__in=['pending', 'sending'], next_attempt_at__lte=now)
+            .order_by('next_attempt_at')
+            .values_list('id', flat=True)[:batch_size]
+        )
+        EmailOutbox.objects.filter(id__in=ids).update(status='sending', next_attempt_at=now + SEND_LEASE)
+    return list(EmailOutbox.objects.filter(id__in=ids).order_by('id'))
+
+
+def deliver_outbox_batch(batch_size=100):
+    """
+    Sends one batch of due outbox messages over a single SMTP connection and records the outcome of each.
+    Failed sends are retried with exponential backoff and marked failed after MAX_ATTEMPTS.
+    Returns (sent, failed) counts.
+    """
+    rows = claim_batch(batch_size)
+    if not rows:
+        return 0, 0
+
+    connection = get_connection(settings.EMAIL_DELIVERY_BACKEND, fail_silently=False)
+    sent = failed = 0
+    try:
+        for row in rows:
+            message = EmailMultiAlternatives(
+                row.subject, row.text_body, row.from_email, row.to_email.split(','), connection=connection
+            )
+            if row.html_body:
+                message.attach_alternative(row.html_body, "text/html")
+            try:
+                # No-op while the connection is up, so the whole batch shares one SMTP session
+                connection.open()
+                message.send()
+            except Exception as e:
+                logger.warning("Outbox delivery of %s failed: %s", row.id, e)
+                # Start the next message on a fresh connection in case this one is broken
+                connection.close()
+                row.attempts += 1
+                row.last_error = str(e)
+                row.status = 'failed' if row.attempts >= MAX_ATTEMPTS else 'pending'
+                row.next_attempt_at = timezone.now() + retry_delay(row.attempts)
+                failed += 1
+            else:
+                row.attempts += 1
+                row.status = 'sent'
+                row.sent_at = timezone.now()
+                row.last_error = None
+                # Bodies can hold temporary passwords and reset links; keep only the envelope once delivered
+                row.text_body = ''
+                row.html_body = None
+                sent += 1
+    finally:
+        connection.close()
+
+    EmailOutbox.objects.bulk_update(
+        rows, ['status', 'attempts', 'last_error', 'next_attempt_at', 'sent_at', 'text_body', 'html_body']
+    )
+    return sent, failed
+
+
+def purge_outbox(retention=None, chunk_size=1000):
+    """
+    Deletes sent and failed messages whose last attempt is older than `retention` (EMAIL_OUTBOX_RETENTION_DAYS
+    by default), a chunk at a time through the (status, next_attempt_at) index. Returns the number deleted.
+    """
+    if retention is None:
+        retention = timedelta(days=settings.EMAIL_OUTBOX_RETENTION_DAYS)
+    expired = EmailOutbox.objects.filter(status__in=['sent', 'failed'], next_attempt_at__lt=timezone.now() - retention)
+    deleted = 0
+    while True:
+        ids = list(expired.order_by().values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            return deleted
+        deleted += EmailOutbox.objects.filter(id__in=ids).delete()[0]
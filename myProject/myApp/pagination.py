@@ -0,0 +1,115 @@
+import base64
+import json
+from bisect import bisect_left, bisect_right
+
+from django.core.paginator import Paginator
+from django.db import connection
+from django.utils.functional import cached_property
+
+
+class KeysetPage:
+    """
+    One page of services paginated on (order, id). Cursors are opaque strings for the ?cursor= parameter.
+    """
+
+    def __init__(self, items, has_next, has_previous, estimated_total=None):
+        self.object_list = items
+        self.has_next = has_next
+        self.has_previous = has_previous
+        self.estimated_total = estimated_total
+        self.next_cursor = encode_cursor('>', items[-1]) if items and has_next else None
+        self.prev_cursor = encode_cursor('<', items[0]) if items and has_previous else None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+def encode_cursor(direction, service):
+    payload = json.dumps([direction, service.order, service.pk]).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    Returns (direction, (order, id)), or None for a missing or tampered cursor (treated as the first page).
+    """
+    if not cursor:
+        return None
+    try:
+        direction, order, pk = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if direction not in ('>', '<'):
+            return None
+        return direction, (int(order), int(pk))
+    except (ValueError, TypeError):
+        return None
+
+
+def estimated_count(model):
+    """
+    Cheap row-count estimate from planner statistics (PostgreSQL reltuples, SQLite sqlite_stat1 after ANALYZE).
+    Returns None when no statistics are available.
+    """
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        try:
+            if connection.vendor == 'postgresql':
+                cursor.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = %s", [table])
+            elif connection.vendor == 'sqlite':
+                cursor.execute("SELECT CAST(stat AS INTEGER) FROM sqlite_stat1 WHERE tbl = %s LIMIT 1", [table])
+            else:
+                return None
+        except Exception:
+            return None
+        row = cursor.fetchone()
+    return row[0] if row and row[0] and row[0] > 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator for large tables: an unfiltered list takes its size from estimated_count() instead of a
+    COUNT(*) over the whole table. Filtered lists, and tables without statistics, are counted as usual.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimated_count(queryset.model)
+            if estimate is not None:
+                return estimate
+        return super().count
+
+
+def paginate_services(services, cursor=None, page=None, per_page=8, estimate_total=False):
+    """
+    Keyset-paginates the cached catalog list, ordered by (order, id): a cursor is located by binary search
+    on that key, so pages stay put while services are added or removed between requests. With
+    estimate_total, the page carries the list's length.
+
+    `page` is the compatibility shim for old ?page=N links and is only used when no cursor is given.
+    """
+    position = decode_cursor(cursor)
+    keys = [(service.order, service.pk) for service in services]
+    if position is None:
+        start = (_page_number(page) - 1) * per_page
+        if start >= len(services):
+            start = max(len(services) - 1, 0) // per_page * per_page
+        end = start + per_page
+    elif position[0] == '>':
+        start = bisect_right(keys, position[1])
+        end = start + per_page
+    else:
+        end = bisect_left(keys, position[1])
+        start = max(end - per_page, 0)
+    total = len(services) if estimate_total else None
+    return KeysetPage(list(services[start:end]), end < len(services), start > 0, total)
+
+
+def _page_number(page):
+    try:
+        return max(int(page), 1)
+    except (TypeError, ValueError):
+        return 1
@@ -0,0 +1,126 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import connection
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import BotBotTransaction, DailyRevenue
+
+CENT = Decimal('0.01')
+CENTS_PER_DOLLAR = 100
+
+# Rows per INSERT; five parameters each keeps a statement well under SQLite's parameter limit
+UPSERT_BATCH_SIZE = 100
+
+
+def rollup_key(transaction_date, subscription_type, status):
+    return timezone.localdate(transaction_date), subscription_type, status
+
+
+def apply_deltas(deltas):
+    """
+    Adds {(day, subscription_type, status): (count, amount)} to the rollups with INSERT ... ON CONFLICT DO UPDATE,
+    which increments in place, so concurrent writers never lose each other's counts. Call it inside the
+    transaction that writes the transactions, so rollups and transactions commit together.
+    """
+    rows = [
+        (day, subscription_type, status, count, amount)
+        for (day, subscription_type, status), (count, amount) in deltas.items()
+        if count or amount
+    ]
+    table = connection.ops.quote_name(DailyRevenue._meta.db_table)
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+            batch = rows[start:start + UPSERT_BATCH_SIZE]
+            cursor.execute(
+                f"INSERT INTO {table} (day, subscription_type, status, transaction_count, amount) "
+                f"VALUES {', '.join(['(%s, %s, %s, %s, %s)'] * len(batch))} "
+                f"ON CONFLICT (day, subscription_type, status) DO UPDATE SET "
+                f"transaction_count = {table}.transaction_count + excluded.transaction_count, "
+                f"amount = {table}.amount + excluded.amount",
+                [value for row in batch for value in row],
+            )
+
+
+def record_transactions(transactions, sign=1):
+    """
+    Counts new BotBotTransaction instances into the rollups, or takes deleted ones out with sign=-1.
+    """
+    deltas = defaultdict(lambda: (0, Decimal(0)))
+    for txn in transactions:
+        key = rollup_key(txn.BotTransaction_date, txn.subscription_type, txn.status)
+        count, amount = deltas[key]
+        deltas[key] = (count + sign, amount + sign * Decimal(txn.amount))
+    apply_deltas(deltas)
+
+
+def record_status_changes(changes):
+    """
+    Moves transactions between status buckets. `changes` holds (BotTransaction_date, subscription_type,
+    amount, old_status, new_status) for each transaction whose status is being changed.
+    """
+    deltas = defaultdict(lambda: (0, Decimal(0)))
+    for transaction_date, subscription_type, amount, old_status, new_status in changes:
+        for status, sign in ((old_status, -1), (new_status, 1)):
+            key = rollup_key(transaction_date, subscription_type, status)
+            count, total = deltas[key]
+            deltas[key] = (count + sign, total + sign * amount)
+    apply_deltas(deltas)
+
+
+def backfill_chunk(first_id, last_id):
+    """
+    Adds the transactions with first_id <= id <= last_id to the rollups, aggregated by the database.
+    """
+    rows = list(
+        BotBotTransaction.objects.filter(id__gte=first_id, id__lte=last_id)
+        .annotate(day=TruncDate('BotTransaction_date'))
+        .values('day', 'subscription_type', 'status')
+        .annotate(count=Count('id'), total=Sum('amount'))
+        .order_by()
+    )
+    apply_deltas({
+        (row['day'], row['subscription_type'], row['status']): (row['count'], row['total'] or Decimal(0))
+        for row in rows
+    })
+    return sum(row['count'] for row in rows)
+
+
+def money(cents):
+    # Amounts are stored in cents (see determine_amount_based_on_plan) and reported in dollars. SQLite sums
+    # decimals as floats, hence the rounding to whole cents
+    return str((Decimal(cents or 0) / CENTS_PER_DOLLAR).quantize(CENT))
+
+
+def revenue_report(start, end, plan=None, status=None):
+    """
+    Transaction counts and amounts in US dollars between two dates (inclusive): in total, per plan, per status
+    and per day. Read from the rollups only, so the cost depends on the length of the range, not the number of
+    transactions.
+    """
+    rows = DailyRevenue.objects.filter(day__range=(start, end))
+    if plan:
+        rows = rows.filter(subscription_type=plan)
+    if status:
+        rows = rows.filter(status=status)
+    sums = {'transactions': Sum('transaction_count'), 'amount': Sum('amount')}
+
+    def breakdown(field):
+        return [
+            {field: row[field], 'transactions': row['transactions'], 'amount': money(row['amount'])}
+            for row in rows.values(field).annotate(**sums).order_by(field)
+        ]
+
+    totals = rows.aggregate(**sums)
+    return {
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'currency': 'USD',
+        'transactions': totals['transactions'] or 0,
+        'amount': money(totals['amount']),
+        'by_plan': breakdown('subscription_type'),
+        'by_status': breakdown('status'),
+        'by_day': breakdown('day'),
+    }
@@ -0,0 +1,61 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+
+from .catalog import bump_catalog_version
+from .emails import send_bulk_emails
+from .entitlements import invalidate_entitlements
+from .models import AIUserAccess, BotBotTransaction, BotService, BotSubscription
+from .revenue import record_transactions
+
+# Sent by the expiration sweeper with user_ids=[...] for each chunk it processes
+subscription_expired = Signal()
+subscription_expiring = Signal()
+
+
+@receiver([post_save, post_delete], sender=AIUserAccess)
+@receiver([post_save, post_delete], sender=BotSubscription)
+def evict_user_entitlements(sender, instance, **kwargs):
+    # Only once the change is visible, or a reader could re-cache the old rows for the whole TTL
+    transaction.on_commit(lambda: invalidate_entitlements(instance.user_id))
+
+
+@receiver([post_save, post_delete], sender=BotService)
+def bump_catalog(sender, **kwargs):
+    # Only once the change is visible, or a reader could cache the old catalog under the new version
+    transaction.on_commit(bump_catalog_version)
+
+
+@receiver(post_save, sender=BotBotTransaction)
+def count_new_transaction(sender, instance, created, raw=False, **kwargs):
+    # Only new rows: statuses are changed in bulk by the webhook reconciler, which moves the rollups itself
+    if created and not raw:
+        record_transactions([instance])
+
+
+@receiver(post_delete, sender=BotBotTransaction)
+def uncount_deleted_transaction(sender, instance, **kwargs):
+    record_transactions([instance], sign=-1)
+
+
+@receiver([subscription_expired, subscription_expiring])
+def evict_swept_entitlements(sender, user_ids, **kwargs):
+    transaction.on_commit(lambda: invalidate_entitlements(*user_ids))
+
+
+@receiver(subscription_expiring)
+def queue_expiry_reminders(sender, user_ids, **kwargs):
+    subscriptions = (
+        BotSubscription.objects.filter(user_id__in=user_ids)
+        .exclude(user__email='')
+        .values_list('user__email', 'selected_plan', 'expiration_date')
+    )
+    send_bulk_emails(
+        'expiry_reminder',
+        (
+            (email, {'user_email': email, 'plan': plan or '', 'expiration_date': expiration_date.strftime('%B %d, %Y')})
+            for email, plan, expiration_date in subscriptions
+        ),
+        ['user_email', 'plan', 'expiration_date'],
+        from_email='hello@iriseupacademy.com',
+    )
@@ -0,0 +1,237 @@
+import logging
+import random
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from square.client import Client
+
+logger = logging.getLogger(__name__)
+
+# Square answers these when it is overloaded or having trouble; anything else is a real answer
+TRANSIENT_STATUSES = {429, 500, 502, 503, 504}
+
+# Seconds per attempt; SQUARE_ENDPOINT_TIMEOUTS overrides them and SQUARE_CALL_TIMEOUT covers anything unlisted
+DEFAULT_TIMEOUTS = {
+    'customers.create_customer': 5.0,
+    'payments.create_payment': 15.0,
+    'cards.create_card': 8.0,
+}
+
+LATENCY_BUCKETS_MS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class SquareUnavailable(Exception):
+    """
+    Square could not give an answer: the circuit is open, or a transient failure outlasted the retries.
+    Whether a charge went through is unknown, so callers must not treat this as a decline.
+    """
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive transient failures and rejects calls for `reset_timeout`
+    seconds, then lets a single trial call through; its outcome closes or re-opens the circuit.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self.trial_thread = None
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        with self.lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'open' or self.trial_in_flight:
+                return False
+            self.trial_in_flight = True
+            self.trial_thread = threading.get_ident()
+            return True
+
+    def release_trial(self):
+        # Frees the trial this thread holds without an outcome, e.g. when the call raised something unexpected
+        with self.lock:
+            if self.trial_in_flight and self.trial_thread == threading.get_ident():
+                self.trial_in_flight = False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial_in_flight = False
+
+
+class LatencyHistogram:
+    """
+    Per-attempt latencies counted into LATENCY_BUCKETS_MS (plus an overflow bucket).
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.total_ms = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, elapsed_ms):
+        with self.lock:
+            self.counts[bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+            self.total_ms += elapsed_ms
+
+    def snapshot(self):
+        with self.lock:
+            count = sum(self.counts)
+            buckets = {f"le_{bound}": n for bound, n in zip(LATENCY_BUCKETS_MS, self.counts)}
+            buckets['inf'] = self.counts[-1]
+            return {'count': count, 'mean_ms': self.total_ms / count if count else None, 'buckets': buckets}
+
+
+class PooledHttpClient:
+    # What the SDK's RequestsClient adopts from a custom http_client_instance: a session and a timeout
+    def __init__(self, session, timeout):
+        self.session = session
+        self.timeout = timeout
+
+
+_lock = threading.Lock()
+_session = None
+_clients = {}
+_breakers = {}
+_histograms = defaultdict(LatencyHistogram)
+
+
+def _shared_session():
+    """
+    The process-wide keep-alive pool every Square call goes through. The adapter never retries by itself;
+    retries happen in call(), where the idempotency key and circuit breaker are known.
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=settings.SQUARE_POOL_SIZE, max_retries=0)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+
+def endpoint_timeout(endpoint):
+    return settings.SQUARE_ENDPOINT_TIMEOUTS.get(
+        endpoint, DEFAULT_TIMEOUTS.get(endpoint, settings.SQUARE_CALL_TIMEOUT)
+    )
+
+
+def client_for(timeout):
+    """
+    A Square client whose requests time out after `timeout` seconds. Clients differ only in their timeout
+    and all share one HTTP pool.
+    """
+    session = _shared_session()
+    with _lock:
+        if timeout not in _clients:
+            _clients[timeout] = Client(
+                http_client_instance=PooledHttpClient(session, timeout),
+                access_token=settings.SQUARE_ACCESS_TOKEN,
+                environment=settings.SQUARE_ENVIRONMENT,  # 'sandbox', 'production' or 'custom' (fake_square)
+                custom_url=settings.SQUARE_CUSTOM_URL,
+            )
+        return _clients[timeout]
+
+
+def breaker_for(endpoint):
+    with _lock:
+        if endpoint not in _breakers:
+            _breakers[endpoint] = CircuitBreaker(
+                settings.SQUARE_BREAKER_THRESHOLD, settings.SQUARE_BREAKER_RESET_TIMEOUT
+            )
+        return _breakers[endpoint]
+
+
+def retry_delay(attempt):
+    # Full jitter, so callers that failed together don't retry together
+    return random.uniform(0, min(settings.SQUARE_RETRY_MAX_DELAY, settings.SQUARE_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+def call(endpoint, body):
+    """
+    Calls a Square endpoint such as 'payments.create_payment' and returns the SDK's ApiResponse.
+
+    Connection errors, timeouts and TRANSIENT_STATUSES are retried with jittered backoff, resending the same
+    body so Square replays the original result for its idempotency key; bodies without one are never retried.
+    Raises SquareUnavailable when the endpoint's circuit is open or the retries run out.
+    """
+    breaker = breaker_for(endpoint)
+    if not breaker.allow():
+        raise SquareUnavailable(f"{endpoint}: circuit open, Square is failing")
+
+    try:
+        api_name, method_name = endpoint.split('.')
+        api_call = getattr(getattr(client_for(endpoint_timeout(endpoint)), api_name), method_name)
+        max_attempts = settings.SQUARE_MAX_ATTEMPTS if 'idempotency_key' in body else 1
+
+        attempt = 1
+        while True:
+            started = time.perf_counter()
+            try:
+                result = api_call(body=body)
+                failure = f"HTTP {result.status_code}" if result.status_code in TRANSIENT_STATUSES else None
+            except requests.RequestException as e:
+                failure = f"{type(e).__name__}: {e}"
+            _histograms[endpoint].observe((time.perf_counter() - started) * 1000)
+
+            if failure is None:
+                # Declines and validation errors are answers too: Square is healthy
+                breaker.record_success()
+                return result
+
+            breaker.record_failure()
+            logger.warning("Square %s attempt %s/%s failed: %s", endpoint, attempt, max_attempts, failure)
+            if attempt >= max_attempts:
+                raise SquareUnavailable(f"{endpoint}: {failure}")
+            time.sleep(retry_delay(attempt))
+            if not breaker.allow():
+                raise SquareUnavailable(f"{endpoint}: circuit opened after {failure}")
+            attempt += 1
+    finally:
+        # Recording an outcome ends a half-open trial; anything else raised mid-trial must not leave it held,
+        # or the circuit would stay open for good
+        breaker.release_trial()
+
+
+def metrics():
+    """
+    This process's per-endpoint latency histograms and circuit states.
+    """
+    with _lock:
+        endpoints = sorted(set(_histograms) | set(_breakers))
+    return {
+        endpoint: {
+            'latency': _histograms[endpoint].snapshot(),
+            'circuit': breaker_for(endpoint).state,
+        }
+        for endpoint in endpoints
+    }
@@ -0,0 +1,69 @@
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import BotSubscription
+from .signals import subscription_expired, subscription_expiring
+
+
+def sweep_expired(now=None, chunk_size=1000):
+    """
+    Deactivates subscriptions whose expiration_date has passed, a chunk at a time. Subscriptions that
+    renew automatically (they have a next_billing_date) are left to `manage.py run_renewals`, which
+    ends them itself once MAX_DECLINED_RENEWALS charges in a row have been declined.
+
+    Each chunk is read from the head of the partial (expiration_date WHERE is_active AND
+    next_billing_date IS NULL) index and flipped with one UPDATE, so flipped rows drop out of the index
+    and the next chunk starts at the head again. Sends subscription_expired with the chunk's user ids.
+    Returns the number deactivated.
+    """
+    now = now or timezone.now()
+    deactivated = 0
+    while True:
+        chunk = list(
+            BotSubscription.objects.filter(is_active=True, expiration_date__lte=now, next_billing_date__isnull=True)
+            .order_by('expiration_date')
+            .values_list('id', 'user_id')[:chunk_size]
+        )
+        if not chunk:
+            return deactivated
+        ids = [subscription_id for subscription_id, _ in chunk]
+        # Re-check so a subscription renewed or put back on billing since the read is left alone
+        deactivated += BotSubscription.objects.filter(
+            id__in=ids, is_active=True, expiration_date__lte=now, next_billing_date__isnull=True
+        ).update(is_active=False, updated_at=now)
+        subscription_expired.send(sender=BotSubscription, user_ids=[user_id for _, user_id in chunk])
+
+
+def sweep_expiring(now=None, within=timedelta(days=3), chunk_size=1000):
+    """
+    Marks subscriptions expiring within `within` that have not been reminded yet, a chunk at a time,
+    and sends subscription_expiring with each chunk's user ids. Subscriptions that will be renewed
+    automatically (they have a next_billing_date) get no reminder. Returns the number marked.
+
+    Each chunk's stamp and the reminders its receivers queue commit together, so a crash in between
+    leaves the chunk to be picked up again rather than marked without a reminder.
+    """
+    now = now or timezone.now()
+    marked = 0
+    while True:
+        with transaction.atomic():
+            chunk = list(
+                BotSubscription.objects.filter(
+                    is_active=True,
+                    expiration_date__gt=now,
+                    expiration_date__lte=now + within,
+                    expiry_reminder_sent_at__isnull=True,
+                    next_billing_date__isnull=True,
+                )
+                .order_by('expiration_date')
+                .values_list('id', 'user_id')[:chunk_size]
+            )
+            if not chunk:
+                return marked
+            ids = [subscription_id for subscription_id, _ in chunk]
+            marked += BotSubscription.objects.filter(id__in=ids, expiry_reminder_sent_at__isnull=True).update(
+                expiry_reminder_sent_at=now
+            )
+            subscription_expiring.send(sender=BotSubscription, user_ids=[user_id for _, user_id in chunk])
@@ -1,3 +1,1358 @@
-from django.test import TestCase
+import base64
+import hashlib
+import hmac
+import io
+import json
+import os
+import re
+import runpy
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from importlib import import_module
+from unittest import mock
 
-# Create your tests here.
+import requests
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core import mail
+from django.core.management import call_command
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.db.utils import ConnectionHandler
+from django.db.models import Q
+from django.template.loader import render_to_string
+from django.test.utils import CaptureQueriesContext
+from django.http import HttpResponse
+from django.contrib.admin.sites import AdminSite
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from . import emails, square_gateway
+from .models import (
+    AIUserAccess, BotBotTransaction, BotService, BotSubscription, BotUserPaymentInfo, CheckoutJob, DailyRevenue,
+    EmailOutbox,
+)
+from .admin import AIUserAccessAdmin, BotSubscriptionAdmin
+from .billing import MAX_DECLINED_RENEWALS, run_renewals
+from .catalog import active_services, catalog_version
+from .checkout_queue import process_checkout_batch
+from .coalescing import REPLAY_TIMEOUT
+from .dedupe import dedupe_chunk
+from .entitlements import (
+    ENTITLEMENT_CACHE_TTL, entitlement_cache_key, entitlement_timeout, get_entitlements, has_access,
+)
+from .exports import access_queryset, transactions_queryset
+from .forecast import RECURRING_PLANS, forecast_renewals, scheduled_renewals, start_of_day
+from .outbox import deliver_outbox_batch, purge_outbox
+from .pagination import decode_cursor, encode_cursor, paginate_services
+from .revenue import backfill_chunk, revenue_report
+from .signals import subscription_expired
+from .sweeper import sweep_expired, sweep_expiring
+from .webhooks import ingest_events, reconcile_batch
+from .views import (
+    complete_checkout, coursemenu, determine_amount_based_on_plan, grant_service_access_bulk, update_session,
+)
+
+
+class CoursemenuQueryBudgetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='learner@example.com')
+        self.services = BotService.objects.bulk_create(
+            BotService(title=f"Bot {i}", order=i) for i in range(30)
+        )
+
+    def render_coursemenu(self):
+        request = RequestFactory().get('/course-menu/')
+        request.user = self.user
+        with mock.patch('myApp.views.render', return_value=HttpResponse()) as render:
+            coursemenu(request)
+        context = render.call_args.args[2]
+        # Touch everything the template and AIUserAccess.__str__ dereference
+        for tab in ('ongoing_services', 'completed_services', 'saved_services', 'favorite_services'):
+            for access in context[tab]:
+                str(access)
+                access.bot_service.description
+        return context
+
+    def add_access(self, services):
+        AIUserAccess.objects.bulk_create(
+            AIUserAccess(user=self.user, bot_service=service, progress=(i % 3) * 50,
+                         is_saved=i % 2 == 0, is_favorite=i % 5 == 0)
+            for i, service in enumerate(services)
+        )
+
+    def assert_warm_queries(self, expected_counts):
+        self.render_coursemenu()  # warm the catalog and entitlement caches
+        with self.assertNumQueries(1):
+            context = self.render_coursemenu()
+        self.assertEqual(context['tab_counts'], expected_counts)
+
+    def test_query_count_is_constant_as_rows_grow(self):
+        self.add_access(self.services[:1])
+        self.assert_warm_queries({'ongoing': 0, 'completed': 0, 'saved': 1, 'favorite': 1})
+
+        AIUserAccess.objects.all().delete()
+        self.add_access(self.services)
+        self.assert_warm_queries({'ongoing': 10, 'completed': 10, 'saved': 15, 'favorite': 6})
+
+
+class ServicePaginationTests(TestCase):
+    def setUp(self):
+        # Unsaved, as the catalog cache hands them out; several services share an order
+        self.services = [BotService(pk=pk, title=f"Bot {pk}", order=pk // 3) for pk in range(1, 21)]
+
+    def test_cursors_round_trip(self):
+        service = self.services[4]
+        self.assertEqual(decode_cursor(encode_cursor('>', service)), ('>', (service.order, service.pk)))
+        self.assertEqual(decode_cursor(encode_cursor('<', service)), ('<', (service.order, service.pk)))
+
+    def test_tampered_cursors_start_from_the_first_page(self):
+        forged = base64.urlsafe_b64encode(json.dumps(['>=', 1, 2]).encode()).decode()
+        not_numbers = base64.urlsafe_b64encode(json.dumps(['>', 'x', 2]).encode()).decode()
+        for cursor in ('', 'not-base64!', 'e30', forged, not_numbers):
+            self.assertIsNone(decode_cursor(cursor), cursor)
+            page = paginate_services(self.services, cursor=cursor, per_page=8)
+            self.assertEqual([service.pk for service in page], list(range(1, 9)))
+
+    def test_next_and_prev_walk_every_page(self):
+        pages, cursor = [], None
+        while True:
+            page = paginate_services(self.services, cursor=cursor, per_page=8)
+            pages.append([service.pk for service in page])
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        self.assertEqual(pages, [list(range(1, 9)), list(range(9, 17)), list(range(17, 21))])
+        self.assertIsNone(page.next_cursor)
+
+        back = paginate_services(self.services, cursor=page.prev_cursor, per_page=8)
+        self.assertEqual([service.pk for service in back], list(range(9, 17)))
+        first = paginate_services(self.services, cursor=back.prev_cursor, per_page=8)
+        self.assertEqual([service.pk for service in first], list(range(1, 9)))
+        self.assertFalse(first.has_previous)
+        self.assertIsNone(first.prev_cursor)
+
+    def test_a_cursor_survives_catalog_changes(self):
+        page = paginate_services(self.services, per_page=8)
+        # A service is added ahead of the cursor before the next request
+        services = sorted(self.services + [BotService(pk=99, title="New", order=0)], key=lambda s: (s.order, s.pk))
+        following = paginate_services(services, cursor=page.next_cursor, per_page=8)
+        self.assertEqual([service.pk for service in following], list(range(9, 17)))
+
+    def test_old_page_links_still_work(self):
+        def pks(page):
+            return [service.pk for service in paginate_services(self.services, page=page, per_page=8)]
+
+        self.assertEqual(pks('2'), list(range(9, 17)))
+        self.assertEqual(pks('99'), list(range(17, 21)))  # past the end: the last page
+        self.assertEqual(pks('abc'), list(range(1, 9)))
+        self.assertEqual(pks('-3'), list(range(1, 9)))
+        page = paginate_services(self.services, page='2', per_page=8, estimate_total=True)
+        self.assertEqual((page.has_previous, page.has_next, page.estimated_total), (True, True, 20))
+
+
+class EntitlementCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='learner@example.com')
+        self.service = BotService.objects.create(title='Coach')
+        self.subscription = BotSubscription.objects.create(
+            user=self.user, selected_plan='4-week', expiration_date=timezone.now() + timedelta(hours=1)
+        )
+
+    def test_a_change_evicts_the_entry_once_it_commits(self):
+        self.assertTrue(has_access(self.user, self.service))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.subscription.expiration_date = timezone.now() - timedelta(minutes=1)
+            self.subscription.save()
+            # A reader before the commit still sees the old row, so the entry must survive until then
+            self.assertIsNotNone(cache.get(entitlement_cache_key(self.user.pk)))
+        self.assertIsNone(cache.get(entitlement_cache_key(self.user.pk)))
+        self.assertFalse(has_access(self.user, self.service))
+
+    def test_an_entry_never_outlives_the_plan(self):
+        entitlements = get_entitlements(self.user)
+        self.assertLessEqual(entitlement_timeout(entitlements), 60 * 60)
+        lifetime = dict(entitlements, expiration_date=None)
+        with mock.patch('myApp.catalog.cache_is_shared', return_value=True):
+            self.assertEqual(entitlement_timeout(lifetime), ENTITLEMENT_CACHE_TTL)
+
+        # Even while the entry is still cached, access ends at expiration_date
+        later = timezone.now() + timedelta(hours=2)
+        with mock.patch('myApp.entitlements.timezone.now', return_value=later), self.assertNumQueries(0):
+            self.assertFalse(has_access(self.user, self.service))
+
+    def test_coursemenu_links_follow_the_entitlements(self):
+        request = RequestFactory().get('/course-menu/')
+        request.user = self.user
+        with mock.patch('myApp.views.render', return_value=HttpResponse()) as render:
+            coursemenu(request)
+        self.assertEqual(render.call_args.args[2]['entitled_service_ids'], {self.service.pk})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.subscription.delete()
+        with mock.patch('myApp.views.render', return_value=HttpResponse()) as render:
+            coursemenu(request)
+        self.assertEqual(render.call_args.args[2]['entitled_service_ids'], frozenset())
+
+
+class CatalogVersionTests(TestCase):
+    def test_version_moves_only_when_the_change_commits(self):
+        cache.clear()
+        before = catalog_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            BotService.objects.create(title='New bot')
+            self.assertEqual(catalog_version(), before)
+        self.assertEqual(catalog_version(), before + 1)
+
+    @override_settings(LOCAL_CACHE_TTL=60)
+    def test_a_process_local_copy_expires_after_the_local_ttl(self):
+        cache.clear()
+        BotService.objects.create(title='Coach')
+        self.assertEqual(len(active_services()), 1)
+        # Another process's change: its version bump lands in its own locmem cache, never in this one
+        BotService.objects.update(is_active=False)
+        self.assertEqual(len(active_services()), 1)
+
+        with mock.patch('time.time', return_value=time.time() + 61):
+            self.assertEqual(active_services(), [])
+            user = User.objects.create(username='learner@example.com')
+            self.assertLessEqual(entitlement_timeout(get_entitlements(user)), 60)
+
+
+class DatabaseProfileTests(TestCase):
+    def load_settings(self, **environ):
+        """
+        The DATABASES a fresh read of settings.py builds with `environ` in the environment.
+        """
+        with mock.patch.dict(os.environ, environ):
+            for name in ('DATABASE_PROFILE', 'DATABASE_POOL_SIZE'):
+                if name not in environ:
+                    os.environ.pop(name, None)
+            return runpy.run_path(sys.modules[settings.SETTINGS_MODULE].__file__)['DATABASES']['default']
+
+    def journal_mode(self, database, path):
+        connections = ConnectionHandler({'default': {**database, 'NAME': path}})
+        try:
+            with connections['default'].cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode')
+                return cursor.fetchone()[0]
+        finally:
+            connections.close_all()
+
+    def test_the_default_leaves_the_database_file_as_it_is(self):
+        database = self.load_settings()
+        self.assertNotIn('init_command', database.get('OPTIONS', {}))
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertEqual(self.journal_mode(database, os.path.join(directory, 'db.sqlite3')), 'delete')
+
+    def test_the_wal_profile_switches_the_file_to_wal(self):
+        database = self.load_settings(DATABASE_PROFILE='sqlite-wal')
+        self.assertEqual(database['OPTIONS']['transaction_mode'], 'IMMEDIATE')
+        with tempfile.TemporaryDirectory() as directory:
+            self.assertEqual(self.journal_mode(database, os.path.join(directory, 'db.sqlite3')), 'wal')
+
+    def test_the_postgres_profile_pools_without_persistent_connections(self):
+        database = self.load_settings(
+            DATABASE_PROFILE='postgres', DATABASE_URL='postgres://app:secret@db:5432/app', DATABASE_POOL_SIZE='8'
+        )
+        self.assertEqual((database['NAME'], database['CONN_MAX_AGE']), ('app', 0))
+        self.assertEqual(database['OPTIONS']['pool']['max_size'], 8)
+
+    def test_an_unknown_profile_is_refused(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self.load_settings(DATABASE_PROFILE='mysql')
+
+
+# A table scan in EXPLAIN output: SQLite prints "SCAN <table>" without "USING ... INDEX", PostgreSQL "Seq Scan"
+FULL_SCAN = re.compile(r'\bSCAN (?!.*\bUSING\b)|\bSeq Scan\b')
+
+
+class QueryPlanTests(TestCase):
+    """
+    Captures the EXPLAIN plan of each hot query and fails if it falls back to a full table scan
+    or stops using the index built for it.
+    """
+
+    def setUp(self):
+        if connection.vendor not in ('sqlite', 'postgresql'):
+            self.skipTest(f"No plan checks for {connection.vendor}")
+        self.user = User.objects.create(username='learner@example.com', email='learner@example.com')
+        self.now = timezone.now()
+
+    def query_plan(self, queryset):
+        if connection.vendor == 'postgresql':
+            # Test tables are tiny, so make the planner show whether an index is usable rather than cheapest
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+        return queryset.explain()
+
+    def assert_indexed(self, queryset, index_name=None):
+        plan = self.query_plan(queryset)
+        self.assertIsNone(FULL_SCAN.search(plan), f"Full scan in plan:\n{plan}\nfor {queryset.query}")
+        if index_name:
+            self.assertIn(index_name, plan)
+
+    def test_user_lookup_by_email(self):
+        self.assert_indexed(User.objects.filter(email='learner@example.com'), 'auth_user_email_idx')
+
+    def test_latest_transaction_by_status(self):
+        self.assert_indexed(
+            BotBotTransaction.objects.filter(user=self.user, status='success').order_by('-BotTransaction_date'),
+            'txn_user_status_date_idx',
+        )
+
+    def test_access_tabs(self):
+        self.assert_indexed(
+            AIUserAccess.objects.filter(user=self.user, bot_service__isnull=False).select_related('bot_service', 'user')
+        )
+
+    def test_saved_and_favorite_access(self):
+        self.assert_indexed(AIUserAccess.objects.filter(user=self.user, is_saved=True), 'access_user_saved_idx')
+        self.assert_indexed(AIUserAccess.objects.filter(user=self.user, is_favorite=True), 'access_user_favorite_idx')
+
+    def test_legacy_access_expiry(self):
+        self.assert_indexed(AIUserAccess.objects.filter(expiration_date__lte=self.now), 'access_expiry_idx')
+
+    def test_active_catalog(self):
+        services = BotService.objects.filter(is_active=True).order_by('order', 'id')
+        self.assert_indexed(services, 'service_active_order_idx')
+        self.assert_indexed(services.filter(order__gt=3), 'service_active_order_idx')
+
+    def test_entitlement_lookup(self):
+        self.assert_indexed(BotSubscription.objects.filter(user_id=self.user.pk))
+
+    def test_due_renewals(self):
+        self.assert_indexed(
+            BotSubscription.objects.filter(next_billing_date__lte=self.now, is_active=True)
+            .filter(Q(renewal_lease_until__isnull=True) | Q(renewal_lease_until__lte=self.now))
+            .order_by('next_billing_date', 'id'),
+            'sub_next_billing_idx',
+        )
+
+    def test_expiration_sweep(self):
+        self.assert_indexed(
+            BotSubscription.objects.filter(is_active=True, expiration_date__lte=self.now, next_billing_date__isnull=True)
+            .order_by('expiration_date'),
+            'sub_reminder_expiry_idx',
+        )
+        self.assert_indexed(
+            BotSubscription.objects.filter(
+                is_active=True,
+                expiration_date__gt=self.now,
+                expiration_date__lte=self.now + timedelta(days=3),
+                expiry_reminder_sent_at__isnull=True,
+                next_billing_date__isnull=True,
+            ).order_by('expiration_date'),
+            'sub_reminder_expiry_idx',
+        )
+
+    def test_transaction_export(self):
+        day = self.now.date()
+        self.assert_indexed(transactions_queryset(day, day))
+        self.assert_indexed(transactions_queryset(day, day, status='error'), 'txn_status_date_idx')
+        self.assert_indexed(access_queryset(status='active'), 'sub_active_expiry_idx')
+        self.assert_indexed(access_queryset(day, day, status='active'), 'sub_active_expiry_idx')
+
+    def test_outbox_due(self):
+        self.assert_indexed(
+            EmailOutbox.objects.filter(status__in=['pending', 'sending'], next_attempt_at__lte=self.now)
+            .order_by('next_attempt_at'),
+            'outbox_due_idx',
+        )
+
+
+class RevenueRollupTests(TestCase):
+    """
+    The daily rollups must always equal a GROUP BY over BotBotTransaction, however the transactions were written.
+    """
+
+    def setUp(self):
+        self.user = User.objects.create(username='buyer@example.com')
+        self.now = timezone.now()
+
+    def assert_rollups_match(self):
+        expected = {}
+        for date, plan, status, amount in BotBotTransaction.objects.values_list(
+            'BotTransaction_date', 'subscription_type', 'status', 'amount'
+        ):
+            count, total = expected.get((timezone.localdate(date), plan, status), (0, 0))
+            expected[(timezone.localdate(date), plan, status)] = (count + 1, total + amount)
+        actual = {
+            (row.day, row.subscription_type, row.status): (row.transaction_count, row.amount)
+            for row in DailyRevenue.objects.exclude(transaction_count=0)
+        }
+        self.assertEqual(actual, expected)
+
+    def payment_event(self, event_id, payment_id, refunded):
+        return {
+            'type': 'payment.updated',
+            'event_id': event_id,
+            'created_at': self.now.isoformat(),
+            'data': {'object': {'payment': {
+                'id': payment_id,
+                'status': 'COMPLETED',
+                'total_money': {'amount': 3795},
+                'refunded_money': {'amount': 3795 if refunded else 0},
+            }}},
+        }
+
+    def test_rollups_follow_creates_status_changes_and_deletes(self):
+        for day, payment_id in enumerate(['P1', 'P2', 'P3']):
+            BotBotTransaction.objects.create(
+                user=self.user, amount=3795, subscription_type='4-week', status='success',
+                BotTransaction_date=self.now - timedelta(days=day), square_payment_id=payment_id,
+            )
+        BotBotTransaction.objects.create(user=self.user, amount=29700, subscription_type='lifetime', status='error')
+        self.assert_rollups_match()
+
+        ingest_events([self.payment_event('e1', 'P1', refunded=True), self.payment_event('e2', 'P2', refunded=False)])
+        reconcile_batch()
+        self.assertEqual(BotBotTransaction.objects.get(square_payment_id='P1').status, 'refunded')
+        self.assert_rollups_match()
+
+        BotBotTransaction.objects.filter(subscription_type='lifetime').delete()
+        self.assert_rollups_match()
+
+        DailyRevenue.objects.all().delete()
+        backfill_chunk(1, BotBotTransaction.objects.order_by('-id').values_list('id', flat=True).first())
+        self.assert_rollups_match()
+
+    def test_the_report_is_in_dollars(self):
+        for plan in ('4-week', '4-week', 'lifetime'):
+            BotBotTransaction.objects.create(
+                user=self.user, amount=determine_amount_based_on_plan(plan), subscription_type=plan, status='success'
+            )
+        today = timezone.localdate()
+
+        report = revenue_report(today, today)
+
+        self.assertEqual((report['currency'], report['transactions'], report['amount']), ('USD', 3, '372.90'))
+        self.assertEqual(
+            [(row['subscription_type'], row['amount']) for row in report['by_plan']],
+            [('4-week', '75.90'), ('lifetime', '297.00')],
+        )
+
+    def test_admin_edits_leave_rolled_up_fields_alone(self):
+        txn = BotBotTransaction.objects.create(
+            user=self.user, amount=3795, subscription_type='4-week', status='success', square_payment_id='P1',
+        )
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'pw'))
+        response = self.client.post(f'/admin/myApp/botbottransaction/{txn.pk}/change/', {
+            'user': self.user.pk, 'status': 'refunded', 'amount': '100', 'subscription_type': 'lifetime',
+            'BotTransaction_date_0': '2020-01-01', 'BotTransaction_date_1': '00:00:00',
+            'error_logs': 'checked by hand', 'square_payment_id': 'P1',
+        })
+        self.assertEqual(response.status_code, 302)
+        txn.refresh_from_db()
+        self.assertEqual((txn.status, txn.amount, txn.error_logs), ('success', Decimal('3795'), 'checked by hand'))
+        self.assert_rollups_match()
+
+
+class RenewalForecastTests(TestCase):
+    def test_renewals_are_weighted_by_the_plan_renewal_rate(self):
+        today = timezone.localdate()
+        now = timezone.now()
+        renewed, declined = User.objects.create(username='renewed'), User.objects.create(username='declined')
+        signed_up, cancelled = User.objects.create(username='signed_up'), User.objects.create(username='cancelled')
+        for user, status in [(renewed, 'error'), (renewed, 'success'), (declined, 'error')]:
+            BotBotTransaction.objects.create(
+                user=user, amount=1287, subscription_type='1-week', status=status, recurring=True,
+                is_renewal=True, BotTransaction_date=now - timedelta(days=1),
+            )
+        # A signup charge is recurring too, but says nothing about renewing
+        BotBotTransaction.objects.create(
+            user=signed_up, amount=1287, subscription_type='1-week', status='success', recurring=True,
+            BotTransaction_date=now - timedelta(days=1),
+        )
+        BotSubscription.objects.create(user=renewed, selected_plan='1-week', next_billing_date=now)
+        BotSubscription.objects.create(
+            user=cancelled, selected_plan='1-week', next_billing_date=now, is_active=False
+        )
+
+        forecast = forecast_renewals(today, horizon_days=14)
+
+        self.assertEqual(forecast['renewal_rates']['1-week'], 0.5)
+        days = {day['date']: day for day in forecast['days']}
+        first, second = days[today.isoformat()], days[(today + timedelta(days=7)).isoformat()]
+        self.assertEqual((first['scheduled_renewals'], first['expected_renewals']), (1, 0.5))
+        self.assertEqual((second['scheduled_renewals'], second['expected_renewals']), (1, 0.25))
+        self.assertEqual(forecast['totals']['scheduled_revenue'], 25.74)
+        self.assertEqual(forecast['totals']['expected_revenue'], round(12.87 * 0.75, 2))
+
+    def test_scheduled_renewals_are_read_in_one_query(self):
+        today = timezone.localdate()
+        morning = start_of_day(today) + timedelta(hours=9)
+        for n, (plan, due) in enumerate([
+            ('1-week', morning - timedelta(days=3)),  # overdue, so due today
+            ('1-week', morning),
+            ('4-week', start_of_day(today + timedelta(days=1))),
+            ('4-week', morning + timedelta(days=1)),
+            ('12-week', morning + timedelta(days=29)),
+            ('12-week', morning + timedelta(days=30)),  # past the horizon
+        ]):
+            user = User.objects.create(username=f'user{n}')
+            BotSubscription.objects.create(user=user, selected_plan=plan, next_billing_date=due)
+
+        with self.assertNumQueries(1):
+            offsets, plans, counts = scheduled_renewals(today, horizon_days=30)
+
+        self.assertEqual(
+            sorted(zip(offsets.tolist(), [RECURRING_PLANS[plan] for plan in plans], counts.tolist())),
+            [(0, '1-week', 2.0), (1, '4-week', 2.0), (29, '12-week', 1.0)],
+        )
+
+    @override_settings(ALLOWED_HOSTS=['*'])
+    def test_the_page_states_the_lookback_it_used(self):
+        self.client.force_login(User.objects.create_superuser(username='admin'))
+        with mock.patch('myApp.forecast.cached_forecast', return_value=forecast_renewals(lookback_days=30)):
+            response = self.client.get('/renewal-forecast/')
+        self.assertContains(response, "renewal rate over the last 30 days.")
+
+
+class AdminBulkActionTests(TestCase):
+    def setUp(self):
+        self.model_admin = BotSubscriptionAdmin(BotSubscription, AdminSite())
+        self.model_admin.message_user = mock.Mock()
+        self.expiration_date = timezone.now() + timedelta(days=3)
+
+    def add_users(self, count, offset=0):
+        # Most subscribers have no AIUserAccess rows at all
+        users = User.objects.bulk_create(User(username=f"user{offset + i}@example.com") for i in range(count))
+        BotSubscription.objects.bulk_create(
+            BotSubscription(
+                user=user, selected_plan='4-week', expiration_date=self.expiration_date,
+                next_billing_date=self.expiration_date,
+            )
+            for user in users
+        )
+        return users
+
+    def run_action(self, action, model_admin=None, **form):
+        model_admin = model_admin or self.model_admin
+        request = RequestFactory().post('/admin/', {'action': action, **form})
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as queries:
+            getattr(model_admin, action)(request, model_admin.model.objects.all())
+        return len(queries)
+
+    def test_actions_cost_the_same_for_ten_rows_or_two_hundred(self):
+        first = self.add_users(10)[0]
+        AIUserAccess.objects.create(user=first, expiration_date=self.expiration_date, selected_plan='4-week')
+        small = [self.run_action('extend_expiration', weeks=2), self.run_action('change_plan', plan='12-week')]
+        self.add_users(190, offset=10)
+        large = [self.run_action('extend_expiration', weeks=2), self.run_action('change_plan', plan='12-week')]
+        self.assertEqual(small, large)
+
+        self.assertEqual(BotSubscription.objects.filter(selected_plan='12-week').count(), 200)
+        moved = BotSubscription.objects.get(user=first)
+        self.assertEqual(moved.expiration_date, self.expiration_date + timedelta(weeks=4))
+        self.assertEqual(moved.selected_plan, '12-week')
+        legacy = AIUserAccess.objects.get(user=first)
+        self.assertEqual((legacy.expiration_date, legacy.selected_plan), (moved.expiration_date, '12-week'))
+
+    def test_switching_to_lifetime_ends_billing(self):
+        self.add_users(3)
+        self.run_action('change_plan', plan='lifetime')
+        self.assertFalse(BotSubscription.objects.exclude(expiration_date=None, next_billing_date=None).exists())
+
+    def test_favorites_are_marked_in_one_update(self):
+        AIUserAccess.objects.bulk_create(AIUserAccess(user=user) for user in self.add_users(5))
+        access_admin = AIUserAccessAdmin(AIUserAccess, AdminSite())
+        access_admin.message_user = mock.Mock()
+        self.assertEqual(self.run_action('mark_favorite', model_admin=access_admin), 1)
+        self.assertEqual(AIUserAccess.objects.filter(is_favorite=True).count(), 5)
+
+
+class SubscriptionBackfillMigrationTests(TransactionTestCase):
+    migrate_from = [('myApp', '0003_botsubscription')]
+    migrate_to = [('myApp', '0004_backfill_botsubscription')]
+
+    def setUp(self):
+        executor = MigrationExecutor(connection)
+        latest = executor.loader.graph.leaf_nodes('myApp')
+        executor.migrate(self.migrate_from)
+        self.addCleanup(lambda: MigrationExecutor(connection).migrate(latest))
+        self.apps = executor.loader.project_state(self.migrate_from).apps
+
+    def migrate(self):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        # A chunk size smaller than the number of users, so the backfill has to page through them
+        with mock.patch.object(import_module('myApp.migrations.0004_backfill_botsubscription'), 'CHUNK_SIZE', 2):
+            executor.migrate(self.migrate_to)
+        return executor.loader.project_state(self.migrate_to).apps
+
+    def test_access_rows_collapse_into_one_subscription_per_user(self):
+        AIUserAccess = self.apps.get_model('myApp', 'AIUserAccess')
+        services = [self.apps.get_model('myApp', 'BotService').objects.create(title=f'bot {n}') for n in range(4)]
+        names = ('latest', 'lifetime', 'stateful', 'unset', 'none')
+        users = {name: User.objects.create_user(username=name).pk for name in names}
+        soon, later = timezone.now() + timedelta(days=3), timezone.now() + timedelta(days=30)
+
+        def access(user, service, **fields):
+            return AIUserAccess.objects.create(user_id=users[user], bot_service=services[service], **fields).pk
+
+        access('latest', 0, selected_plan='1-week', expiration_date=later)
+        access('latest', 1, selected_plan='4-week', expiration_date=soon)
+        access('lifetime', 0, selected_plan='4-week', expiration_date=soon)
+        access('lifetime', 1, selected_plan='lifetime', expiration_date=None)
+        kept = {
+            access('stateful', 0, selected_plan='4-week', expiration_date=soon, progress=0.5),
+            access('stateful', 1, selected_plan='4-week', expiration_date=soon, is_saved=True),
+            access('stateful', 2, selected_plan='4-week', expiration_date=soon, is_favorite=True),
+        }
+        access('stateful', 3, selected_plan='4-week', expiration_date=soon)
+        access('unset', 0)
+
+        apps = self.migrate()
+
+        subscriptions = {
+            user_id: (plan, expiration_date)
+            for user_id, plan, expiration_date in apps.get_model('myApp', 'BotSubscription').objects.values_list(
+                'user_id', 'selected_plan', 'expiration_date'
+            )
+        }
+        self.assertEqual(subscriptions, {
+            # The last plan by row wins, with the latest expiry across the user's rows
+            users['latest']: ('4-week', later),
+            # Any row that never expires means lifetime access
+            users['lifetime']: ('lifetime', None),
+            users['stateful']: ('4-week', soon),
+            users['unset']: (None, None),
+        })
+        # Only rows holding progress, a save or a favorite survive
+        self.assertEqual(set(apps.get_model('myApp', 'AIUserAccess').objects.values_list('id', flat=True)), kept)
+
+
+class DedupeAccessTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='dupes@example.com')
+        self.service = BotService.objects.create(title='Coach')
+        self.now = timezone.now()
+        # Rows without a bot_service slip past unique_user_bot_service, as repeated grants left them
+        AIUserAccess.objects.bulk_create([
+            AIUserAccess(user=self.user, progress=0.5, is_saved=True, expiration_date=self.now, selected_plan='4-week'),
+            AIUserAccess(user=self.user, progress=0.2, expiration_date=self.now + timedelta(weeks=12)),
+            AIUserAccess(user=self.user, is_favorite=True, expiration_date=self.now - timedelta(weeks=1)),
+        ])
+        AIUserAccess.objects.create(user=self.user, bot_service=self.service, progress=0.3)
+
+    def test_duplicates_merge_into_the_newest_row(self):
+        self.assertEqual(dedupe_chunk(self.user.id, self.user.id, dry_run=True), (1, 2))
+        self.assertEqual(AIUserAccess.objects.count(), 4)
+
+        newest = AIUserAccess.objects.filter(bot_service=None).latest('id')
+        self.assertEqual(dedupe_chunk(self.user.id, self.user.id), (1, 2))
+        merged = AIUserAccess.objects.get(bot_service=None)
+        self.assertEqual(merged.id, newest.id)
+        self.assertEqual(merged.progress, 0.5)
+        self.assertTrue(merged.is_saved and merged.is_favorite)
+        self.assertEqual(merged.expiration_date, self.now + timedelta(weeks=12))
+        self.assertEqual(merged.selected_plan, '4-week')
+        self.assertEqual(dedupe_chunk(self.user.id, self.user.id), (0, 0))
+
+    def test_drop_orphans_keeps_rows_with_state(self):
+        AIUserAccess.objects.filter(bot_service=None).update(progress=0.0, is_saved=False, is_favorite=False)
+        self.assertEqual(dedupe_chunk(self.user.id, self.user.id, drop_orphans=True), (1, 3))
+        self.assertEqual(list(AIUserAccess.objects.values_list('bot_service', flat=True)), [self.service.id])
+
+
+def square_response(**body):
+    # What square_gateway.call returns for a successful call
+    return mock.Mock(is_error=lambda: False, body=body, errors=None)
+
+
+def fake_square(payment_id='PAY1', customer_id='CUST1', card_id='CARD1'):
+    """
+    A stand-in for square_gateway.call answering every endpoint successfully.
+    """
+    responses = {
+        'customers.create_customer': square_response(customer={'id': customer_id}),
+        'payments.create_payment': square_response(payment={'id': payment_id}),
+        'cards.create_card': square_response(card={'id': card_id}),
+    }
+    return mock.patch('myApp.square_gateway.call', side_effect=lambda endpoint, body: responses[endpoint])
+
+
+CHECKOUT = {'email': 'buyer@example.com', 'plan': '4-week', 'source_id': 'cnon:card', 'verification_token': 'vt'}
+
+
+@override_settings(SQUARE_MAX_ATTEMPTS=3, SQUARE_BREAKER_THRESHOLD=3, SQUARE_BREAKER_RESET_TIMEOUT=30.0,
+                   SQUARE_RETRY_BASE_DELAY=0.2, SQUARE_RETRY_MAX_DELAY=2.0)
+class SquareGatewayTests(TestCase):
+    endpoint = 'payments.create_payment'
+
+    def setUp(self):
+        for registry in (square_gateway._breakers, square_gateway._histograms):
+            registry.clear()
+            self.addCleanup(registry.clear)
+        sleep = mock.patch('myApp.square_gateway.time.sleep')
+        self.sleep = sleep.start()
+        self.addCleanup(sleep.stop)
+        # Every failed attempt logs a warning; these tests fail attempts on purpose
+        logger = mock.patch('myApp.square_gateway.logger')
+        logger.start()
+        self.addCleanup(logger.stop)
+
+    def answering(self, *outcomes):
+        """
+        Stands in for the Square client, its create_payment giving `outcomes` in turn: an HTTP status, an
+        exception to raise, or a function to run first that returns one of those.
+        """
+        answers = iter(outcomes)
+
+        def create_payment(body):
+            outcome = next(answers)
+            outcome = outcome() if callable(outcome) else outcome
+            if isinstance(outcome, Exception):
+                raise outcome
+            return mock.Mock(status_code=outcome)
+
+        client = mock.Mock()
+        client.payments.create_payment.side_effect = create_payment
+        patcher = mock.patch('myApp.square_gateway.client_for', return_value=client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return client.payments.create_payment
+
+    def open_circuit(self):
+        self.answering(503, 503, 503)
+        for _ in range(3):
+            with self.assertRaises(square_gateway.SquareUnavailable):
+                square_gateway.call(self.endpoint, {})
+        breaker = square_gateway.breaker_for(self.endpoint)
+        self.assertEqual(breaker.state, 'open')
+        return breaker
+
+    def test_transient_failures_are_retried_with_the_same_key(self):
+        body = {'idempotency_key': 'k1', 'amount_money': {'amount': 1287, 'currency': 'USD'}}
+        create_payment = self.answering(503, requests.ConnectionError("reset"), 200)
+
+        self.assertEqual(square_gateway.call(self.endpoint, body).status_code, 200)
+        self.assertEqual([call.kwargs['body'] for call in create_payment.call_args_list], [body] * 3)
+        self.assertEqual(self.sleep.call_count, 2)
+        self.assertEqual(square_gateway.breaker_for(self.endpoint).state, 'closed')
+
+    def test_calls_without_an_idempotency_key_are_tried_once(self):
+        create_payment = self.answering(503)
+        with self.assertRaises(square_gateway.SquareUnavailable):
+            square_gateway.call(self.endpoint, {'amount_money': {'amount': 1287, 'currency': 'USD'}})
+        self.assertEqual(create_payment.call_count, 1)
+
+    def test_answers_are_not_retried(self):
+        # A decline is Square answering, not Square failing
+        create_payment = self.answering(400)
+        self.assertEqual(square_gateway.call(self.endpoint, {'idempotency_key': 'k1'}).status_code, 400)
+        self.assertEqual(create_payment.call_count, 1)
+
+    def test_retry_delay_is_full_jitter_up_to_the_cap(self):
+        with mock.patch('myApp.square_gateway.random.uniform', side_effect=lambda low, high: (low, high)):
+            self.assertEqual([square_gateway.retry_delay(attempt) for attempt in (1, 2, 3, 5)],
+                             [(0, 0.2), (0, 0.4), (0, 0.8), (0, 2.0)])
+        self.assertTrue(all(0 <= square_gateway.retry_delay(3) <= 0.8 for _ in range(100)))
+
+    @override_settings(SQUARE_ENDPOINT_TIMEOUTS={'cards.create_card': 3.0}, SQUARE_CALL_TIMEOUT=7.0)
+    def test_timeouts_are_per_endpoint(self):
+        self.assertEqual(square_gateway.endpoint_timeout('cards.create_card'), 3.0)
+        self.assertEqual(square_gateway.endpoint_timeout('payments.create_payment'), 15.0)
+        self.assertEqual(square_gateway.endpoint_timeout('refunds.refund_payment'), 7.0)
+        with mock.patch('myApp.square_gateway.client_for') as client_for:
+            client_for.return_value.payments.create_payment.return_value = mock.Mock(status_code=200)
+            square_gateway.call(self.endpoint, {})
+        client_for.assert_called_once_with(15.0)
+
+    def test_an_open_circuit_lets_one_trial_through(self):
+        breaker = self.open_circuit()
+        create_payment = self.answering(200)
+        with self.assertRaises(square_gateway.SquareUnavailable):
+            square_gateway.call(self.endpoint, {})
+        self.assertEqual(create_payment.call_count, 0)
+
+        breaker.opened_at -= 31
+        rejected = []
+
+        def concurrent_call():
+            # Another request arriving while the trial is in flight
+            try:
+                square_gateway.call(self.endpoint, {})
+            except square_gateway.SquareUnavailable:
+                rejected.append(True)
+
+        def trial():
+            thread = threading.Thread(target=concurrent_call)
+            thread.start()
+            thread.join()
+            return 200
+
+        create_payment = self.answering(trial)
+        self.assertEqual(square_gateway.call(self.endpoint, {}).status_code, 200)
+        self.assertEqual((rejected, create_payment.call_count, breaker.state), ([True], 1, 'closed'))
+
+    def test_an_unexpected_error_in_a_trial_frees_it(self):
+        breaker = self.open_circuit()
+        breaker.opened_at -= 31
+        self.answering(ValueError("bad body"), 200)
+        with self.assertRaises(ValueError):
+            square_gateway.call(self.endpoint, {})
+        self.assertEqual(square_gateway.call(self.endpoint, {}).status_code, 200)
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_latency_is_counted_per_attempt(self):
+        histogram = square_gateway.LatencyHistogram()
+        for elapsed_ms in (10, 25, 30, 20000):
+            histogram.observe(elapsed_ms)
+        snapshot = histogram.snapshot()
+        self.assertEqual((snapshot['count'], snapshot['mean_ms']), (4, 20065 / 4))
+        self.assertEqual((snapshot['buckets']['le_25'], snapshot['buckets']['le_50'], snapshot['buckets']['inf']), (2, 1, 1))
+
+        self.answering(503, 200)
+        square_gateway.call(self.endpoint, {'idempotency_key': 'k1'})
+        self.assertEqual(square_gateway.metrics()[self.endpoint]['latency']['count'], 2)
+
+
+@override_settings(ALLOWED_HOSTS=['*'], CHECKOUT_MODE='inline')
+class AsyncCheckoutTests(TransactionTestCase):
+    # The async view runs the checkout on another thread, whose connection can't see a TestCase transaction
+
+    def setUp(self):
+        cache.clear()
+
+    async def test_async_view_runs_the_shared_checkout(self):
+        user = await User.objects.acreate(username=CHECKOUT['email'], email=CHECKOUT['email'])
+        await BotUserPaymentInfo.objects.acreate(user=user, customer_id='CUST0', card_id='CARD0')
+
+        with fake_square() as square:
+            response = await self.async_client.post(
+                '/process-payment-async/', CHECKOUT, content_type='application/json'
+            )
+
+        self.assertEqual(response.json(), {'success': True})
+        # A returning buyer goes straight to the payment, and the payment id is kept for webhooks
+        self.assertEqual([call.args[0] for call in square.call_args_list], ['payments.create_payment'])
+        self.assertTrue(await BotBotTransaction.objects.filter(user=user, square_payment_id='PAY1').aexists())
+
+
+class CompiledEmailTests(TestCase):
+    fields = {'user_email': "<b>o'brien&co</b>@example.com", 'random_password': 'p<w>d'}
+
+    def setUp(self):
+        emails._compiled.clear()
+        self.addCleanup(emails._compiled.clear)
+
+    def test_rendering_matches_the_template_engine(self):
+        message = emails.build_email('welcome_email', 'buyer@example.com', self.fields)
+        [(html, mimetype)] = message.alternatives
+
+        self.assertEqual(message.to, ['buyer@example.com'])
+        self.assertEqual(message.subject, render_to_string('myApp/welcome_email_subject.txt').strip())
+        self.assertEqual(message.body, render_to_string('myApp/welcome_email.txt', self.fields))
+        self.assertEqual(html, render_to_string('myApp/welcome_email.html', self.fields))
+        self.assertEqual(mimetype, 'text/html')
+
+    def test_fields_are_escaped_in_html_only(self):
+        message = emails.build_email('welcome_email', 'buyer@example.com', self.fields)
+        [(html, _)] = message.alternatives
+
+        self.assertIn("Dear <b>o'brien&co</b>@example.com,", message.body)
+        self.assertIn('temporary password: p<w>d', message.body)
+        self.assertIn('Hello &lt;b&gt;o&#x27;brien&amp;co&lt;/b&gt;@example.com,', html)
+        self.assertIn('</strong> p&lt;w&gt;d', html)
+        self.assertNotIn(emails.FIELD_MARK, message.body + html + message.subject)
+
+    def test_templates_are_compiled_once_per_shared_context(self):
+        recipients = [
+            (f'user{n}@example.com', {'user_email': f'user{n}@example.com', 'random_password': str(n)}) for n in range(3)
+        ]
+        with mock.patch('myApp.emails.get_template', wraps=emails.get_template) as get_template:
+            messages = list(emails.build_bulk_emails('welcome_email', recipients, ['user_email', 'random_password']))
+            list(emails.build_bulk_emails('welcome_email', recipients, ['random_password', 'user_email']))
+            self.assertEqual(get_template.call_count, 3)
+
+            emails.compiled_email('welcome_email', ['user_email', 'random_password'], {'site': 'other'})
+            self.assertEqual(get_template.call_count, 6)
+
+        self.assertEqual([message.to for message in messages], [[to] for to, _ in recipients])
+        self.assertIn('temporary password: 2', messages[2].body)
+
+
+@override_settings(EMAIL_DELIVERY_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class OutboxDeliveryTests(TestCase):
+    def test_bodies_are_blanked_once_sent_and_old_rows_purged(self):
+        row = EmailOutbox.objects.create(
+            to_email='buyer@example.com', from_email='hello@iriseupacademy.com', subject='Welcome',
+            text_body='Your password is hunter22', html_body='<p>Your password is hunter22</p>',
+        )
+        self.assertEqual(deliver_outbox_batch(), (1, 0))
+        self.assertEqual(mail.outbox[0].body, 'Your password is hunter22')
+        row.refresh_from_db()
+        self.assertEqual((row.status, row.text_body, row.html_body), ('sent', '', None))
+
+        self.assertEqual(purge_outbox(timedelta(days=30)), 0)
+        EmailOutbox.objects.filter(pk=row.pk).update(next_attempt_at=timezone.now() - timedelta(days=31))
+        self.assertEqual(purge_outbox(timedelta(days=30)), 1)
+
+
+class RenewalTests(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+
+    def subscribe(self, username, plan='4-week', **fields):
+        user = User.objects.create(username=username)
+        BotUserPaymentInfo.objects.create(user=user, customer_id=f'CUST-{username}', card_id=f'CARD-{username}')
+        return BotSubscription.objects.create(
+            user=user, selected_plan=plan, expiration_date=self.now, next_billing_date=self.now, **fields
+        )
+
+    def test_declines_stop_after_the_cap(self):
+        subscription = self.subscribe('declined@example.com')
+        declined = mock.Mock(is_error=lambda: True, errors=[{'code': 'CARD_DECLINED'}])
+        with mock.patch('myApp.square_gateway.call', return_value=declined) as square:
+            for day in range(MAX_DECLINED_RENEWALS + 2):
+                run_renewals(now=self.now + timedelta(days=day, hours=1))
+
+        self.assertEqual(square.call_count, MAX_DECLINED_RENEWALS)
+        subscription.refresh_from_db()
+        self.assertEqual((subscription.is_active, subscription.next_billing_date), (False, None))
+        self.assertEqual(
+            BotBotTransaction.objects.filter(status='error', is_renewal=True).count(), MAX_DECLINED_RENEWALS
+        )
+
+    def test_the_expiry_sweep_leaves_renewals_to_billing(self):
+        renewing = self.subscribe('renewing@example.com')
+        declining = self.subscribe('declining@example.com')
+        declined = mock.Mock(is_error=lambda: True, errors=[{'code': 'CARD_DECLINED'}])
+
+        def square(endpoint, body):
+            return declined if body['source_id'] == 'CARD-declining@example.com' else square_response(payment={'id': 'PAY1'})
+
+        with mock.patch('myApp.square_gateway.call', side_effect=square) as charges:
+            # The sweep runs first each day, with both subscriptions past their expiration_date
+            for day in range(MAX_DECLINED_RENEWALS + 2):
+                now = self.now + timedelta(days=day, hours=1)
+                self.assertEqual(sweep_expired(now=now), 0)
+                run_renewals(now=now)
+
+        self.assertEqual(
+            [call.args[1]['source_id'] for call in charges.call_args_list].count('CARD-declining@example.com'),
+            MAX_DECLINED_RENEWALS,
+        )
+        renewing.refresh_from_db()
+        declining.refresh_from_db()
+        self.assertTrue(renewing.is_active)
+        self.assertEqual(renewing.next_billing_date, self.now + timedelta(weeks=4))
+        self.assertEqual((declining.is_active, declining.next_billing_date), (False, None))
+
+    def test_only_active_recurring_subscriptions_are_charged(self):
+        self.subscribe('inactive@example.com', is_active=False)
+        lifetime = self.subscribe('lifetime@example.com', plan='lifetime')
+        renewing = self.subscribe('renewing@example.com')
+        with fake_square() as square:
+            counts = run_renewals(now=self.now + timedelta(hours=1))
+
+        self.assertEqual(counts, {'success': 1, 'declined': 0, 'error': 0})
+        self.assertEqual(square.call_args.args[1]['customer_id'], 'CUST-renewing@example.com')
+        lifetime.refresh_from_db()
+        renewing.refresh_from_db()
+        self.assertIsNone(lifetime.next_billing_date)
+        self.assertEqual(renewing.next_billing_date, self.now + timedelta(weeks=4))
+
+
+class ExpiryReminderTests(TestCase):
+    def test_only_subscriptions_that_will_not_renew_are_reminded(self):
+        expires = timezone.now() + timedelta(days=2)
+        for username, next_billing_date in [('renews@example.com', expires), ('lapses@example.com', None)]:
+            user = User.objects.create(username=username, email=username)
+            BotSubscription.objects.create(
+                user=user, selected_plan='4-week', expiration_date=expires, next_billing_date=next_billing_date
+            )
+
+        self.assertEqual(sweep_expiring(), 1)
+        self.assertEqual([message.to for message in mail.outbox], [['lapses@example.com']])
+        self.assertEqual(sweep_expiring(), 0)
+
+    def test_only_subscriptions_that_will_not_renew_are_expired(self):
+        expired = timezone.now() - timedelta(hours=1)
+        for username, next_billing_date in [('renews@example.com', expired), ('lapses@example.com', None)]:
+            user = User.objects.create(username=username, email=username)
+            BotSubscription.objects.create(
+                user=user, selected_plan='4-week', expiration_date=expired, next_billing_date=next_billing_date
+            )
+
+        receiver = mock.Mock()
+        subscription_expired.connect(receiver)
+        self.addCleanup(subscription_expired.disconnect, receiver)
+        self.assertEqual(sweep_expired(), 1)
+        self.assertEqual(receiver.call_args.kwargs['user_ids'], [User.objects.get(username='lapses@example.com').pk])
+        self.assertEqual(
+            dict(BotSubscription.objects.values_list('user__username', 'is_active')),
+            {'renews@example.com': True, 'lapses@example.com': False},
+        )
+        self.assertEqual(sweep_expired(), 0)
+
+    def test_a_failed_reminder_leaves_the_subscription_unmarked(self):
+        user = User.objects.create(username='lapses@example.com', email='lapses@example.com')
+        BotSubscription.objects.create(user=user, selected_plan='lifetime', expiration_date=timezone.now() + timedelta(days=1))
+        with mock.patch('myApp.signals.send_bulk_emails', side_effect=RuntimeError("SMTP down")):
+            with self.assertRaises(RuntimeError):
+                sweep_expiring()
+        self.assertFalse(BotSubscription.objects.filter(expiry_reminder_sent_at__isnull=False).exists())
+
+
+class GrantAccessTests(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create_user(username=f'user{n}') for n in range(5)]
+
+    def test_many_users_are_granted_in_batched_upserts(self):
+        with CaptureQueriesContext(connection) as queries:
+            # Instances and bare ids both work
+            granted = grant_service_access_bulk(self.users[:3] + [user.pk for user in self.users[3:]], '4-week', batch_size=2)
+
+        self.assertEqual(granted, 5)
+        self.assertEqual(len(queries), 3)
+        self.assertTrue(all('ON CONFLICT' in query['sql'] for query in queries))
+        self.assertEqual(
+            set(BotSubscription.objects.filter(is_active=True, selected_plan='4-week').values_list('user_id', flat=True)),
+            {user.pk for user in self.users},
+        )
+
+    def test_a_repeated_grant_refreshes_the_row(self):
+        grant_service_access_bulk(self.users, '4-week')
+        BotSubscription.objects.update(is_active=False, expiry_reminder_sent_at=timezone.now())
+
+        self.assertEqual(grant_service_access_bulk(self.users, 'lifetime'), 5)
+
+        self.assertEqual(BotSubscription.objects.count(), 5)
+        self.assertEqual(
+            set(BotSubscription.objects.values_list('selected_plan', 'expiration_date', 'is_active', 'expiry_reminder_sent_at')),
+            {('lifetime', None, True, None)},
+        )
+
+
+@override_settings(ALLOWED_HOSTS=['*'])
+class SessionWriteTests(TestCase):
+    def setUp(self):
+        store = import_module(settings.SESSION_ENGINE).SessionStore
+        save = mock.patch.object(store, 'save', autospec=True, side_effect=store.save)
+        self.save = save.start()
+        self.addCleanup(save.stop)
+
+    def saves(self, path, data, **kwargs):
+        self.save.reset_mock()
+        self.client.post(path, data, **kwargs)
+        return self.save.call_count
+
+    def test_resubmitting_a_plan_leaves_the_session_alone(self):
+        def select(plan):
+            return self.saves('/set-selected-plan/', {'plan': plan}, content_type='application/json')
+
+        select('4-week')
+        self.assertEqual(select('4-week'), 0)
+        self.assertEqual(select('12-week'), 1)
+        self.assertEqual(self.client.session['selected_plan'], '12-week')
+
+    def test_only_changed_answers_mark_the_session_modified(self):
+        answers = {'gender': 'female', 'special_goal': 'focus', 'main_goal': 'career'}
+        stored = import_module(settings.SESSION_ENGINE).SessionStore()
+        self.assertTrue(update_session(stored, **answers))
+        stored.save()
+
+        def resubmit(**values):
+            session = import_module(settings.SESSION_ENGINE).SessionStore(stored.session_key)
+            return update_session(session, **values), session.modified
+
+        self.assertEqual(resubmit(**answers), (False, False))
+        # A blank answer keeps the stored one rather than clearing it
+        self.assertEqual(resubmit(**{**answers, 'gender': ''}), (False, False))
+        self.assertEqual(resubmit(**{**answers, 'main_goal': 'health'}), (True, True))
+
+
+class PurgeSessionsTests(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        for n in range(5):
+            Session.objects.create(session_key=f'expired{n}', session_data='', expire_date=now - timedelta(days=n + 1))
+        Session.objects.create(session_key='live', session_data='', expire_date=now + timedelta(days=1))
+
+    def purge(self, **options):
+        out = io.StringIO()
+        call_command('purge_sessions', chunk_size=2, pause=0, stdout=out, **options)
+        return out.getvalue()
+
+    def test_expired_sessions_are_deleted_in_chunks(self):
+        output = self.purge()
+        self.assertEqual(list(Session.objects.values_list('session_key', flat=True)), ['live'])
+        self.assertEqual(re.findall(r'^deleted (\d+) sessions$', output, re.MULTILINE), ['2', '4', '5'])
+        self.assertIn('done: deleted 5 sessions', output)
+
+    def test_all_deletes_live_sessions_too(self):
+        self.assertIn('done: deleted 6 sessions', self.purge(all=True))
+        self.assertFalse(Session.objects.exists())
+
+
+class CheckoutWriteTests(TestCase):
+    def checkout(self, payment_id, card_id='CARD1', plan='4-week'):
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as queries:
+            user = complete_checkout(
+                'buyer@example.com', plan, determine_amount_based_on_plan(plan), 'CUST1', card_id, payment_id=payment_id
+            )
+        return user, [query['sql'] for query in queries]
+
+    def test_a_returning_buyer_is_written_with_upserts(self):
+        user, _ = self.checkout('PAY1')
+        _, queries = self.checkout('PAY2', card_id='CARD2', plan='12-week')
+
+        self.assertEqual(BotUserPaymentInfo.objects.get(user=user).card_id, 'CARD2')
+        subscription = BotSubscription.objects.get(user=user)
+        self.assertEqual(subscription.selected_plan, '12-week')
+        self.assertEqual(BotBotTransaction.objects.filter(user=user).count(), 2)
+        # Card and subscription are each one INSERT ... ON CONFLICT, never read first
+        for table in ('myApp_botuserpaymentinfo', 'myApp_botsubscription'):
+            touching = [sql for sql in queries if f'"{table}"' in sql]
+            self.assertEqual(len(touching), 1, touching)
+            self.assertIn('ON CONFLICT', touching[0])
+
+    def test_a_failure_partway_leaves_nothing_behind(self):
+        with mock.patch.object(BotBotTransaction.objects, 'create', side_effect=DatabaseError("disk I/O error")):
+            with self.assertRaises(DatabaseError):
+                self.checkout('PAY1')
+
+        # The account, its card, its subscription and its welcome email went with the failed transaction
+        self.assertFalse(User.objects.filter(username='buyer@example.com').exists())
+        self.assertFalse(BotUserPaymentInfo.objects.exists())
+        self.assertFalse(BotSubscription.objects.exists())
+        self.assertFalse(EmailOutbox.objects.exists())
+
+        user, _ = self.checkout('PAY1')
+        self.assertEqual(BotBotTransaction.objects.get().user, user)
+
+
+@override_settings(ALLOWED_HOSTS=['*'], CHECKOUT_MODE='inline')
+class ReplayedPaymentTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_a_payment_square_returns_again_is_recorded_once(self):
+        with fake_square(payment_id='PAY1'):
+            # Different client keys, so the second request misses the replay cache and reaches Square again
+            responses = [
+                self.client.post('/process-payment/', {**CHECKOUT, 'idempotency_key': key}, content_type='application/json')
+                for key in ('first', 'second')
+            ]
+
+        self.assertEqual([response.status_code for response in responses], [200, 200])
+        self.assertEqual(list(BotBotTransaction.objects.values_list('status', 'square_payment_id')), [('success', 'PAY1')])
+
+    def test_a_double_submit_is_charged_once(self):
+        with fake_square(payment_id='PAY1') as square:
+            first, second = [
+                self.client.post('/process-payment/', CHECKOUT, content_type='application/json') for _ in range(2)
+            ]
+
+        self.assertEqual(second.content, first.content)
+        self.assertNotIn('Idempotent-Replayed', first)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual([call.args[0] for call in square.call_args_list].count('payments.create_payment'), 1)
+        self.assertEqual(BotBotTransaction.objects.count(), 1)
+
+    def test_client_keys_are_scoped_to_the_buyer(self):
+        responses = []
+        for email, n in (('buyer@example.com', 1), ('other@example.com', 2)):
+            with fake_square(payment_id=f'PAY{n}', customer_id=f'CUST{n}', card_id=f'CARD{n}'):
+                responses.append(self.client.post(
+                    '/process-payment/', {**CHECKOUT, 'email': email, 'idempotency_key': 'same'},
+                    content_type='application/json',
+                ))
+
+        self.assertNotIn('Idempotent-Replayed', responses[1])
+        self.assertEqual(
+            set(BotBotTransaction.objects.values_list('user__email', 'square_payment_id')),
+            {('buyer@example.com', 'PAY1'), ('other@example.com', 'PAY2')},
+        )
+
+    @override_settings(SQUARE_WEBHOOK_SIGNATURE_KEY='whsec', SQUARE_WEBHOOK_URL='https://example.com/square-webhook/')
+    def test_a_refund_webhook_reaches_the_checkout_transaction(self):
+        with fake_square(payment_id='PAY1'):
+            self.client.post('/process-payment/', CHECKOUT, content_type='application/json')
+        # Square follows a completed refund with payment.updated carrying the refunded amount
+        body = json.dumps({
+            'type': 'payment.updated',
+            'event_id': 'e1',
+            'created_at': timezone.now().isoformat(),
+            'data': {'object': {'payment': {
+                'id': 'PAY1', 'status': 'COMPLETED', 'total_money': {'amount': 999}, 'refunded_money': {'amount': 999},
+            }}},
+        })
+        signature = base64.b64encode(
+            hmac.new(b'whsec', f'https://example.com/square-webhook/{body}'.encode(), hashlib.sha256).digest()
+        ).decode()
+
+        response = self.client.post(
+            '/square-webhook/', body, content_type='application/json', HTTP_X_SQUARE_HMACSHA256_SIGNATURE=signature
+        )
+        self.assertEqual(response.status_code, 200)
+        reconcile_batch()
+        self.assertEqual(BotBotTransaction.objects.get(square_payment_id='PAY1').status, 'refunded')
+        subscription = BotSubscription.objects.get(user__email=CHECKOUT['email'])
+        self.assertIsNone(subscription.next_billing_date)
+        self.assertTrue(subscription.has_expired())
+
+
+@override_settings(ALLOWED_HOSTS=['*'], CHECKOUT_MODE='inline')
+class ReturningBuyerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username=CHECKOUT['email'], email=CHECKOUT['email'])
+
+    def store_card(self):
+        BotUserPaymentInfo.objects.create(user=self.user, customer_id='CUST9', card_id='CARD9')
+        complete_checkout(self.user.email, '4-week', 3795, 'CUST9', 'CARD9', user=self.user, payment_id='PAY0')
+
+    def repurchase(self, **data):
+        return self.client.post('/repurchase/', data, content_type='application/json')
+
+    def payments(self, square):
+        return [call.args[1] for call in square.call_args_list if call.args[0] == 'payments.create_payment']
+
+    def test_a_checkout_reuses_the_stored_customer_and_card(self):
+        self.store_card()
+        with fake_square(payment_id='PAY1') as square:
+            response = self.client.post('/process-payment/', CHECKOUT, content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([call.args[0] for call in square.call_args_list], ['payments.create_payment'])
+        self.assertEqual(self.payments(square)[0]['customer_id'], 'CUST9')
+        self.assertEqual(BotUserPaymentInfo.objects.get(user=self.user).card_id, 'CARD9')
+
+    def test_a_returning_buyer_without_a_stored_card_gets_one(self):
+        with fake_square(payment_id='PAY1') as square:
+            response = self.client.post('/process-payment/', CHECKOUT, content_type='application/json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [call.args[0] for call in square.call_args_list],
+            ['customers.create_customer', 'payments.create_payment', 'cards.create_card'],
+        )
+        self.assertEqual(User.objects.count(), 1)
+        info = BotUserPaymentInfo.objects.get(user=self.user)
+        self.assertEqual((info.customer_id, info.card_id), ('CUST1', 'CARD1'))
+
+    def test_repurchase_charges_the_card_on_file(self):
+        self.store_card()
+        self.client.force_login(self.user)
+        with fake_square(payment_id='PAY1') as square:
+            response = self.repurchase(plan='12-week')
+
+        self.assertEqual(response.json(), {'success': True, 'plan': '12-week'})
+        [payment] = self.payments(square)
+        self.assertEqual((payment['source_id'], payment['customer_id']), ('CARD9', 'CUST9'))
+        self.assertNotIn('verification_token', payment)
+        self.assertEqual(BotSubscription.objects.get(user=self.user).selected_plan, '12-week')
+
+    def test_repeats_inside_the_replay_window_are_charged_once(self):
+        self.store_card()
+        self.client.force_login(self.user)
+        with fake_square(payment_id='PAY1') as square:
+            first, second = self.repurchase(), self.repurchase()
+        self.assertEqual(len(self.payments(square)), 1)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+
+        # Once the last purchase is older than the window, the next one is a new purchase with a new key
+        BotBotTransaction.objects.update(BotTransaction_date=timezone.now() - timedelta(seconds=REPLAY_TIMEOUT + 1))
+        with fake_square(payment_id='PAY2') as square:
+            third = self.repurchase()
+        self.assertNotIn('Idempotent-Replayed', third)
+        self.assertEqual(len(self.payments(square)), 1)
+        self.assertEqual(BotBotTransaction.objects.filter(square_payment_id__in=['PAY1', 'PAY2']).count(), 2)
+
+    def test_client_keys_are_scoped_to_the_buyer(self):
+        other = User.objects.create_user(username='other@example.com', email='other@example.com')
+        for user, customer_id, card_id in ((self.user, 'CUST9', 'CARD9'), (other, 'CUST8', 'CARD8')):
+            BotUserPaymentInfo.objects.create(user=user, customer_id=customer_id, card_id=card_id)
+        charged = []
+        for user, payment_id in ((self.user, 'PAY1'), (other, 'PAY2')):
+            self.client.force_login(user)
+            with fake_square(payment_id=payment_id) as square:
+                self.repurchase(plan='4-week', idempotency_key='same')
+            charged += [payment['customer_id'] for payment in self.payments(square)]
+        self.assertEqual(charged, ['CUST9', 'CUST8'])
+
+    def test_repurchase_needs_a_stored_card(self):
+        self.client.force_login(self.user)
+        with fake_square() as square:
+            response = self.repurchase(plan='4-week')
+        self.assertEqual(response.status_code, 400)
+        square.assert_not_called()
+
+
+@override_settings(ALLOWED_HOSTS=['*'], CHECKOUT_MODE='queued')
+class QueuedCheckoutTests(TransactionTestCase):
+    # Jobs run on a thread pool, whose connections can't see a TestCase transaction
+
+    def setUp(self):
+        cache.clear()
+
+    def test_a_queued_checkout_runs_once_and_reports_back(self):
+        response = self.client.post('/process-payment/', CHECKOUT, content_type='application/json')
+        self.assertEqual(response.status_code, 202)
+        status_url = response.json()['status_url']
+        self.assertEqual(self.client.get(status_url).json()['status'], 'queued')
+
+        with fake_square(payment_id='PAY1') as square:
+            self.assertEqual(process_checkout_batch(), {'succeeded': 1, 'failed': 0, 'queued': 0})
+            self.assertEqual(process_checkout_batch(), {'succeeded': 0, 'failed': 0, 'queued': 0})
+
+        self.assertEqual([call.args[0] for call in square.call_args_list].count('payments.create_payment'), 1)
+        self.assertEqual(self.client.get(status_url).json()['status'], 'succeeded')
+        self.assertEqual(CheckoutJob.objects.get().payload, {})
+        self.assertTrue(BotBotTransaction.objects.filter(user__email=CHECKOUT['email'], square_payment_id='PAY1').exists())
+
+
+@override_settings(ALLOWED_HOSTS=['*'])
+class ExportStreamingTests(TestCase):
+    async def test_export_streams_under_asgi(self):
+        staff = await User.objects.acreate(username='staff@example.com', is_staff=True)
+        buyer = await User.objects.acreate(username='buyer@example.com', email='buyer@example.com')
+        for payment_id in ('P1', 'P2'):
+            await BotBotTransaction.objects.acreate(
+                user=buyer, amount=3795, subscription_type='4-week', status='success', square_payment_id=payment_id
+            )
+        await self.async_client.aforce_login(staff)
+
+        response = await self.async_client.get('/export/transactions/?gzip=0')
+
+        # An async iterator is sent a block at a time; a sync one would have been read into a list first
+        self.assertTrue(response.is_async)
+        body = b''.join([block async for block in response.streaming_content]).decode()
+        lines = body.splitlines()
+        self.assertEqual(lines[0].split(',')[:2], ['id', 'date'])
+        self.assertEqual([line.split(',')[-1] for line in lines[1:]], ['P1', 'P2'])
+
+    def test_access_slices_follow_the_subscription(self):
+        now = timezone.now()
+        for username, expiration_date, is_active in [
+            ('current@example.com', now + timedelta(days=3), True),
+            ('lapsed@example.com', now - timedelta(days=3), False),
+        ]:
+            user = User.objects.create(username=username)
+            BotSubscription.objects.create(
+                user=user, selected_plan='4-week', expiration_date=expiration_date, is_active=is_active
+            )
+            # Legacy rows never had an expiry written, which read as "never expires"
+            AIUserAccess.objects.create(user=user, progress=10)
+
+        def users(status):
+            return list(access_queryset(status=status).values_list('user__username', flat=True))
+
+        self.assertEqual(users('active'), ['current@example.com'])
+        self.assertEqual(users('expired'), ['lapsed@example.com'])
+        self.assertEqual(list(access_queryset(start=now.date() - timedelta(days=3), end=now.date() - timedelta(days=3))
+                              .values_list('user__username', flat=True)), ['lapsed@example.com'])
@@ -1,10 +1,35 @@
+from django.contrib.auth import views as auth_views
 from django.urls import path
 from . import views
+from .emails import CachedPasswordResetForm
 
 urlpatterns = [
     path('', views.personalized_plan, name='personalized_plan'),
     path('set-selected-plan/', views.setSelectedPlanInSession, name='set_selected_plan'),
     path('process-payment/', views.process_payment, name='process_payment'),
+    path('process-payment-async/', views.process_payment_async, name='process_payment_async'),
+    path('checkout-status/<uuid:checkout_id>/', views.checkout_status, name='checkout_status'),
+    path('repurchase/', views.repurchase, name='repurchase'),
     path('grant-service-access/', views.grant_service_access, name='grant_service_access'),
     path('course-menu/', views.coursemenu, name='course_menu'),
+    path('square-metrics/', views.square_metrics, name='square_metrics'),
+    path('revenue-report/', views.revenue_report_view, name='revenue_report'),
+    path('export/<str:kind>/', views.export_records, name='export_records'),
+    path('renewal-forecast/', views.renewal_forecast, name='renewal_forecast'),
+    path('square-webhook/', views.square_webhook, name='square_webhook'),
+
+    # Password reset; the emails are queued in the outbox like every other message
+    path('forgot-password/', auth_views.PasswordResetView.as_view(
+        template_name='myApp/forgot_password.html',
+        form_class=CachedPasswordResetForm,
+    ), name='password_reset'),
+    path('forgot-password/done/', auth_views.PasswordResetDoneView.as_view(
+        template_name='myApp/password_reset_done.html',
+    ), name='password_reset_done'),
+    path('reset/<uidb64>/<token>/', auth_views.PasswordResetConfirmView.as_view(
+        template_name='myApp/password_reset_confirm.html',
+    ), name='password_reset_confirm'),
+    path('reset/done/', auth_views.PasswordResetCompleteView.as_view(
+        template_name='myApp/password_reset_complete.html',
+    ), name='password_reset_complete'),
 ]
@@ -6,22 +6,30 @@ from .models import AIUserAccess
 from django.shortcuts import render, get_object_or_404, redirect
 from .models import BotService, AIUserAccess
 from django.contrib.auth.decorators import login_required
-from square.client import Client
+
+
+def update_session(session, **values):
+    """
+    Stores the given non-empty values in the session, touching it only for values that actually changed,
+    so re-submitting a quiz step with the same answers doesn't rewrite the session. Returns whether anything changed.
+    """
+    changed = False
+    for key, value in values.items():
+        if value and session.get(key) != value:
+            session[key] = value
+            changed = True
+    return changed
 
 
 def personalized_plan(request):
     if request.method == 'POST':
-        gender = request.POST.get('gender')
-        special_goal = request.POST.get('special_goal')
-        main_goal = request.POST.get('main_goal')
-        
         # Store data in the session
-        if gender:
-            request.session['gender'] = gender
-        if special_goal:
-            request.session['special_goal'] = special_goal
-        if main_goal:
-            request.session['main_goal'] = main_goal
+        update_session(
+            request.session,
+            gender=request.POST.get('gender'),
+            special_goal=request.POST.get('special_goal'),
+            main_goal=request.POST.get('main_goal'),
+        )
         
         return redirect('next_view_name')  # Replace 'next_view_name' with the actual view name you want to redirect to
 
@@ -38,21 +46,6 @@ def personalized_plan(request):
 
     return render(request, 'myApp/personalized_plan.html', context)
 
-'''    
-# Initialize the Square Client
-square_client = Client(
-    access_token=settings.SQUARE_ACCESS_TOKEN,
-    environment='production',
-)
-'''
-
-# Initialize the Square Client
-square_client = Client(
-    access_token=settings.SQUARE_ACCESS_TOKEN,
-    environment='sandbox',  # Change 'production' to 'sandbox' for testing
-)
-
-
 import json
 import logging
 from django.http import JsonResponse
@@ -71,7 +64,7 @@ def setSelectedPlanInSession(request):
                 logger.error(f"Invalid plan selected: {selected_plan}")
                 return JsonResponse({'success': False, 'error': 'Invalid plan selected.'})
 
-            request.session['selected_plan'] = selected_plan
+            update_session(request.session, selected_plan=selected_plan)
             return JsonResponse({'success': True})
         except Exception as e:
             logger.error("Error in setSelectedPlanInSession:", exc_info=True)
@@ -98,204 +91,92 @@ def grant_BotService_access(user, selected_plan):
     """
     This function grants the user access to all BotServices and sets an expiration date based on the selected plan.
     """
-    # Get all BotServices available in the BotService menu
-    BotServices = BotService.objects.all()
-
-    # Set a default expiration date (optional)
-    expiration_date = None
-
-    # Determine expiration date based on selected plan
-    if selected_plan == '1-week':
-        expiration_date = timezone.now() + timedelta(weeks=1)
-    elif selected_plan == '4-week':
-        expiration_date = timezone.now() + timedelta(weeks=4)
-    elif selected_plan == '12-week':
-        expiration_date = timezone.now() + timedelta(weeks=12)
-    elif selected_plan == 'lifetime':
-        expiration_date = None 
-    else:
-        # Handle the case where the selected plan is not recognized
-        expiration_date = timezone.now() + timedelta(weeks=4)  # Default to 1 week if plan is unrecognized
-        # Optionally, log a warning or handle this situation differently
-        logger.warning(f"Unrecognized selected plan: {selected_plan}, defaulting to 4 week expiration.")
-
-    # Grant access to all BotServices with the determined expiration date
-    for BotService in BotServices:
-        AIUserAccess.objects.create(user=user, BotService=BotService, progress=0.0, expiration_date=expiration_date)
+    return grant_service_access(user, selected_plan)
 
-    return True
-
-from django.core.mail import EmailMultiAlternatives
+from .emails import build_email
 
 def send_welcomepassword_email(user_email, random_password):
     """
     Sends a personalized welcome email with HTML design to new users.
+    The message goes through EMAIL_BACKEND, i.e. into the outbox, so it commits with the caller's transaction.
     """
-    subject = 'Welcome to iRiseUp Academy – Your Account is Ready!'
-    from_email = 'hello@iriseupacademy.com'
-    to_email = [user_email]
-
-    # Plain text content for fallback
-    text_content = (
-        f"Dear {user_email},\n\n"
-        "Welcome to iRiseUp Academy! Your account has been successfully created.\n"
-        f"Here is your temporary password: {random_password}\n\n"
-        "Please log in to update your password and start your learning journey.\n\n"
-        "Best regards,\n"
-        "The iRiseUp Academy Team"
+    email = build_email(
+        'welcome_email',
+        user_email,
+        {'user_email': user_email, 'random_password': random_password},
+        from_email='hello@iriseupacademy.com',
     )
-
-    # HTML content (you can use your email design)
-    html_content = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="UTF-8">
-        <title>Welcome to iRiseUp Academy</title>
-        <style>
-            body {{
-                font-family: Arial, sans-serif;
-                color: #333;
-                line-height: 1.6;
-                margin: 0;
-                padding: 0;
-                background-color: #f4f4f4;
-            }}
-            .container {{
-                width: 100%;
-                max-width: 600px;
-                margin: 0 auto;
-                background-color: #ffffff;
-                border-radius: 8px;
-                box-shadow: 0 2px 8px rgba(0, 0, 0, 0.1);
-                overflow: hidden;
-            }}
-            .header {{
-                background-color: #5860F8;
-                color: #ffffff;
-                padding: 20px;
-                text-align: center;
-            }}
-            .header img {{
-                max-width: 120px;
-                margin-bottom: 10px;
-            }}
-            .header h1 {{
-                margin: 0;
-                font-size: 28px;
-                font-weight: bold;
-            }}
-            .content {{
-                padding: 30px 20px;
-                text-align: left;
-                background-color: #ffffff;
-            }}
-            .content p {{
-                font-size: 16px;
-                margin-bottom: 20px;
-            }}
-            .button {{
-                display: inline-block;
-                padding: 12px 25px;
-                color: #ffffff;
-                background-color: #5860F8;
-                text-decoration: none;
-                border-radius: 5px;
-                font-size: 16px;
-                margin-top: 20px;
-            }}
-            .button:hover {{
-                background-color: #4752c4;
-            }}
-            .footer {{
-                text-align: center;
-                padding: 20px;
-                background-color: #f4f4f4;
-                color: #888;
-                font-size: 12px;
-            }}
-            .footer p {{
-                margin: 0;
-            }}
-            .footer a {{
-                color: #5860F8;
-                text-decoration: none;
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <!-- Email Header -->
-            <div class="header">
-                <img src="https://www.iriseupacademy.com/static/myapp/images/resource/author-6.png" alt="iRiseUp Academy Logo">
-                <h1>Welcome to iRiseUp Academy, {user_email}!</h1>
-            </div>
-
-            <!-- Email Content -->
-            <div class="content">
-                <p>Hello {user_email},</p>
-                <p>Your account has been successfully created. Below is your temporary password:</p>
-                <p><strong>Temporary Password:</strong> {random_password}</p>
-                <p>Please log in and update your password for security.</p>
-                <a href="https://www.iriseupacademy.com/sign_in" class="button">Log In Now</a>
-                <p>Best regards,<br><strong>The iRiseUp Academy Team</strong></p>
-            </div>
-
-            <!-- Email Footer -->
-            <div class="footer">
-                <p>iRiseUp Academy, Columbus, Ohio, USA | <a href="https://iriseupacademy.com/unsubscribe">Unsubscribe</a></p>
-            </div>
-        </div>
-    </body>
-    </html>
-    """
-
-    # Create the email message with plain text and HTML alternatives
-    email = EmailMultiAlternatives(subject, text_content, from_email, to_email)
-    email.attach_alternative(html_content, "text/html")
     email.send()
 
 from django.utils import timezone
 from datetime import timedelta
+from itertools import islice
 import logging
-from .models import BotService, AIUserAccess
+from django.db import transaction
+from functools import partial
+from .models import BotService, AIUserAccess, BotSubscription
+from .entitlements import invalidate_entitlements
 
 logger = logging.getLogger(__name__)
 
+def grant_expiration_date(selected_plan):
+    """
+    Returns the access expiration date for a plan. Lifetime access never expires.
+    """
+    if selected_plan == 'lifetime':
+        return None
+
+    expiration_date, _ = compute_plan_dates(selected_plan)
+    if expiration_date is None:
+        # Handle unrecognized plans
+        logger.warning(f"Unrecognized selected plan: {selected_plan}, defaulting to 4-week expiration.")
+        expiration_date = timezone.now() + timedelta(weeks=4)
+    return expiration_date
+
+
 def grant_service_access(user, selected_plan):
     """
     Grants the user access to all bot services and sets an expiration date based on the selected plan.
     """
-    # Get all bot services available
-    services = BotService.objects.all()
+    grant_service_access_bulk([user], selected_plan)
+    return True
 
-    # Set a default expiration date (optional)
-    expiration_date = None
 
-    # Determine expiration date based on selected plan
-    if selected_plan == '1-week':
-        expiration_date = timezone.now() + timedelta(weeks=1)
-    elif selected_plan == '4-week':
-        expiration_date = timezone.now() + timedelta(weeks=4)
-    elif selected_plan == '12-week':
-        expiration_date = timezone.now() + timedelta(weeks=12)
-    elif selected_plan == 'lifetime':
-        expiration_date = None  # Lifetime access, no expiration
-    else:
-        # Handle unrecognized plans
-        expiration_date = timezone.now() + timedelta(weeks=4)  # Default to 4 weeks if unrecognized
-        logger.warning(f"Unrecognized selected plan: {selected_plan}, defaulting to 4-week expiration.")
+def grant_service_access_bulk(users, selected_plan, batch_size=1000):
+    """
+    Grants every user in `users` (User instances or ids) access to all bot services.
 
-    # Grant access to all bot services with the determined expiration date
-    for service in services:
-        AIUserAccess.objects.create(
-            user=user,
-            bot_service=service,
+    Access is one BotSubscription row per user, written with batched INSERT ... ON CONFLICT upserts, so a
+    repeated grant refreshes the plan and expiration date instead of duplicating rows, and services added
+    to the catalog later are covered without new rows. Returns the number of users granted.
+    """
+    expiration_date = grant_expiration_date(selected_plan)
+
+    rows = (
+        BotSubscription(
+            user_id=getattr(user, 'pk', user),
+            selected_plan=selected_plan,
             expiration_date=expiration_date,
-            progress=0.0
+            is_active=True,
+            expiry_reminder_sent_at=None,
         )
+        for user in users
+    )
 
-    return True
+    written = 0
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return written
+        BotSubscription.objects.bulk_create(
+            batch,
+            update_conflicts=True,
+            unique_fields=['user'],
+            update_fields=['selected_plan', 'expiration_date', 'is_active', 'expiry_reminder_sent_at', 'updated_at'],
+        )
+        # bulk_create skips post_save, so evict the cached entitlements ourselves, once the grant is visible
+        transaction.on_commit(partial(invalidate_entitlements, *[row.user_id for row in batch]))
+        written += len(batch)
 
 
 # Get an instance of a logger
@@ -308,7 +189,6 @@ from django.core.mail import send_mail
 import json
 import uuid
 import logging
-from square.client import Client
 from .models import User  # Adjust according to your user model
 from django.contrib.auth.models import User  # For User model
 from django.utils.crypto import get_random_string  # For generating random passwords
@@ -317,230 +197,650 @@ from .models import BotUserPaymentInfo, User, AIUserAccess
 
 logger = logging.getLogger(__name__)
 
-# Initialize Square client
-client = Client(
-    access_token=settings.SQUARE_ACCESS_TOKEN,
-    environment='production',  # Change to 'production' when you're ready
-)
-
 from django.utils.crypto import get_random_string
 from django.views.decorators.csrf import csrf_exempt
 from django.http import JsonResponse
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
 from django.utils import timezone
 import json
 import uuid
 import logging
 from datetime import timedelta
-from .models import BotService, AIUserAccess, BotBotTransaction, BotUserPaymentInfo
+from .models import BotService, AIUserAccess, BotBotTransaction, BotUserPaymentInfo, BotSubscription, CheckoutJob
+from django.http import HttpResponseNotModified
+from django.urls import reverse
+from . import square_gateway
+from .coalescing import checkout_request_key, coalesce, repurchase_request_key, square_idempotency_key, square_key
+from .square_gateway import SquareUnavailable
+from . import webhooks
+from square.utilities.webhooks_helper import is_valid_webhook_event_signature
 
 logger = logging.getLogger(__name__)
 
-@csrf_exempt
-def process_payment(request):
-    if request.method == "POST":
-        try:
-            data = json.loads(request.body)
-            card_token = data.get('source_id')
-            selected_plan = data.get('plan')
-            verification_token = data.get('verification_token')
-
-            # Ensure the correct email is being used from the user's current session
-            user_email = data.get('email')
-            if not user_email:
-                logger.error("Email is missing from form data. Cannot proceed with payment.")
-                return JsonResponse({"error": "Email is missing from session."}, status=400)
-
-            # Ensure the amount is valid based on the selected plan
-            amount = determine_amount_based_on_plan(selected_plan)
-            if amount <= 0:
-                return JsonResponse({"error": "Invalid plan selected."}, status=400)
-
-            # Step 1: Create a new customer or retrieve the existing one
-            customer_result = square_client.customers.create_customer(
-                body={
-                    "given_name": data.get('givenName'),
-                    "family_name": data.get('familyName'),
-                    "email_address": user_email,
-                }
+PAYMENT_PROVIDER_UNAVAILABLE = "Our payment provider is not responding. Please try again shortly."
+
+PAYMENT_ERROR_MESSAGES = {
+    'CARD_DECLINED': "Your card was declined. Please try another payment method.",
+    'INSUFFICIENT_FUNDS': "Insufficient funds. Please check your account balance.",
+    'INVALID_CARD': "Invalid card details. Please check and try again.",
+    'EXPIRED_CARD': "Your card has expired. Please use another card.",
+    'NETWORK_ERROR': "Network issue encountered. Please try again later.",
+    'FRAUD_REJECTED': "Payment rejected due to suspected fraud. Please contact your bank.",
+    'AUTHENTICATION_REQUIRED': "Additional authentication required. Please complete the verification."
+}
+
+
+def compute_plan_dates(selected_plan):
+    """
+    Returns the (expiration_date, next_billing_date) pair for a plan. Lifetime plans never expire or bill again.
+    """
+    weeks = {'1-week': 1, '4-week': 4, '12-week': 12}.get(selected_plan)
+    if weeks is None:
+        return None, None
+    expiration_date = timezone.now() + timedelta(weeks=weeks)
+    return expiration_date, expiration_date
+
+
+def payment_error_response(errors):
+    """
+    Maps Square payment error codes to the JSON error returned to the browser.
+    """
+    error_codes = [error['code'] for error in errors]
+    logger.error("Payment Error: %s", error_codes)
+    for code in error_codes:
+        if code in PAYMENT_ERROR_MESSAGES:
+            return JsonResponse({"error": PAYMENT_ERROR_MESSAGES[code]}, status=400)
+    return JsonResponse({"error": "Payment failed. Please try again."}, status=400)
+
+
+def record_failed_transaction(user_email, amount, selected_plan, error_logs):
+    """
+    Stores an error BotBotTransaction for the user, if we already know them.
+    """
+    user = User.objects.filter(email=user_email).first() if user_email else None
+    if user:
+        BotBotTransaction.objects.create(
+            user=user,
+            amount=amount,
+            subscription_type=selected_plan,
+            status='error',
+            error_logs=str(error_logs),
+            recurring=False
+        )
+
+
+def stored_payment_info(user_email):
+    """
+    The (customer_id, card_id) Square already holds for this buyer, or None for a first-time customer.
+    """
+    return (
+        BotUserPaymentInfo.objects.filter(user__username=user_email)
+        .values_list('customer_id', 'card_id')
+        .first()
+    )
+
+
+def complete_checkout(user_email, selected_plan, amount, customer_id, card_id, user=None, payment_id=None):
+    """
+    Persists a successful Square checkout: the user account, the card on file, the access row and the transaction.
+    Pass `user` when the buyer is already known (one-click repurchase) to skip the account lookup, and the Square
+    `payment_id` so that later webhooks (refunds, disputes) can find the transaction.
+
+    Everything is written in one transaction, so a checkout costs a single commit, and the card and subscription
+    are written with INSERT ... ON CONFLICT upserts rather than update_or_create's SELECT followed by a write.
+
+    Square answers a repeated call (a retried job, a duplicate that missed the replay cache) with the payment it
+    already made; a payment that is already recorded is a success and nothing is written again.
+    """
+    try:
+        return _complete_checkout(user_email, selected_plan, amount, customer_id, card_id, user, payment_id)
+    except IntegrityError:
+        # A concurrent checkout recorded the same payment between our check and our insert
+        recorded = recorded_payment(payment_id)
+        if recorded is None:
+            raise
+        return recorded.user
+
+
+def recorded_payment(payment_id):
+    if payment_id is None:
+        return None
+    return BotBotTransaction.objects.filter(square_payment_id=payment_id).select_related('user').first()
+
+
+def _complete_checkout(user_email, selected_plan, amount, customer_id, card_id, user, payment_id):
+    expiration_date, next_billing_date = compute_plan_dates(selected_plan)
+
+    with transaction.atomic():
+        recorded = recorded_payment(payment_id)
+        if recorded is not None:
+            logger.info("Payment %s was already recorded; not writing it again.", payment_id)
+            return recorded.user
+
+        # Step 4: Create or retrieve the user; a new account is inserted with its password already hashed
+        # (the callable default only runs the slow hasher when the account is actually created)
+        random_password = get_random_string(8)
+        created = False
+        if user is None:
+            user, created = User.objects.get_or_create(
+                username=user_email,
+                defaults={'email': user_email, 'password': lambda: make_password(random_password)}
+            )
+        if created:
+            # Queue the welcome email in the outbox alongside the new account
+            send_welcomepassword_email(user_email, random_password)
+
+        logger.info(f"User {user_email} processed for payment.")
+
+        # Step 6: Store the customer_id and card_id
+        BotUserPaymentInfo.objects.bulk_create(
+            [BotUserPaymentInfo(user=user, customer_id=customer_id, card_id=card_id)],
+            update_conflicts=True,
+            unique_fields=['user'],
+            update_fields=['customer_id', 'card_id'],
+        )
+
+        # Step 7: Upsert the user's subscription with the plan's expiration and billing dates
+        BotSubscription.objects.bulk_create(
+            [BotSubscription(
+                user=user,
+                selected_plan=selected_plan,
+                expiration_date=expiration_date,
+                next_billing_date=next_billing_date,
+                is_active=True,
+                expiry_reminder_sent_at=None,
+                declined_renewals=0,
+            )],
+            update_conflicts=True,
+            unique_fields=['user'],
+            update_fields=[
+                'selected_plan', 'expiration_date', 'next_billing_date', 'is_active', 'expiry_reminder_sent_at',
+                'declined_renewals', 'updated_at',
+            ],
+        )
+
+        # Step 9: Create a BotBotTransaction with a success status and recurring info
+        BotBotTransaction.objects.create(
+            user=user,
+            amount=amount,
+            subscription_type=selected_plan,
+            status='success',
+            recurring=selected_plan in ['1-week', '4-week', '12-week'],
+            next_billing_date=next_billing_date,
+            square_payment_id=payment_id,
+        )
+
+        # The user just bought or changed a plan; drop whatever access we had cached for them.
+        # bulk_create skips post_save, so this is done here, once the rows are visible to other requests.
+        transaction.on_commit(lambda: invalidate_entitlements(user.pk))
+
+    return user
+
+
+def customer_body(data, user_email, idempotency_key=None):
+    return {
+        "idempotency_key": idempotency_key or str(uuid.uuid4()),
+        "given_name": data.get('givenName'),
+        "family_name": data.get('familyName'),
+        "email_address": user_email,
+    }
+
+
+def payment_body(card_token, amount, verification_token, customer_id, idempotency_key=None):
+    body = {
+        "source_id": card_token,
+        "idempotency_key": idempotency_key or str(uuid.uuid4()),
+        "amount_money": {
+            "amount": amount,
+            "currency": "USD"
+        },
+        "autocomplete": True,
+        "customer_id": customer_id,
+    }
+    # Charges of a card on file carry no buyer verification
+    if verification_token:
+        body["verification_token"] = verification_token
+    return body
+
+
+def card_body(data, payment_id, verification_token, customer_id, idempotency_key=None):
+    return {
+        "idempotency_key": idempotency_key or str(uuid.uuid4()),
+        "source_id": payment_id,
+        "verification_token": verification_token,
+        "card": {
+            "cardholder_name": f"{data.get('givenName')} {data.get('familyName')}",
+            "customer_id": customer_id,
+        }
+    }
+
+
+def checkout_validation_error(data):
+    """
+    The error response for a checkout request that can't be processed, or None if it looks valid.
+    """
+    if not data.get('email'):
+        logger.error("Email is missing from form data. Cannot proceed with payment.")
+        return JsonResponse({"error": "Email is missing from session."}, status=400)
+    if determine_amount_based_on_plan(data.get('plan')) <= 0:
+        return JsonResponse({"error": "Invalid plan selected."}, status=400)
+    return None
+
+
+def run_checkout(data, checkout_key=None, on_step=None):
+    """
+    Runs a whole checkout for a process_payment request body: the Square calls followed by complete_checkout.
+    Returns the JsonResponse for the browser. Square idempotency keys are derived from `checkout_key`, so
+    running the same checkout again is safe; `on_step` is called with the name of each step as it starts.
+    """
+    on_step = on_step or (lambda step: None)
+    try:
+        card_token = data.get('source_id')
+        selected_plan = data.get('plan')
+        verification_token = data.get('verification_token')
+
+        # Ensure the email was sent and the amount is valid based on the selected plan
+        error = checkout_validation_error(data)
+        if error:
+            return error
+        user_email = data.get('email')
+        amount = determine_amount_based_on_plan(selected_plan)
+
+        # Returning customers already have a Square customer and a card on file: reuse both and go
+        # straight to the payment, instead of creating a duplicate customer and storing the card again
+        stored = stored_payment_info(user_email)
+
+        # Step 1: Create a new customer or retrieve the existing one
+        if stored:
+            customer_id, card_id = stored
+        else:
+            on_step('customer')
+            customer_result = square_gateway.call(
+                'customers.create_customer',
+                customer_body(data, user_email, square_idempotency_key(checkout_key, 'customer')),
             )
             if customer_result.is_error():
                 logger.error("Customer creation failed: %s", customer_result.errors)
-                user = User.objects.get(email=user_email)
-                BotBotTransaction.objects.create(
-                    user=user,
-                    amount=amount,
-                    subscription_type=selected_plan,
-                    status='error',
-                    error_logs=str(customer_result.errors),
-                    recurring=False
-                )
+                record_failed_transaction(user_email, amount, selected_plan, customer_result.errors)
                 return JsonResponse({"error": "Failed to create customer profile."}, status=400)
 
             customer_id = customer_result.body['customer']['id']
 
-            # Step 2: Make the payment request with the verification token and store the card on file
-            payment_result = square_client.payments.create_payment(
-                body={
-                    "source_id": card_token,
-                    "idempotency_key": str(uuid.uuid4()),
-                    "amount_money": {
-                        "amount": amount,
-                        "currency": "USD"
-                    },
-                    "verification_token": verification_token,
-                    "autocomplete": True,
-                    "customer_id": customer_id,
-                }
-            )
-            logger.info("Square API Payment Response: %s", payment_result)
-
-            if payment_result.is_error():
-                error_codes = [error['code'] for error in payment_result.errors]
-                logger.error("Payment Error: %s", error_codes)
-
-                # Handle various error codes with specific messages
-                error_messages = {
-                    'CARD_DECLINED': "Your card was declined. Please try another payment method.",
-                    'INSUFFICIENT_FUNDS': "Insufficient funds. Please check your account balance.",
-                    'INVALID_CARD': "Invalid card details. Please check and try again.",
-                    'EXPIRED_CARD': "Your card has expired. Please use another card.",
-                    'NETWORK_ERROR': "Network issue encountered. Please try again later.",
-                    'FRAUD_REJECTED': "Payment rejected due to suspected fraud. Please contact your bank.",
-                    'AUTHENTICATION_REQUIRED': "Additional authentication required. Please complete the verification."
-                }
-                for code in error_codes:
-                    if code in error_messages:
-                        return JsonResponse({"error": error_messages[code]}, status=400)
-                return JsonResponse({"error": "Payment failed. Please try again."}, status=400)
-
-            payment_id = payment_result.body['payment']['id']
-
-            # Step 3: Store the card on file for the customer
-            card_result = square_client.cards.create_card(
-                body={
-                    "idempotency_key": str(uuid.uuid4()),
-                    "source_id": payment_id,
-                    "verification_token": verification_token,
-                    "card": {
-                        "cardholder_name": f"{data.get('givenName')} {data.get('familyName')}",
-                        "customer_id": customer_id,
-                    }
-                }
+        # Step 2: Make the payment request with the verification token and store the card on file
+        on_step('payment')
+        payment_result = square_gateway.call(
+            'payments.create_payment',
+            payment_body(
+                card_token, amount, verification_token, customer_id, square_idempotency_key(checkout_key, 'payment')
+            ),
+        )
+        logger.info("Square API Payment Response: %s", payment_result)
+
+        if payment_result.is_error():
+            return payment_error_response(payment_result.errors)
+
+        payment_id = payment_result.body['payment']['id']
+
+        # Step 3: Store the card on file for a new customer
+        if not stored:
+            on_step('card')
+            card_result = square_gateway.call(
+                'cards.create_card',
+                card_body(data, payment_id, verification_token, customer_id, square_idempotency_key(checkout_key, 'card')),
             )
             if card_result.is_error():
                 logger.error("Card storage failed: %s", card_result.errors)
-                BotBotTransaction.objects.create(
-                    user=user,
-                    amount=amount,
-                    subscription_type=selected_plan,
-                    status='error',
-                    error_logs=str(card_result.errors),
-                    recurring=False
-                )
+                record_failed_transaction(user_email, amount, selected_plan, card_result.errors)
                 return JsonResponse({"error": "Failed to store card on file."}, status=400)
 
             card_id = card_result.body['card']['id']
 
-            # Step 4: Create or retrieve the user in the Django application
-            user, created = User.objects.get_or_create(
-                username=user_email,
-                defaults={'email': user_email}
-            )
+        # Steps 4-9: Persist the user, card on file, access and transaction
+        on_step('saving')
+        complete_checkout(user_email, selected_plan, amount, customer_id, card_id, payment_id=payment_id)
 
-            if created:
-                random_password = get_random_string(8)
-                user.set_password(random_password)
-                user.save()
+        return JsonResponse({"success": True})
 
-                # Send the welcome email
-                send_welcomepassword_email(user_email, random_password)
+    except SquareUnavailable as e:
+        logger.error("Square unavailable: %s", str(e))
+        record_failed_transaction(user_email, amount, selected_plan, e)
+        return JsonResponse({"error": PAYMENT_PROVIDER_UNAVAILABLE}, status=503)
 
-            logger.info(f"User {user_email} processed for payment.") 
+    except Exception as e:
+        logger.error("Unexpected error occurred: %s", str(e), exc_info=True)
+        if 'amount' in locals():
+            record_failed_transaction(user_email, amount, selected_plan, e)
+        return JsonResponse({"error": f"An unexpected error occurred: {str(e)}"}, status=500)
 
-            # Step 6: Store the customer_id and card_id in the database
-            BotUserPaymentInfo.objects.update_or_create(
-                user=user,
-                defaults={'customer_id': customer_id, 'card_id': card_id}
-            )
 
-            # Step 7: Set expiration and billing dates based on the selected plan
-            expiration_date = None
-            next_billing_date = None
-            if selected_plan == '1-week':
-                expiration_date = timezone.now() + timedelta(weeks=1)
-                next_billing_date = expiration_date
-            elif selected_plan == '4-week':
-                expiration_date = timezone.now() + timedelta(weeks=4)
-                next_billing_date = expiration_date
-            elif selected_plan == '12-week':
-                expiration_date = timezone.now() + timedelta(weeks=12)
-                next_billing_date = expiration_date
-            elif selected_plan == 'lifetime':
-                expiration_date = None
-                next_billing_date = None
-
-            # Update or create AIUserAccess for the plan
-            AIUserAccess.objects.update_or_create(
-                user=user,
-                defaults={
-                    'expiration_date': expiration_date,
-                    'selected_plan': selected_plan
-                }
-            )
+@csrf_exempt
+@coalesce(checkout_request_key)
+def process_payment(request):
+    """
+    Runs the checkout and answers with its outcome, or with CHECKOUT_MODE=queued validates it, queues it for
+    `manage.py process_checkouts` and answers 202 with a checkout_status URL to poll.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "Invalid request method."}, status=405)
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({"error": "Invalid request body."}, status=400)
+    return checkout_response(data, getattr(request, 'checkout_key', None))
 
-            # Step 9: Create a BotBotTransaction with a success status and recurring info
-            BotBotTransaction.objects.create(
-                user=user,
-                amount=amount,
-                subscription_type=selected_plan,
-                status='success',
-                recurring=selected_plan in ['1-week', '4-week', '12-week'],
-                next_billing_date=next_billing_date
-            )
 
-            return JsonResponse({"success": True})
+def checkout_response(data, checkout_key=None):
+    """
+    What process_payment answers for a request body: the outcome of the checkout, or with CHECKOUT_MODE=queued
+    a 202 for the job it was queued as.
+    """
+    if settings.CHECKOUT_MODE == 'queued':
+        error = checkout_validation_error(data)
+        if error:
+            return error
+        job = CheckoutJob.objects.create(email=data['email'], plan=data['plan'], payload=data)
+        return JsonResponse(
+            {"checkout_id": str(job.pk), "status_url": reverse('checkout_status', args=[job.pk])},
+            status=202,
+        )
+    return run_checkout(data, checkout_key)
 
-        except Exception as e:
-            logger.error("Unexpected error occurred: %s", str(e), exc_info=True)
-            user = User.objects.get(email=user_email) if 'user_email' in locals() else None
-            if user:
-                BotBotTransaction.objects.create(
-                    user=user,
-                    amount=amount,
-                    subscription_type=selected_plan,
-                    status='error',
-                    error_logs=str(e),
-                    recurring=False
-                )
-            return JsonResponse({"error": f"An unexpected error occurred: {str(e)}"}, status=500)
-
-    return JsonResponse({"error": "Invalid request method."}, status=405)
+
+def checkout_status(request, checkout_id):
+    """
+    Where a queued checkout is up to, for the browser to poll. Answers 304 while nothing has changed
+    since the ETag it sent.
+    """
+    job = (
+        CheckoutJob.objects.filter(pk=checkout_id)
+        .values('status', 'step', 'response_status', 'response_body', 'updated_at')
+        .first()
+    )
+    if job is None:
+        return JsonResponse({"error": "Unknown checkout."}, status=404)
+
+    etag = f'"{job["status"]}-{job["step"]}-{job["updated_at"].timestamp()}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponseNotModified()
+    else:
+        # A job waiting to be retried keeps its last answer to itself until it finishes
+        finished = job['status'] in ('succeeded', 'failed')
+        response = JsonResponse({
+            "checkout_id": str(checkout_id),
+            "status": job['status'],
+            "step": job['step'],
+            "result": job['response_body'] if finished else None,
+            "result_status": job['response_status'] if finished else None,
+        })
+    response['ETag'] = etag
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+
+
+def checkout_in_thread(data, checkout_key):
+    """
+    process_payment's checkout, for a worker thread outside the request cycle: that thread's connection is
+    released here, since request_finished only closes the connections of the thread it runs on.
+    """
+    try:
+        return checkout_response(data, checkout_key)
+    finally:
+        close_old_connections()
+
+
+@csrf_exempt
+@coalesce(checkout_request_key)
+async def process_payment_async(request):
+    """
+    process_payment for ASGI deployments: the same checkout and JSON responses, run in a worker thread of its
+    own, so the event loop never waits on Square's latency. Timeouts, retries and the circuit breaker are the
+    gateway's.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "Invalid request method."}, status=405)
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({"error": "Invalid request body."}, status=400)
+
+    return await sync_to_async(checkout_in_thread, thread_sensitive=False)(
+        data, getattr(request, 'checkout_key', None)
+    )
+
+
+@coalesce(repurchase_request_key)
+def repurchase(request):
+    """
+    One-click repurchase or upgrade for a signed-in customer: charges the card on file for the posted plan
+    (by default the current one) with a single Square call, then extends access like a checkout.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "Invalid request method."}, status=405)
+    if not request.user.is_authenticated:
+        return JsonResponse({"error": "Please sign in first."}, status=401)
+
+    user = request.user
+    try:
+        data = json.loads(request.body or b'{}')
+        payment_info = BotUserPaymentInfo.objects.filter(user=user).values_list('customer_id', 'card_id').first()
+        if payment_info is None:
+            return JsonResponse({"error": "No card on file."}, status=400)
+        customer_id, card_id = payment_info
+
+        selected_plan = data.get('plan') or (
+            BotSubscription.objects.filter(user=user).values_list('selected_plan', flat=True).first()
+        )
+        amount = determine_amount_based_on_plan(selected_plan)
+        if amount <= 0:
+            return JsonResponse({"error": "Invalid plan selected."}, status=400)
+
+        payment_result = square_gateway.call(
+            'payments.create_payment',
+            payment_body(card_id, amount, None, customer_id, square_key(request, 'payment')),
+        )
+        if payment_result.is_error():
+            record_failed_transaction(user.email, amount, selected_plan, payment_result.errors)
+            return payment_error_response(payment_result.errors)
+
+        complete_checkout(
+            user.email, selected_plan, amount, customer_id, card_id, user=user,
+            payment_id=payment_result.body['payment']['id'],
+        )
+        return JsonResponse({"success": True, "plan": selected_plan})
+
+    except SquareUnavailable as e:
+        logger.error("Square unavailable: %s", str(e))
+        record_failed_transaction(user.email, amount, selected_plan, e)
+        return JsonResponse({"error": PAYMENT_PROVIDER_UNAVAILABLE}, status=503)
+
+    except Exception as e:
+        logger.error("Unexpected error occurred: %s", str(e), exc_info=True)
+        return JsonResponse({"error": f"An unexpected error occurred: {str(e)}"}, status=500)
+
+
+from django.contrib.admin.views.decorators import staff_member_required
+from django.utils.dateparse import parse_date
+from .revenue import revenue_report
+from django.http import Http404, StreamingHttpResponse
+from django.core.handlers.asgi import ASGIRequest
+from . import exports
+from django.contrib import admin
+
+
+@staff_member_required
+def square_metrics(request):
+    """
+    This worker's Square latency histograms and circuit states, per endpoint.
+    """
+    return JsonResponse(square_gateway.metrics())
+
+
+@staff_member_required
+def revenue_report_view(request):
+    """
+    Revenue from the daily rollups for ?start=YYYY-MM-DD&end=YYYY-MM-DD (default: the last 30 days),
+    optionally narrowed to one &plan= and &status=.
+    """
+    today = timezone.localdate()
+    try:
+        start = parse_date(request.GET['start']) if request.GET.get('start') else today - timedelta(days=29)
+        end = parse_date(request.GET['end']) if request.GET.get('end') else today
+    except ValueError:
+        start = end = None
+    if start is None or end is None or start > end:
+        return JsonResponse({"error": "start and end must be dates (YYYY-MM-DD), start first."}, status=400)
+    return JsonResponse(revenue_report(start, end, plan=request.GET.get('plan'), status=request.GET.get('status')))
+
+
+@staff_member_required
+def renewal_forecast(request):
+    """
+    Expected renewals and revenue per day for the next ?days= (default 90), scheduled and churn-adjusted,
+    as an admin page or with ?format=json. Cached for the day; ?refresh=1 recomputes it.
+    """
+    from . import forecast  # forecast imports billing, which imports this module
+
+    try:
+        horizon_days = int(request.GET.get('days', forecast.DEFAULT_HORIZON_DAYS))
+    except ValueError:
+        horizon_days = 0
+    if not 1 <= horizon_days <= 366:
+        return JsonResponse({"error": "days must be between 1 and 366."}, status=400)
+    result = forecast.cached_forecast(horizon_days, refresh=request.GET.get('refresh') == '1')
+    if request.GET.get('format') == 'json':
+        return JsonResponse(result)
+    return render(request, 'myApp/renewal_forecast.html', {
+        **admin.site.each_context(request),
+        'title': 'Renewal forecast',
+        'forecast': result,
+    })
+
+@staff_member_required
+def export_records(request, kind):
+    """
+    Streams transactions or access rows as ?format=csv|ndjson, gzipped unless ?gzip=0, optionally filtered by
+    ?start=, ?end= (YYYY-MM-DD) and ?status=. `manage.py export_records` writes the same files.
+    """
+    if kind not in exports.EXPORTS:
+        raise Http404("No such export.")
+    fmt = request.GET.get('format', 'csv')
+    if fmt not in exports.FORMATS:
+        return JsonResponse({"error": f"format must be one of {', '.join(exports.FORMATS)}."}, status=400)
+    compress = request.GET.get('gzip', '1') != '0'
+    try:
+        start = parse_date(request.GET['start']) if request.GET.get('start') else None
+        end = parse_date(request.GET['end']) if request.GET.get('end') else None
+        if (request.GET.get('start') and start is None) or (request.GET.get('end') and end is None):
+            raise ValueError("start and end must be dates (YYYY-MM-DD).")
+        blocks = exports.stream_export(
+            kind, fmt, compress, start=start, end=end, status=request.GET.get('status') or None
+        )
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+
+    if isinstance(request, ASGIRequest):
+        # Streamed a block at a time under ASGI too, rather than built in memory first
+        blocks = exports.async_blocks(blocks)
+    response = StreamingHttpResponse(
+        blocks, content_type='application/gzip' if compress else f"{exports.FORMATS[fmt]}; charset=utf-8"
+    )
+    filename = exports.export_filename(kind, fmt, compress, start, end)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+
+@csrf_exempt
+def square_webhook(request):
+    """
+    Receives Square event notifications. The signature is checked and the event appended to the ingest table,
+    nothing more, so bursts and replays are answered quickly; `manage.py reconcile_webhooks` applies them.
+    """
+    if request.method != "POST":
+        return JsonResponse({"error": "Invalid request method."}, status=405)
+    if not settings.SQUARE_WEBHOOK_SIGNATURE_KEY:
+        logger.error("Square webhook received but SQUARE_WEBHOOK_SIGNATURE_KEY is not set")
+        return JsonResponse({"error": "Webhooks are not configured."}, status=503)
+
+    body = request.body.decode('utf-8', errors='replace')
+    if not is_valid_webhook_event_signature(
+        body,
+        request.headers.get('X-Square-Hmacsha256-Signature', ''),
+        settings.SQUARE_WEBHOOK_SIGNATURE_KEY,
+        settings.SQUARE_WEBHOOK_URL or request.build_absolute_uri(),
+    ):
+        return JsonResponse({"error": "Invalid signature."}, status=403)
+
+    try:
+        payload = json.loads(body)
+    except json.JSONDecodeError:
+        return JsonResponse({"error": "Invalid JSON data."}, status=400)
+    if not webhooks.ingest_events([payload]):
+        return JsonResponse({"error": "Not a Square event."}, status=400)
+    return JsonResponse({"received": True})
 
 
 from django.shortcuts import render
 from .models import BotService, AIUserAccess
-from django.core.paginator import Paginator
+from .catalog import active_services
+from .entitlements import get_entitlements
+from .pagination import paginate_services
+
+def user_service_tabs(user):
+    """
+    Fetches all of the user's access rows joined to their services in a single query and splits them
+    into the ongoing/completed/saved/favorite tabs, so rendering the tabs never goes back to the database.
+    """
+    tabs = {'ongoing': [], 'completed': [], 'saved': [], 'favorite': []}
+    rows = (
+        AIUserAccess.objects.filter(user=user, bot_service__isnull=False)
+        .select_related('bot_service', 'user')
+        .order_by('bot_service__order', 'bot_service_id')
+    )
+    for access in rows:
+        if access.progress >= 100:
+            tabs['completed'].append(access)
+        elif access.progress > 0:
+            tabs['ongoing'].append(access)
+        if access.is_saved:
+            tabs['saved'].append(access)
+        if access.is_favorite:
+            tabs['favorite'].append(access)
+    return tabs
+
 
 def coursemenu(request):
     if request.user.is_authenticated:
-        # Get the current page number from the request
-        page_number = request.GET.get('page', 1)
+        # Keyset cursor for the recommended list; ?page=N is still honoured for old links
+        cursor = request.GET.get('cursor')
+        page_number = request.GET.get('page')
 
-        # Fetch all bot services
-        all_services = BotService.objects.filter(is_active=True)
+        # Fetch all active bot services from the versioned catalog cache
+        all_services = active_services()
 
-        # Separate saved and favorite bot services for the user
-        saved_services = AIUserAccess.objects.filter(user=request.user, is_saved=True)
-        favorite_services = AIUserAccess.objects.filter(user=request.user, is_favorite=True)
+        # One query for all of the user's access rows, split into the four tabs in Python
+        tabs = user_service_tabs(request.user)
+
+        # Keyset pagination on (order, id) for all services (recommended bot services)
+        recommended_services_page = paginate_services(
+            all_services, cursor=cursor, page=page_number, per_page=8, estimate_total=True
+        )
 
-        # Pagination for all services (recommended bot services)
-        paginator = Paginator(all_services, 8)  # 8 bot services per page
-        recommended_services_page = paginator.get_page(page_number)
+        # The services the user's plan lets them open, from the entitlement cache
+        entitled_service_ids = get_entitlements(request.user)['service_ids']
 
         context = {
-            'saved_services': saved_services,
-            'favorite_services': favorite_services,
+            'entitled_service_ids': entitled_service_ids,
+            'ongoing_services': tabs['ongoing'],
+            'completed_services': tabs['completed'],
+            'saved_services': tabs['saved'],
+            'favorite_services': tabs['favorite'],
+            'tab_counts': {tab: len(rows) for tab, rows in tabs.items()},
             'recommended_services_page': recommended_services_page,  # Include paginated page
         }
 
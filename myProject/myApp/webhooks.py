@@ -0,0 +1,173 @@
+import logging
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Q, Subquery
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .entitlements import invalidate_entitlements
+from .models import AIUserAccess, BotBotTransaction, BotSubscription, SquareWebhookEvent
+from .revenue import record_status_changes
+
+logger = logging.getLogger(__name__)
+
+# Square payment status -> BotBotTransaction status
+PAYMENT_STATUSES = {
+    'COMPLETED': 'success',
+    'APPROVED': 'pending',
+    'PENDING': 'pending',
+    'FAILED': 'error',
+    'CANCELED': 'error',
+}
+
+# Square dispute state -> BotBotTransaction status; a lost or accepted dispute returns the money like a refund
+DISPUTE_STATUSES = {
+    'WON': 'success',
+    'INQUIRY_CLOSED': 'success',
+    'LOST': 'refunded',
+    'ACCEPTED': 'refunded',
+}
+
+
+def _money(payment, field):
+    return (payment.get(field) or {}).get('amount') or 0
+
+
+def payment_status(payment):
+    """
+    The transaction status for a Square payment object. Refunds show up here too: Square sends payment.updated
+    with refunded_money when a refund completes, and a payment refunded in full counts as refunded.
+    """
+    total = _money(payment, 'total_money') or _money(payment, 'amount_money')
+    if total and _money(payment, 'refunded_money') >= total:
+        return 'refunded'
+    return PAYMENT_STATUSES.get(payment.get('status'))
+
+
+def parse_event(payload):
+    """
+    Builds an unsaved SquareWebhookEvent from a notification body, or returns None if it isn't one.
+    Only the payment it concerns and the transaction status it implies are pulled out; refund events are kept
+    for the record but change nothing themselves, since the payment.updated that accompanies them does.
+    """
+    if not isinstance(payload, dict) or not payload.get('event_id') or not payload.get('type'):
+        return None
+    event_type = payload['type']
+    data_object = (payload.get('data') or {}).get('object') or {}
+
+    payment_id = status = None
+    if 'payment' in data_object:
+        payment = data_object['payment']
+        payment_id, status = payment.get('id'), payment_status(payment)
+    elif 'refund' in data_object:
+        payment_id = data_object['refund'].get('payment_id')
+    elif 'dispute' in data_object:
+        dispute = data_object['dispute']
+        payment_id = (dispute.get('disputed_payment') or {}).get('payment_id')
+        status = DISPUTE_STATUSES.get(dispute.get('state'), 'disputed')
+
+    return SquareWebhookEvent(
+        event_id=payload['event_id'],
+        event_type=event_type,
+        payment_id=payment_id,
+        transaction_status=status if payment_id else None,
+        occurred_at=parse_datetime(payload.get('created_at') or '') or timezone.now(),
+        payload=payload,
+    )
+
+
+def ingest_events(payloads):
+    """
+    Appends notifications to the ingest table in one INSERT. Redeliveries of an event already stored are dropped
+    by the unique event_id, so a replay of thousands of old events costs one cheap statement each and nothing more.
+    """
+    events = [event for event in map(parse_event, payloads) if event is not None]
+    SquareWebhookEvent.objects.bulk_create(events, ignore_conflicts=True)
+    return len(events)
+
+
+def latest_payment_status():
+    # The status implied by the newest event for the outer transaction's payment, received in any batch so far
+    return Subquery(
+        SquareWebhookEvent.objects.filter(payment_id=OuterRef('square_payment_id'), transaction_status__isnull=False)
+        .order_by('-occurred_at', '-id')
+        .values('transaction_status')[:1]
+    )
+
+
+def apply_payment_statuses(payment_ids):
+    """
+    Sets the transactions for these payments to the status of their payment's newest event, received in this
+    batch or any earlier one, so events arriving out of order still end on the right status. The rows are locked
+    and read first to move their revenue rollups, then written with one UPDATE per new status.
+    Returns the number of transactions changed.
+    """
+    changes = list(
+        BotBotTransaction.objects.select_for_update()
+        .filter(square_payment_id__in=payment_ids)
+        .annotate(new_status=latest_payment_status())
+        .exclude(status=F('new_status'))
+        .values_list('id', 'BotTransaction_date', 'subscription_type', 'amount', 'status', 'new_status')
+    )
+    ids_by_status = defaultdict(list)
+    for txn_id, *_, new_status in changes:
+        ids_by_status[new_status].append(txn_id)
+    for new_status, ids in ids_by_status.items():
+        BotBotTransaction.objects.filter(id__in=ids).update(status=new_status)
+    record_status_changes([change[1:] for change in changes])
+    return len(changes)
+
+
+def revoke_refunded_access(payment_ids, now):
+    """
+    Ends access for users whose refunded payment is their latest successful one; a refund of an old purchase
+    leaves a newer one alone. Lifetime plans are ended too. Renewals stop, since the card was charged back.
+    Returns the affected user ids.
+    """
+    later_success = BotBotTransaction.objects.filter(
+        user=OuterRef('user'), status='success', BotTransaction_date__gt=OuterRef('BotTransaction_date')
+    )
+    user_ids = list(
+        BotBotTransaction.objects.filter(square_payment_id__in=payment_ids, status='refunded')
+        .exclude(Exists(later_success))
+        .values_list('user_id', flat=True)
+        .distinct()
+    )
+    if not user_ids:
+        return []
+    # `manage.py sweep_expirations` deactivates them and sends subscription_expired as for any other expiry
+    BotSubscription.objects.filter(user_id__in=user_ids).filter(
+        Q(expiration_date__isnull=True) | Q(expiration_date__gt=now)
+    ).update(expiration_date=now, next_billing_date=None, updated_at=now)
+    AIUserAccess.objects.filter(user_id__in=user_ids, expiration_date__gt=now).update(expiration_date=now)
+    transaction.on_commit(lambda: invalidate_entitlements(*user_ids))
+    return user_ids
+
+
+def reconcile_batch(batch_size=500):
+    """
+    Applies the next batch of unprocessed events in one transaction: statuses, revenue rollups and access.
+    Returns (events processed, transactions changed).
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        events = list(
+            SquareWebhookEvent.objects.select_for_update(skip_locked=True)
+            .filter(processed_at__isnull=True)
+            .order_by('id')
+            .values_list('id', 'payment_id', 'transaction_status')[:batch_size]
+        )
+        if not events:
+            return 0, 0
+        payment_ids = {payment_id for _, payment_id, status in events if status is not None}
+
+        changed = 0
+        if payment_ids:
+            changed = apply_payment_statuses(payment_ids)
+            revoked = revoke_refunded_access(payment_ids, now)
+            if revoked:
+                logger.info("Ended access for %s users after refunds or lost disputes", len(revoked))
+
+        SquareWebhookEvent.objects.filter(id__in=[event_id for event_id, _, _ in events]).update(processed_at=now)
+    return len(events), changed
@@ -77,12 +77,7 @@ WSGI_APPLICATION = 'myProject.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
-    }
-}
+# DATABASES is built from DATABASE_PROFILE further down, once the environment has been read
 
 
 # Password validation
@@ -133,6 +128,7 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 import environ
 import os
+from django.core.exceptions import ImproperlyConfigured
 
 # Initialize environment variables
 env = environ.Env()
@@ -140,12 +136,121 @@ environ.Env.read_env(os.path.join(BASE_DIR, '.env'))
 
 # Access the environment variable
 SQUARE_ACCESS_TOKEN = env('SQUARE_ACCESS_TOKEN')
-
-
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
-EMAIL_HOST = 'smtp.office365.com'
-EMAIL_PORT = 587
-EMAIL_USE_TLS = True
+SQUARE_ENVIRONMENT = env('SQUARE_ENVIRONMENT', default='sandbox')
+# Only used when SQUARE_ENVIRONMENT=custom, e.g. http://127.0.0.1:8765 for `manage.py fake_square`
+SQUARE_CUSTOM_URL = env('SQUARE_CUSTOM_URL', default='https://connect.squareup.com')
+# Per-attempt timeout (seconds) for Square endpoints without their own entry in SQUARE_ENDPOINT_TIMEOUTS
+SQUARE_CALL_TIMEOUT = env.float('SQUARE_CALL_TIMEOUT', default=10.0)
+# e.g. SQUARE_ENDPOINT_TIMEOUTS=payments.create_payment=20,cards.create_card=5 (see myApp.square_gateway)
+SQUARE_ENDPOINT_TIMEOUTS = env.dict('SQUARE_ENDPOINT_TIMEOUTS', cast={'value': float}, default={})
+# Keep-alive connections to Square per process
+SQUARE_POOL_SIZE = env.int('SQUARE_POOL_SIZE', default=20)
+# Attempts per call on transient errors (only for requests carrying an idempotency key), with jittered backoff
+SQUARE_MAX_ATTEMPTS = env.int('SQUARE_MAX_ATTEMPTS', default=3)
+SQUARE_RETRY_BASE_DELAY = env.float('SQUARE_RETRY_BASE_DELAY', default=0.2)
+SQUARE_RETRY_MAX_DELAY = env.float('SQUARE_RETRY_MAX_DELAY', default=2.0)
+# Consecutive transient failures that open an endpoint's circuit, and seconds before a trial call is let through
+SQUARE_BREAKER_THRESHOLD = env.int('SQUARE_BREAKER_THRESHOLD', default=5)
+SQUARE_BREAKER_RESET_TIMEOUT = env.float('SQUARE_BREAKER_RESET_TIMEOUT', default=30.0)
+# From the webhook subscription in the Square Developer portal. The URL must be exactly the notification URL
+# registered there, since it is part of what Square signs; without it the request's own URL is used.
+SQUARE_WEBHOOK_SIGNATURE_KEY = env('SQUARE_WEBHOOK_SIGNATURE_KEY', default='')
+SQUARE_WEBHOOK_URL = env('SQUARE_WEBHOOK_URL', default='')
+
+# inline: process_payment answers once the checkout is done. queued: it answers 202 straight away and the
+# checkout is run by `manage.py process_checkouts`; the browser polls checkout-status/<id>/ for the outcome.
+CHECKOUT_MODE = env('CHECKOUT_MODE', default='inline')
+
+# Process-local by default; point CACHE_URL at a shared backend (e.g. rediscache://, memcache://,
+# dbcache://cache_table) so the catalog and entitlement caches are shared between workers.
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://'),
+}
+# A process-local cache never hears of changes made by another process: other web workers, or management
+# commands such as run_renewals, reconcile_webhooks and sweep_expirations. With one, the catalog and
+# entitlement caches only hold entries this many seconds, so such changes can show up that much later.
+# Run more than one process with a shared CACHE_URL, where changes show up at once.
+LOCAL_CACHE_TTL = env.int('LOCAL_CACHE_TTL', default=60)
+
+# Session storage for the quiz and plan-selection funnel:
+#   cached_db (default)  read from the cache, written through to django_session
+#   signed_cookies       kept entirely in a signed cookie, so anonymous funnel traffic never touches the database
+#   db                   django_session only
+SESSION_STRATEGY = env('SESSION_STRATEGY', default='cached_db')
+if SESSION_STRATEGY not in ('cached_db', 'signed_cookies', 'db'):
+    raise ImproperlyConfigured(f"Unknown SESSION_STRATEGY {SESSION_STRATEGY!r}")
+SESSION_ENGINE = f'django.contrib.sessions.backends.{SESSION_STRATEGY}'
+
+# Database profile:
+#   sqlite (default)  db.sqlite3 with SQLite's stock settings
+#   sqlite-wal        db.sqlite3 in WAL mode, tuned so concurrent checkouts wait for the write lock instead of
+#                     failing with "database is locked". Switching to WAL rewrites the file's header, so it is
+#                     opted into where the app is served (see procfile) rather than by every manage.py run
+#                     against the checked-in db.sqlite3
+#   postgres          DATABASE_URL, with a psycopg pool when DATABASE_POOL_SIZE > 0
+DATABASE_PROFILE = env('DATABASE_PROFILE', default='sqlite')
+
+# The app is served over ASGI (see procfile), where every request runs its ORM work on a fresh thread, so
+# persistent connections would pile up rather than be reused; Django's docs say to disable them there.
+# Only raise DATABASE_CONN_MAX_AGE for a WSGI deployment.
+DATABASE_CONN_MAX_AGE = env.int('DATABASE_CONN_MAX_AGE', default=0)
+
+if DATABASE_PROFILE == 'postgres':
+    DATABASES = {'default': env.db('DATABASE_URL')}
+    DATABASE_POOL_SIZE = env.int('DATABASE_POOL_SIZE', default=0)
+    if DATABASE_POOL_SIZE:
+        # Needs psycopg[pool]; Django refuses persistent connections alongside a pool
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default'].setdefault('OPTIONS', {})['pool'] = {
+            'min_size': env.int('DATABASE_POOL_MIN_SIZE', default=2),
+            'max_size': DATABASE_POOL_SIZE,
+            'timeout': env.float('DATABASE_POOL_TIMEOUT', default=10.0),
+        }
+    else:
+        DATABASES['default']['CONN_MAX_AGE'] = DATABASE_CONN_MAX_AGE
+        DATABASES['default']['CONN_HEALTH_CHECKS'] = True
+elif DATABASE_PROFILE == 'sqlite-wal':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+            'OPTIONS': {
+                # Seconds a writer waits for the lock before giving up
+                'timeout': env.float('SQLITE_BUSY_TIMEOUT', default=20.0),
+                # Take the write lock when the transaction starts; a deferred transaction that reads first
+                # and then writes can't wait for the lock and fails immediately
+                'transaction_mode': 'IMMEDIATE',
+                'init_command': (
+                    'PRAGMA journal_mode=WAL;'
+                    'PRAGMA synchronous=NORMAL;'
+                    f"PRAGMA mmap_size={env.int('SQLITE_MMAP_SIZE', default=128 * 1024 * 1024)};"
+                    'PRAGMA cache_size=-20000;'
+                    'PRAGMA temp_store=MEMORY;'
+                ),
+            },
+        }
+    }
+elif DATABASE_PROFILE == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+        }
+    }
+else:
+    raise ImproperlyConfigured(f"Unknown DATABASE_PROFILE {DATABASE_PROFILE!r}")
+
+
+# All mail is queued in the EmailOutbox table and delivered by `manage.py send_outbox`
+EMAIL_BACKEND = 'myApp.outbox.OutboxEmailBackend'
+EMAIL_DELIVERY_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+# Sent and failed outbox rows are deleted this many days after their last attempt (`send_outbox` purges them)
+EMAIL_OUTBOX_RETENTION_DAYS = env.int('EMAIL_OUTBOX_RETENTION_DAYS', default=30)
+EMAIL_HOST = env('EMAIL_HOST', default='smtp.office365.com')
+EMAIL_PORT = env.int('EMAIL_PORT', default=587)
+EMAIL_USE_TLS = env.bool('EMAIL_USE_TLS', default=True)
+EMAIL_TIMEOUT = env.int('EMAIL_TIMEOUT', default=30)
 EMAIL_HOST_USER = env('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = env('EMAIL_HOST_PASSWORD')
 DEFAULT_FROM_EMAIL = env('DEFAULT_FROM_EMAIL')
\ No newline at end of file